@@ -8,9 +8,16 @@ from amarillo.models.Carpool import Agency, Carpool, Region
 from amarillo.services import stops
 from amarillo.services import trips
 from amarillo.services.agencyconf import AgencyConfService, agency_conf_directory
+from amarillo.services.bbox_feed import BboxFeedService
 from amarillo.services.carpools import CarpoolService
+from amarillo.services.enhancement import EnhancementPipeline
+from amarillo.services.feed_cache import FeedCache, FileDigests
+from amarillo.services.gtfs import GtfsRtProducer
+from amarillo.services.gtfs_history import GtfsFeedHistory
+from amarillo.services.gtfsrt_publisher import GtfsRtPublisher
 from amarillo.services.agencies import AgencyService
 from amarillo.services.regions import RegionService
+from amarillo.services.routing import RoutingCache
 
 from amarillo.services.config import config
 
@@ -26,8 +33,6 @@ def create_required_directories():
     logger.info("Checking that necessary directories exist")
     # Folder to serve GTFS(-RT) from
     assert_folder_exists('data/gtfs')
-    # Temp folder for GTFS generation
-    assert_folder_exists('data/tmp')
 
     for agency_id in container['agencies'].agencies:
         for subdir in ['carpool', 'trash', 'enhanced', 'failed']:
@@ -49,6 +54,11 @@ def configure_services():
     container['regions'] = RegionService()
     logger.info("Loaded %d regions", len(container['regions'].regions))
 
+    container['feed_cache'] = FeedCache()
+    container['bbox_feed'] = BboxFeedService(container['feed_cache'])
+    container['file_digests'] = FileDigests()
+    container['gtfs_history'] = GtfsFeedHistory(max_versions=config.gtfs_history_size)
+
     create_required_directories()
 
 
@@ -62,8 +72,26 @@ def configure_enhancer_services():
 
     stop_store.load_stop_sources()
     container['stops_store'] = stop_store
-    container['trips_store'] = trips.TripStore(stop_store, container['agencyconf'])
-    container['carpools'] = CarpoolService(container['trips_store'], config.max_age_carpool_offers_in_days)
+    routing_cache = RoutingCache(
+        config.routing_cache_file,
+        config.routing_cache_max_entries,
+        config.routing_cache_ttl_in_days * 86400,
+        config.routing_cache_precision) if config.routing_cache_file else None
+    container['trips_store'] = trips.TripStore(stop_store, container['agencyconf'], container['regions'], routing_cache)
+    container['gtfsrt_producer'] = GtfsRtProducer(container['trips_store'], config.gtfsrt_horizon_in_hours)
+    container['gtfsrt_publisher'] = GtfsRtPublisher(
+        container['gtfsrt_producer'],
+        container['trips_store'],
+        container['regions'].regions.keys(),
+        debounce_in_s=config.gtfsrt_debounce_in_s,
+        heartbeat_in_s=config.gtfsrt_heartbeat_in_s)
+    container['enhancement_pipeline'] = EnhancementPipeline(
+        container['trips_store'],
+        workers=config.enhancement_workers,
+        queue_size=config.enhancement_queue_size,
+        batch_size=config.enhancement_batch_size)
+    container['enhancement_pipeline'].start()
+    container['carpools'] = CarpoolService(container['enhancement_pipeline'], config.max_age_carpool_offers_in_days)
 
     logger.info("Restore carpools...")
 
@@ -85,6 +113,7 @@ def configure_enhancer_services():
                 except Exception as e:
                     logger.warning("Issue during deletion of carpool %s: %s", carpool_file_name, repr(e))
 
+    container['enhancement_pipeline'].join()
     logger.info("Restored carpools: %s", container['carpools'].get_all_ids())
     logger.info("Starting scheduler")
     Syncer(FileBasedStore(), container["agencyconf"]).schedule_full_sync(config.daily_sync_time)
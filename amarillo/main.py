@@ -7,6 +7,8 @@ from fastapi.responses import JSONResponse
 
 from amarillo.configuration import configure_services, configure_admin_token
 from amarillo.services.config import config
+from amarillo.services.feed_cache import DigestStaticFiles
+from amarillo.utils.container import container
 
 logging.config.fileConfig('logging.conf', disable_existing_loggers=False)
 logger = logging.getLogger("main")
@@ -15,7 +17,7 @@ import uvicorn
 import mimetypes
 from starlette.staticfiles import StaticFiles
 
-from amarillo.routers import carpool, agency, agencyconf, region
+from amarillo.routers import carpool, agency, agencyconf, region, gtfsrt
 from fastapi import FastAPI, Request
 
 # https://pydantic-docs.helpmanual.io/usage/settings/
@@ -59,6 +61,7 @@ app.include_router(carpool.router)
 app.include_router(agency.router)
 app.include_router(agencyconf.router)
 app.include_router(region.router)
+app.include_router(gtfsrt.router)
 
 
 def configure():
@@ -100,7 +103,7 @@ def configure_routing():
             category=DeprecationWarning,
             stacklevel=2,
         )
-        app.mount('/gtfs', StaticFiles(directory='data/gtfs'), name='gtfs')
+        app.mount('/gtfs', DigestStaticFiles(directory='data/gtfs', digests=container['file_digests']), name='gtfs')
         
     app.include_router(home.router)
 
@@ -1,7 +1,9 @@
-from pydantic import ConfigDict, BaseModel, Field, HttpUrl, AnyUrl
+from pydantic import ConfigDict, BaseModel, Field, HttpUrl, AnyUrl, field_validator
 from enum import Enum
 from typing import Optional
 
+from amarillo.utils.utils import check_speed_profile
+
 
 class AgencyRole(str, Enum):
     consumer = "consumer"
@@ -43,12 +45,27 @@ class AgencyConf(BaseModel):
         default=True,
         examples=[True])
 
+    use_supplied_path: bool = Field(
+        description="Should Amarillo add pickup/dropoff points along the path supplied with a carpool instead of routing it? Stop times are then estimated from the distance along the path and the speed profile.",
+        default=False,
+        examples=[True])
+
+    speed_profile: Optional[list[tuple[float, float]]] = Field(
+        description="Speeds (km/h) starting at the given distances (km) from the trip's origin, used to estimate stop times along supplied paths. Defaults to the configured default speed profile.",
+        default=None,
+        examples=[[[0, 30], [5, 60], [30, 90]]])
+
     roles: list[AgencyRole] = Field(
         description="Roles this agency has.",
         default=[],
         examples=[["carpool_agency"], ["consumer"]],
     )
 
+    @field_validator('speed_profile')
+    @classmethod
+    def check_speed_profile(cls, value):
+        return value if value is None else check_speed_profile(value)
+
     model_config = ConfigDict(
         json_schema_extra={
             "title": "Agency Configuration",
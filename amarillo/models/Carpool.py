@@ -118,6 +118,13 @@ class Region(BaseModel):
         description="Bounding box of the region. Format is [minLon, minLat, maxLon, maxLat]",
         examples=[[10.5,49.2,11.3,51.3]])
 
+    gtfsrt_horizon_in_hours: Optional[NumType] = Field(
+        None,
+        description="Only trips departing within this many hours are published in the region's "
+        "GTFS-RT feed. If not given, the globally configured horizon applies.",
+        gt=0,
+        examples=[36])
+
 class Agency(BaseModel):
     id: str = Field(
         description="ID of the agency.",
@@ -0,0 +1,61 @@
+import logging
+import math
+
+from fastapi import APIRouter, HTTPException, Request, status, Depends
+from fastapi.responses import Response
+
+from amarillo.routers.agencyconf import verify_consumer_api_key
+from amarillo.services.bbox_feed import BboxFeedService
+from amarillo.services.feed_cache import cached_file_response
+from amarillo.utils.container import container
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(
+    prefix="/gtfs-rt",
+    tags=["region"]
+)
+
+
+@router.get("/",
+    summary="Return GTFS-RT Feed for a bounding box",
+    description="Returns a GTFS-RT feed containing only trips intersecting the given bounding box "
+    "and, optionally, offered by the given agency.",
+    response_description="GTFS-RT-Feed",
+    response_class=Response,
+    responses={
+        status.HTTP_304_NOT_MODIFIED: {"description": "Feed not modified since the version identified by If-None-Match"},
+        status.HTTP_400_BAD_REQUEST: {"description": "Bad request, e.g. because bbox is malformed or format is neither protobuf nor json."},
+        status.HTTP_404_NOT_FOUND: {"description": "Feed not available yet"},
+        }
+)
+async def get_bbox_feed(request: Request, bbox: str, agency: str | None = None, format: str = "protobuf", user: str = Depends(verify_consumer_api_key)):
+    """
+    bbox is given as minLon,minLat,maxLon,maxLat, e.g. 8.9,48.4,9.3,48.9
+    """
+    if format not in ['json', 'protobuf']:
+        message = "Specified format is not supported, i.e. neither protobuf nor json."
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=message)
+    coordinates = _parse_bbox(bbox)
+
+    service: BboxFeedService = container['bbox_feed']
+    feed = service.get_feed(coordinates, agency, format)
+    if feed is None:
+        message = "GTFS-RT feed is not available yet."
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=message)
+
+    media_type = 'application/json' if format == 'json' else 'application/x-protobuf'
+    return cached_file_response(request, feed, media_type)
+
+
+def _parse_bbox(bbox: str):
+    try:
+        coordinates = [float(c) for c in bbox.split(',')]
+    except ValueError:
+        coordinates = []
+
+    if len(coordinates) != 4 or not all(math.isfinite(c) for c in coordinates) or \
+            coordinates[0] > coordinates[2] or coordinates[1] > coordinates[3]:
+        message = "bbox must be given as minLon,minLat,maxLon,maxLat"
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=message)
+    return coordinates
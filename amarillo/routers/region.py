@@ -1,14 +1,21 @@
+import csv
+import io
+import json
 import logging
 import time
 from typing import List
 
-from fastapi import APIRouter, HTTPException, status, Depends
+from fastapi import APIRouter, HTTPException, Request, status, Depends
 
 from amarillo.models.Carpool import Region
 from amarillo.routers.agencyconf import verify_consumer_api_key
+from amarillo.services.feed_cache import CachedFile, FeedCache, FileDigests, cached_file_response, digest_file_response
+from amarillo.services.gtfs import differential_feed, feed_to_json
+from amarillo.services.gtfs_history import DIFF_FILES, GtfsFeedHistory
+from amarillo.services.gtfsrt import gtfs_realtime_pb2
 from amarillo.services.regions import RegionService
 from amarillo.utils.container import container
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, Response, StreamingResponse
 
 logger = logging.getLogger(__name__)
 
@@ -58,31 +65,135 @@ def _assert_region_exists(region_id: str) -> Region:
 
 @router.get("/{region_id}/gtfs", 
     summary="Return GTFS Feed for this region",
+    description="Returns the GTFS feed. Its ETag is the hash of its content, so If-None-Match "
+    "only returns the feed, if its content changed. Range requests are supported.",
     response_description="GTFS-Feed (zip-file)",
     response_class=FileResponse,
     responses={
+        status.HTTP_304_NOT_MODIFIED: {"description": "Feed not modified since the version identified by If-None-Match"},
         status.HTTP_404_NOT_FOUND: {"description": "Region not found"},
         }
 )
-async def get_file(region_id: str, user: str = Depends(verify_consumer_api_key)):
+async def get_file(region_id: str, request: Request, user: str = Depends(verify_consumer_api_key)):
     _assert_region_exists(region_id)
-    return FileResponse(f'data/gtfs/amarillo.{region_id}.gtfs.zip')
+    digests: FileDigests = container['file_digests']
+    response = digest_file_response(request, digests, f'data/gtfs/amarillo.{region_id}.gtfs.zip', 'application/zip')
+    if response is None:
+        message = f"GTFS feed for region {region_id} is not available yet."
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=message)
+    return response
+
+@router.get("/{region_id}/gtfs/diff",
+    summary="Return the changes between two versions of the GTFS feed for this region",
+    description="Returns the rows of trips, stop_times, calendars, shapes and stops added, changed or removed "
+    "between the feed versions since and until (default: the latest version), as identified by feed_info's "
+    "feed_version. For added or changed entities, all their rows of version until are returned, which replace "
+    "their previous rows. For removed ones, their rows of version since are returned. "
+    "As NDJSON, each line is an object with the file, the change and the record. "
+    "As CSV, only the changes of the given file are returned, with the change as first column.",
+    response_description="Changes as NDJSON or CSV",
+    response_class=StreamingResponse,
+    responses={
+        status.HTTP_404_NOT_FOUND: {"description": "Region not found or feed versions not known (anymore)"},
+        status.HTTP_400_BAD_REQUEST: {"description": "Bad request, e.g. because format is neither ndjson nor csv, or file is missing for csv."}
+        }
+)
+async def get_gtfs_diff(region_id: str, since: str, until: str | None = None, format: str = "ndjson",
+        file: str | None = None, user: str = Depends(verify_consumer_api_key)):
+    _assert_region_exists(region_id)
+    if format not in ['ndjson', 'csv']:
+        message = "Specified format is not supported, i.e. neither ndjson nor csv."
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=message)
+    if (format == 'csv' and file is None) or (file is not None and file not in DIFF_FILES):
+        message = f"For csv, file must be one of {', '.join(DIFF_FILES)}."
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=message)
+
+    history: GtfsFeedHistory = container['gtfs_history']
+    if until is None:
+        versions = history.versions(region_id)
+        until = versions[0] if versions else None
+    changes = history.diff(region_id, since, until, [file] if file else None) if until else None
+    if changes is None:
+        message = f"GTFS feed versions {since} and {until} of region {region_id} are not known."
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=message)
+
+    headers = {'X-Feed-Version': until}
+    if format == 'csv':
+        return StreamingResponse(_changes_as_csv(changes, DIFF_FILES[file][0]), media_type='text/csv', headers=headers)
+    return StreamingResponse(_changes_as_ndjson(changes), media_type='application/x-ndjson', headers=headers)
+
+def _changes_as_ndjson(changes):
+    for change in changes:
+        yield json.dumps({'file': change.filename, 'change': change.change, 'record': change.record}) + '\n'
+
+def _changes_as_csv(changes, fields):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['change', *fields])
+    for change in changes:
+        writer.writerow([change.change, *(change.record.get(field) for field in fields)])
+        if buffer.tell() > 65536:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
 
 @router.get("/{region_id}/gtfs-rt",
     summary="Return GTFS-RT Feed for this region",
+    description="Returns the full GTFS-RT feed. If since is given, only the entities changed or removed "
+    "after the feed version since (the header timestamp of a previously fetched feed) are returned "
+    "as DIFFERENTIAL feed, if these are still known.",
     response_description="GTFS-RT-Feed",
-    response_class=FileResponse,
+    response_class=Response,
     responses={
+        status.HTTP_304_NOT_MODIFIED: {"description": "Feed not modified since the version identified by If-None-Match"},
         status.HTTP_404_NOT_FOUND: {"description": "Region not found"},
                 status.HTTP_400_BAD_REQUEST: {"description": "Bad request, e.g. because format is not supported, i.e. neither protobuf nor json."}
         }
 )
-async def get_file(region_id: str, format: str = "protobuf", user: str = Depends(verify_consumer_api_key)):
+async def get_file(region_id: str, request: Request, format: str = "protobuf", since: int | None = None, user: str = Depends(verify_consumer_api_key)):
     _assert_region_exists(region_id)
-    if format == 'json':
-        return FileResponse(f'data/gtfs/amarillo.{region_id}.gtfsrt.json')
-    elif format == 'protobuf':
-        return FileResponse(f'data/gtfs/amarillo.{region_id}.gtfsrt.pbf')
-    else:
+    if format not in ['json', 'protobuf']:
         message = "Specified format is not supported, i.e. neither protobuf nor json."
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=message)
+
+    media_type = 'application/json' if format == 'json' else 'application/x-protobuf'
+    feed_cache: FeedCache = container['feed_cache']
+    feed_path = f'data/gtfs/amarillo.{region_id}.gtfsrt'
+    if since is not None:
+        diff = _differential_feed(feed_cache, feed_path, since, format)
+        if diff is not None:
+            return cached_file_response(request, diff, media_type)
+
+    feed = feed_cache.get(f'{feed_path}.pbf')
+    if feed is None:
+        message = f"GTFS-RT feed for region {region_id} is not available yet."
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=message)
+    if format == 'json':
+        # created on first request per feed version
+        feed = feed.derive('json', lambda content: CachedFile(None, feed_to_json(_parsed_feed(feed))))
+    return cached_file_response(request, feed, media_type)
+
+def _parsed_feed(feed: CachedFile):
+    return feed.derive('message', gtfs_realtime_pb2.FeedMessage.FromString)
+
+def _differential_feed(feed_cache: FeedCache, feed_path: str, since: int, format: str) -> CachedFile | None:
+    """
+    Returns the changes of the GTFS-RT feed after feed version since,
+    or None, if they are not known and the full dataset needs to be served.
+    Differential feeds are cached per version of the full feed.
+    """
+    feed = feed_cache.get(f'{feed_path}.pbf')
+    versions = feed_cache.get(f'{feed_path}.versions.json')
+    if feed is None or versions is None:
+        return None
+
+    def create_differential_feed(content):
+        diff = differential_feed(_parsed_feed(feed), versions.derive('json', json.loads), since)
+        if diff is None:
+            return None
+        if format == 'json':
+            return CachedFile(None, feed_to_json(diff))
+        return CachedFile(None, diff.SerializeToString())
+
+    return feed.derive_bounded(('since', since, format, versions.signature), create_differential_feed)
@@ -0,0 +1,114 @@
+import json
+import logging
+import time
+
+import numpy as np
+import shapely
+
+from amarillo.services.feed_cache import CachedFile, FeedCache
+from amarillo.services.gtfs import feed_to_json
+from amarillo.services.gtfsrt import gtfs_realtime_pb2
+
+logger = logging.getLogger(__name__)
+
+
+class _SpatialFeedIndex:
+    """
+    Entities of one published feed version, indexed by an STRtree
+    over the bounds of the trips they were created for.
+    """
+
+    def __init__(self, feed, index):
+        self.feed = feed
+        self.agencies = np.array(index['agencies'], dtype=object)
+        bounds = np.array(index['bounds'], dtype=float).reshape(-1, 4)
+        self.tree = shapely.STRtree(shapely.box(bounds[:, 0], bounds[:, 1], bounds[:, 2], bounds[:, 3]))
+
+    def query(self, bbox, agency=None):
+        indices = np.sort(self.tree.query(shapely.box(*bbox), predicate='intersects'))
+        if agency is not None:
+            indices = indices[self.agencies[indices] == agency]
+
+        result = gtfs_realtime_pb2.FeedMessage()
+        result.header.CopyFrom(self.feed.header)
+        result.entity.extend(self.feed.entity[int(i)] for i in indices)
+        return result
+
+
+class BboxFeedService:
+    """
+    BboxFeedService serves GTFS-RT feeds for arbitrary bboxes, optionally
+    restricted to one agency. They are extracted from the published feed
+    of all trips, using the spatial index the enhancer publishes along
+    with it. The index is built once per feed version, results are cached
+    for RESULT_TTL_IN_S seconds. While a feed and its index are being
+    republished, i.e. don't match, the last matching pair is used.
+    """
+    RESULT_TTL_IN_S = 30
+    MAX_CACHED_RESULTS = 256
+
+    def __init__(self, feed_cache: FeedCache, feed_path: str = 'data/gtfs/amarillo.gtfsrt'):
+        self.feed_cache = feed_cache
+        self.feed_path = feed_path
+        # (bbox, agency, format) -> (index signature, expiry, CachedFile)
+        self._results = {}
+        # ((feed signature, index file signature), _SpatialFeedIndex) of the last matching feed and index
+        self._spatial_index = None
+
+    def get_feed(self, bbox, agency: str | None = None, format: str = 'protobuf') -> CachedFile | None:
+        """
+        Returns the feed of all entities whose trip intersects bbox, or None,
+        if no feed with matching index has been published (yet).
+        """
+        current = self._current_spatial_index()
+        if current is None:
+            return None
+        signature, spatial_index = current
+
+        key = (tuple(bbox), agency, format)
+        now = time.monotonic()
+        cached = self._results.get(key)
+        if cached is not None and cached[0] == signature and cached[1] > now:
+            return cached[2]
+
+        result_feed = spatial_index.query(bbox, agency)
+        if format == 'json':
+            result = CachedFile(None, feed_to_json(result_feed))
+        else:
+            result = CachedFile(None, result_feed.SerializeToString())
+
+        if len(self._results) >= self.MAX_CACHED_RESULTS:
+            self._results = {k: v for k, v in self._results.items() if v[1] > now}
+            if len(self._results) >= self.MAX_CACHED_RESULTS:
+                self._results.clear()
+        self._results[key] = (signature, now + self.RESULT_TTL_IN_S, result)
+        return result
+
+    def _current_spatial_index(self):
+        """
+        Returns the signature and spatial index of the published feed and
+        index. If they don't match, e.g. because the second one of them is
+        just being replaced, they are read once more, and if they still
+        don't match, the last matching pair is returned.
+        """
+        for _ in range(2):
+            feed = self.feed_cache.get(f'{self.feed_path}.pbf')
+            index = self.feed_cache.get(f'{self.feed_path}.index.json')
+            if feed is None or index is None:
+                break
+            signature = (feed.signature, index.signature)
+            if self._spatial_index is not None and self._spatial_index[0] == signature:
+                return self._spatial_index
+            spatial_index = self._create_index(feed.content, index)
+            if spatial_index is not None:
+                self._spatial_index = (signature, spatial_index)
+                return self._spatial_index
+        return self._spatial_index
+
+    def _create_index(self, content, index_file):
+        feed = gtfs_realtime_pb2.FeedMessage.FromString(content)
+        index = json.loads(index_file.content)
+        if index.get('version') != feed.header.timestamp or len(index['bounds']) != len(feed.entity):
+            logger.warning("Spatial index does not match feed %s.pbf", self.feed_path)
+            return None
+        return _SpatialFeedIndex(feed, index)
@@ -9,6 +9,11 @@ from amarillo.utils.utils import yesterday, is_older_than_days
 logger = logging.getLogger(__name__)
 
 class CarpoolService():
+    """
+    CarpoolService keeps the current carpools and puts them to or deletes
+    them from trip_store, which is a TripStore or an EnhancementPipeline
+    in front of it.
+    """
     
     def __init__(self, trip_store, max_age_carpool_offers_in_days: int = 180):
         self.max_age_carpool_offers_in_days = max_age_carpool_offers_in_days
@@ -1,6 +1,10 @@
-from typing import List
+from importlib.util import find_spec
+from typing import List, Literal
+from pydantic import field_validator
 from pydantic_settings import BaseSettings
 
+from amarillo.utils.utils import check_speed_profile
+
 
 class Config(BaseSettings):
     amarillo_baseurl: str = 'http://localhost:8000/'
@@ -14,6 +18,31 @@ class Config(BaseSettings):
     fahrgemeinschaft_query_data: str = None
     env: str = 'DEV'
     graphhopper_base_url: str = 'https://api.mfdz.de/gh'
+    # Routing results are cached in this SQLite file (disabled if empty),
+    # keyed by their points rounded to routing_cache_precision decimal places
+    routing_cache_file: str | None = 'data/routing-cache.sqlite'
+    routing_cache_max_entries: int = 100000
+    routing_cache_ttl_in_days: float = 30
+    routing_cache_precision: int = 5
+    # Routes are requested with at most routing_max_in_flight concurrent
+    # requests, each retried up to routing_retries times. After
+    # routing_circuit_breaker_failures consecutive failed requests,
+    # routing is suspended for routing_circuit_breaker_reset_in_s seconds
+    routing_max_in_flight: int = 8
+    routing_timeout_in_s: float = 10
+    routing_retries: int = 2
+    routing_retry_backoff_in_s: float = 0.5
+    routing_circuit_breaker_failures: int = 5
+    routing_circuit_breaker_reset_in_s: float = 30
+    # Carpools are enhanced by enhancement_workers concurrent workers,
+    # taking them from a queue of at most enhancement_queue_size carpools,
+    # and added to the trip store in batches of up to enhancement_batch_size
+    enhancement_workers: int = 16
+    enhancement_queue_size: int = 1000
+    enhancement_batch_size: int = 100
+    # Speeds (km/h) starting at the given distances (km) from a trip's
+    # origin, used to estimate stop times along agency supplied paths
+    default_speed_profile: list[tuple[float, float]] = [(0, 30), (5, 60), (30, 90)]
     stop_sources_file: str = 'conf/stop_sources.json'
     max_age_carpool_offers_in_days: int = 180
     # Syn per default at 11:30pm so all updates are done at midnight
@@ -22,5 +51,38 @@ class Config(BaseSettings):
     # To stay backwards compatible, we keep the endpoint per default,
     # but will print a warning.
     publish_deprecated_gtfs_endpoint: bool = True
+    # GTFS-RT feeds are regenerated this many seconds after the first
+    # of a batch of changes, and at least every gtfsrt_heartbeat_in_s seconds
+    gtfsrt_debounce_in_s: float = 2
+    gtfsrt_heartbeat_in_s: float = 60
+    # If set, GTFS-RT feeds only contain trips departing within this many
+    # hours, otherwise the next 14 days. Can be overriden per region.
+    gtfsrt_horizon_in_hours: float | None = None
+    # Number of processes exporting region GTFS feeds in parallel,
+    # defaults to the number of CPUs
+    gtfs_export_workers: int | None = None
+    # Compression of the GTFS zip entries, 'deflated' or 'stored', and
+    # the deflate level (0-9), defaults to zlib's default level 6
+    gtfs_zip_compression: Literal['deflated', 'stored'] = 'deflated'
+    gtfs_zip_compresslevel: int | None = None
+    # Number of published GTFS feeds kept per region, between which
+    # /region/{region_id}/gtfs/diff returns the changes
+    gtfs_history_size: int = 7
+    # If set, trips, stop_times, shapes, calendars etc. are additionally
+    # exported as 'parquet' or 'arrow' files next to each GTFS zip.
+    # Requires pyarrow (requirements.columnar.txt)
+    gtfs_columnar_format: Literal['parquet', 'arrow'] | None = None
+
+    @field_validator('default_speed_profile')
+    @classmethod
+    def check_default_speed_profile(cls, value):
+        return check_speed_profile(value)
+
+    @field_validator('gtfs_columnar_format')
+    @classmethod
+    def check_columnar_dependencies(cls, value):
+        if value is not None and find_spec('pyarrow') is None:
+            raise ValueError("gtfs_columnar_format requires pyarrow, see requirements.columnar.txt")
+        return value
 
 config = Config(_env_file='config', _env_file_encoding='utf-8')
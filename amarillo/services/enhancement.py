@@ -0,0 +1,146 @@
+import asyncio
+import itertools
+import logging
+import threading
+
+from amarillo.models.Carpool import Carpool
+
+logger = logging.getLogger(__name__)
+
+
+class EnhancementPipeline:
+    """
+    EnhancementPipeline enhances carpools concurrently and hands the
+    enhanced carpools to the TripStore in batches. It can be used in
+    place of the TripStore by the CarpoolService.
+
+    Carpools put by any thread are queued in a bounded queue (put_carpool
+    blocks while it is full) and enhanced by a number of worker
+    coroutines, which await their routes concurrently, in an event loop
+    running in its own thread. All changes of the TripStore are applied in this thread, in
+    batches of up to batch_size enhanced carpools.
+
+    A carpool put again or deleted while it is queued or being enhanced
+    supersedes the former put, whose enhancement is then discarded.
+    """
+
+    def __init__(self, trip_store, workers: int = 16, queue_size: int = 1000, batch_size: int = 100):
+        self.trip_store = trip_store
+        self.workers = workers
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        # agency scoped carpool id -> generation of its pending put
+        self._generations = {}
+        self._generation_counter = itertools.count()
+        self._loop = None
+        self._queue = None
+        self._enhanced = None
+
+    def start(self):
+        started = threading.Event()
+        thread = threading.Thread(target=self.run, args=(started,), name='enhancement-pipeline', daemon=True)
+        thread.start()
+        started.wait()
+        return thread
+
+    def run(self, started: threading.Event = None):
+        asyncio.run(self._run(started))
+
+    def put_carpool(self, carpool: Carpool):
+        """
+        Queues carpool for enhancement, blocking while the queue is full.
+        """
+        self._call(self._put_carpool(carpool))
+
+    def delete_carpool(self, agency_id: str, carpool_id: str):
+        """
+        Deletes carpool from the TripStore and discards its pending enhancement.
+        """
+        self._call(self._delete_carpool(agency_id, carpool_id))
+
+    def unflag_unrecent_updates(self):
+        """
+        Unflags trips which are not recent any longer, like
+        TripStore.unflag_unrecent_updates, in the pipeline's thread.
+        """
+        self._call(self._unflag_unrecent_updates())
+
+    def join(self):
+        """
+        Blocks until all queued carpools are enhanced and handed to the TripStore.
+        """
+        self._call(self._join())
+
+    def _call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    async def _run(self, started):
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(self.queue_size)
+        self._enhanced = asyncio.Queue()
+        tasks = [asyncio.create_task(self._enhance()) for _ in range(self.workers)]
+        tasks.append(asyncio.create_task(self._add_enhanced()))
+        if started is not None:
+            started.set()
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            await self.trip_store.transformer.async_router.aclose()
+
+    async def _put_carpool(self, carpool):
+        id = f"{carpool.agency}:{carpool.id}"
+        generation = self._generations[id] = next(self._generation_counter)
+        await self._queue.put((id, generation, carpool))
+
+    async def _delete_carpool(self, agency_id, carpool_id):
+        self._generations.pop(f"{agency_id}:{carpool_id}", None)
+        self.trip_store.delete_carpool(agency_id, carpool_id)
+
+    async def _unflag_unrecent_updates(self):
+        self.trip_store.unflag_unrecent_updates()
+
+    async def _join(self):
+        await self._queue.join()
+        await self._enhanced.join()
+
+    def _is_current(self, id, generation):
+        return self._generations.get(id) == generation
+
+    def _done(self, id, generation):
+        if self._is_current(id, generation):
+            del self._generations[id]
+
+    async def _enhance(self):
+        while True:
+            id, generation, carpool = await self._queue.get()
+            try:
+                if self._is_current(id, generation):
+                    enhanced_carpool = await self.trip_store.enhance_carpool_async(carpool)
+                    if enhanced_carpool is not None:
+                        await self._enhanced.put((id, generation, enhanced_carpool))
+                    else:
+                        self._done(id, generation)
+            except Exception:
+                logger.exception("Enhancement of carpool %s failed", id)
+                self._done(id, generation)
+            finally:
+                self._queue.task_done()
+
+    async def _add_enhanced(self):
+        while True:
+            batch = [await self._enhanced.get()]
+            while len(batch) < self.batch_size and not self._enhanced.empty():
+                batch.append(self._enhanced.get_nowait())
+            try:
+                enhanced_carpools = []
+                for id, generation, enhanced_carpool in batch:
+                    if self._is_current(id, generation):
+                        enhanced_carpools.append(enhanced_carpool)
+                        self._done(id, generation)
+                self.trip_store.put_enhanced_carpools(enhanced_carpools)
+                logger.debug("Added batch of %s enhanced carpools", len(enhanced_carpools))
+            except Exception:
+                logger.exception("Adding batch of enhanced carpools failed")
+            finally:
+                for _ in batch:
+                    self._enhanced.task_done()
@@ -0,0 +1,209 @@
+from collections import OrderedDict
+import gzip
+import hashlib
+import logging
+import os
+
+from fastapi import Request
+from fastapi.responses import FileResponse, Response
+from starlette.datastructures import Headers
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+
+logger = logging.getLogger(__name__)
+
+
+class CachedFile:
+    """
+    In-memory copy of a published file, with its ETag and lazily
+    created gzip variant.
+
+    Attributes:
+        signature   (inode, size, mtime) of the file this content was read from
+        content     the file's content
+    """
+    # Upper bound of values derived from the content for client supplied
+    # keys (e.g. differential feeds), which are kept per file version
+    MAX_DERIVED = 64
+
+    def __init__(self, signature, content: bytes):
+        self.signature = signature
+        self.content = content
+        self.etag = f'"{hashlib.sha1(content).hexdigest()}"'
+        self.gzip_etag = self.etag[:-1] + '-gzip"'
+        self._gzipped = None
+        self._derived = {}
+        self._bounded_derived = OrderedDict()
+
+    @property
+    def gzipped(self) -> bytes:
+        if self._gzipped is None:
+            self._gzipped = gzip.compress(self.content, mtime=0)
+        return self._gzipped
+
+    def derive(self, key, func):
+        """
+        Returns func(content), which is computed only once per key
+        for this version of the file.
+        """
+        if key not in self._derived:
+            self._derived[key] = func(self.content)
+        return self._derived[key]
+
+    def derive_bounded(self, key, func):
+        """
+        Like derive, but only the MAX_DERIVED most recently used values
+        are kept. To be used for keys depending on client input.
+        """
+        if key in self._bounded_derived:
+            self._bounded_derived.move_to_end(key)
+        else:
+            self._bounded_derived[key] = func(self.content)
+            if len(self._bounded_derived) > self.MAX_DERIVED:
+                self._bounded_derived.popitem(last=False)
+        return self._bounded_derived[key]
+
+
+class FeedCache:
+    """
+    FeedCache keeps the latest published version of feed files in memory.
+    A file is only read again, when the enhancer published a new version,
+    i.e. replaced the file, which is detected via its inode, size and
+    modification time.
+    """
+
+    def __init__(self):
+        self._files = {}
+
+    def get(self, filename: str) -> CachedFile | None:
+        """
+        Returns the current content of filename, or None, if it does not exist (yet).
+        """
+        try:
+            stat = os.stat(filename)
+        except FileNotFoundError:
+            return None
+        signature = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        cached = self._files.get(filename)
+        if cached is None or cached.signature != signature:
+            logger.debug("Reload %s", filename)
+            with open(filename, 'rb') as f:
+                cached = CachedFile(signature, f.read())
+            self._files[filename] = cached
+        return cached
+
+
+class FileDigests:
+    """
+    FileDigests records the content hash of published files, which serves
+    as their strong ETag. It is computed once per published version of a
+    file, i.e. again only after the enhancer replaced it, which is
+    detected via its inode, size and modification time.
+    """
+
+    def __init__(self):
+        self._digests = {}
+
+    def get(self, filename: str) -> tuple[os.stat_result, str] | None:
+        """
+        Returns the stat result of filename and the ETag of its content,
+        or None, if it does not exist (yet).
+        """
+        try:
+            stat = os.stat(filename)
+        except FileNotFoundError:
+            return None
+        signature = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        cached = self._digests.get(filename)
+        if cached is None or cached[1] != signature:
+            logger.debug("Hash %s", filename)
+            digest = hashlib.sha256()
+            with open(filename, 'rb') as f:
+                # the file may have been replaced since os.stat
+                stat = os.fstat(f.fileno())
+                signature = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+                while chunk := f.read(1 << 20):
+                    digest.update(chunk)
+            cached = (stat, signature, f'"{digest.hexdigest()}"')
+            self._digests[filename] = cached
+        return cached[0], cached[2]
+
+
+class DigestStaticFiles(StaticFiles):
+    """
+    StaticFiles, which use the content hash of a file as ETag instead of
+    its modification time and size, so an unchanged, but republished file
+    is not downloaded again.
+    """
+
+    def __init__(self, *args, digests: FileDigests, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.digests = digests
+
+    def file_response(self, full_path, stat_result, scope, status_code = 200) -> Response:
+        digest = self.digests.get(full_path)
+        if digest is None:
+            return super().file_response(full_path, stat_result, scope, status_code)
+        stat_result, etag = digest
+        response = FileResponse(full_path, status_code=status_code, stat_result=stat_result, headers={'ETag': etag})
+        if _etag_matches(Headers(scope=scope).get('if-none-match'), [etag]):
+            return NotModifiedResponse(response.headers)
+        return response
+
+
+def _accepts_gzip(accept_encoding: str | None) -> bool:
+    """
+    Returns whether accept_encoding accepts gzip, i.e. lists gzip (or, if
+    gzip is not listed, *) with a q-value greater than 0.
+    """
+    qvalues = {}
+    for coding in (accept_encoding or '').split(','):
+        name, *params = [part.strip() for part in coding.split(';')]
+        qvalue = 1.0
+        for param in params:
+            if param.lower().startswith('q='):
+                try:
+                    qvalue = float(param[2:])
+                except ValueError:
+                    qvalue = 0.0
+        qvalues[name.lower()] = qvalue
+    return qvalues.get('gzip', qvalues.get('*', 0.0)) > 0
+
+
+def _etag_matches(if_none_match: str | None, etags) -> bool:
+    if if_none_match is None:
+        return False
+    client_etags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+    return '*' in client_etags or any(etag in client_etags for etag in etags)
+
+
+def digest_file_response(request: Request, digests: FileDigests, filename: str, media_type: str | None = None) -> Response | None:
+    """
+    Returns filename as response with its content hash as ETag and
+    support for Range requests, or 304 Not Modified, if the client
+    already has this version, or None, if the file does not exist (yet).
+    """
+    digest = digests.get(filename)
+    if digest is None:
+        return None
+    stat_result, etag = digest
+    if _etag_matches(request.headers.get('if-none-match'), [etag]):
+        return Response(status_code=304, headers={'ETag': etag})
+    return FileResponse(filename, media_type=media_type, stat_result=stat_result, headers={'ETag': etag})
+
+
+def cached_file_response(request: Request, cached: CachedFile, media_type: str) -> Response:
+    """
+    Returns cached as response, gzipped if the client accepts it, or
+    304 Not Modified, if the client already has this version.
+    """
+    use_gzip = _accepts_gzip(request.headers.get('accept-encoding'))
+    etag = cached.gzip_etag if use_gzip else cached.etag
+    headers = {'ETag': etag, 'Vary': 'Accept-Encoding'}
+
+    if _etag_matches(request.headers.get('if-none-match'), [cached.etag, cached.gzip_etag]):
+        return Response(status_code=304, headers=headers)
+
+    if use_gzip:
+        headers['Content-Encoding'] = 'gzip'
+        return Response(cached.gzipped, media_type=media_type, headers=headers)
+    return Response(cached.content, media_type=media_type, headers=headers)
@@ -2,33 +2,308 @@ import amarillo.services.gtfsrt.gtfs_realtime_pb2 as gtfs_realtime_pb2
 import amarillo.services.gtfsrt.realtime_extension_pb2 as mfdzrte
 from amarillo.services.gtfs_constants import *
 from google.protobuf.json_format import MessageToDict
-from google.protobuf.json_format import ParseDict
-from datetime import datetime, timedelta
+from amarillo.utils.utils import write_atomically
+from datetime import datetime
+import bisect
 import json
-import re
-import time
+import math
+import numpy as np
+import os
 
 import logging
 
 logger = logging.getLogger(__name__)
 
+class FeedVersions():
+	"""
+	Tracks for one feed the version in which each entity was last changed
+	and in which entities were removed. Versions increase monotonically and
+	are published as the feed header's timestamp, so consumers can pass the
+	timestamp of their last fetch as since cursor.
+	"""
+	# Removals older than this are forgotten. Consumers with an older cursor
+	# receive the full dataset again.
+	HISTORY_IN_S = 24 * 3600
+
+	def __init__(self):
+		self.version = 0
+		self.history_start = None
+		# entity_id -> (version, entity)
+		self.entities = {}
+		# entity_id -> version in which the entity was removed
+		self.deleted = {}
+
+	def update(self, time, entities):
+		"""
+		Registers entities as the feed's current content and returns
+		the new feed version.
+		"""
+		version = max(int(time), self.version + 1)
+		current = {}
+		for entity in entities:
+			previous = self.entities.get(entity.id)
+			if previous is not None and (previous[1] is entity or previous[1] == entity):
+				current[entity.id] = (previous[0], entity)
+			else:
+				current[entity.id] = (version, entity)
+				self.deleted.pop(entity.id, None)
+		for entity_id in self.entities.keys() - current.keys():
+			self.deleted[entity_id] = version
+		self.entities = current
+		self.version = version
+
+		if self.history_start is None:
+			self.history_start = version
+		history_start = version - self.HISTORY_IN_S
+		if self.history_start < history_start:
+			self.deleted = {entity_id: v for entity_id, v in self.deleted.items() if v >= history_start}
+			self.history_start = history_start
+		return version
+
+	def preview(self, entities):
+		"""
+		Returns the as_dict() of these versions as if entities were the
+		feed's content, without registering them. Entities changed or removed
+		since the current version get the next version, so they are part of
+		every differential feed until the next version is registered.
+		"""
+		pending = self.version + 1
+		entity_versions = {}
+		for entity in entities:
+			previous = self.entities.get(entity.id)
+			if previous is not None and (previous[1] is entity or previous[1] == entity):
+				entity_versions[entity.id] = previous[0]
+			else:
+				entity_versions[entity.id] = pending
+		deleted = dict(self.deleted)
+		for entity_id in self.entities.keys() - entity_versions.keys():
+			deleted[entity_id] = pending
+		return {
+			'version': self.version,
+			'history_start': self.history_start,
+			'entities': entity_versions,
+			'deleted': deleted
+		}
+
+	def as_dict(self):
+		return {
+			'version': self.version,
+			'history_start': self.history_start,
+			'entities': {entity_id: v for entity_id, (v, _) in self.entities.items()},
+			'deleted': dict(self.deleted)
+		}
+
+
+def differential_feed(feed, versions, since):
+	"""
+	Returns a DIFFERENTIAL FeedMessage containing the entities of feed
+	which changed after version since, and deletions of entities removed
+	after since. versions is the FeedVersions.as_dict() of feed.
+
+	Returns None, if versions don't describe this feed or since precedes
+	their history, in which case consumers need the full dataset.
+	"""
+	if versions.get('version') != feed.header.timestamp or since < versions['history_start']:
+		return None
+	diff = gtfs_realtime_pb2.FeedMessage()
+	diff.header.CopyFrom(feed.header)
+	diff.header.incrementality = gtfs_realtime_pb2.FeedHeader.DIFFERENTIAL
+	entity_versions = versions['entities']
+	diff.entity.extend(entity for entity in feed.entity if entity_versions.get(entity.id, since + 1) > since)
+	for entity_id, version in versions['deleted'].items():
+		if version > since:
+			diff.entity.add(id=entity_id, is_deleted=True)
+	return diff
+
+
+_INCREMENTALITY_NAMES = dict((v, k) for k, v in gtfs_realtime_pb2.FeedHeader.Incrementality.items())
+_TRIP_SCHEDULE_RELATIONSHIP_NAMES = dict((v, k) for k, v in gtfs_realtime_pb2.TripDescriptor.ScheduleRelationship.items())
+_STOP_SCHEDULE_RELATIONSHIP_NAMES = dict((v, k) for k, v in gtfs_realtime_pb2.TripUpdate.StopTimeUpdate.ScheduleRelationship.items())
+_PICKUP_DROPOFF_TYPE_NAMES = dict((v, k) for k, v in mfdzrte.MfdzStopTimePropertiesExtension.DropOffPickupType.items())
+
+
+def feed_to_json(feed):
+	"""
+	Encodes feed as JSON, equivalent to json.dumps(MessageToDict(feed)).
+	Instead of walking the message via protobuf reflection, it directly
+	reads the fields GtfsRtProducer sets, i.e. other fields (vehicle
+	positions, alerts, ...) are not encoded.
+	"""
+	header = feed.header
+	header_dict = {'gtfsRealtimeVersion': header.gtfs_realtime_version}
+	if header.HasField('incrementality'):
+		header_dict['incrementality'] = _INCREMENTALITY_NAMES[header.incrementality]
+	if header.HasField('timestamp'):
+		header_dict['timestamp'] = str(header.timestamp)
+	feed_dict = {'header': header_dict}
+	if len(feed.entity) > 0:
+		feed_dict['entity'] = [_entity_to_dict(entity) for entity in feed.entity]
+	return json.dumps(feed_dict, separators=(',', ':')).encode('utf-8')
+
+def _entity_to_dict(entity):
+	entity_dict = {'id': entity.id}
+	if entity.HasField('is_deleted'):
+		entity_dict['isDeleted'] = entity.is_deleted
+	if entity.HasField('trip_update'):
+		trip_update = entity.trip_update
+		trip_update_dict = {'trip': _trip_descriptor_to_dict(trip_update.trip)}
+		if len(trip_update.stop_time_update) > 0:
+			trip_update_dict['stopTimeUpdate'] = [_stop_time_update_to_dict(u) for u in trip_update.stop_time_update]
+		entity_dict['tripUpdate'] = trip_update_dict
+	return entity_dict
+
+def _trip_descriptor_to_dict(trip):
+	trip_dict = {}
+	if trip.HasField('trip_id'):
+		trip_dict['tripId'] = trip.trip_id
+	if trip.HasField('start_time'):
+		trip_dict['startTime'] = trip.start_time
+	if trip.HasField('start_date'):
+		trip_dict['startDate'] = trip.start_date
+	if trip.HasField('schedule_relationship'):
+		trip_dict['scheduleRelationship'] = _TRIP_SCHEDULE_RELATIONSHIP_NAMES[trip.schedule_relationship]
+	if trip.HasField('route_id'):
+		trip_dict['routeId'] = trip.route_id
+	if trip.HasExtension(mfdzrte.trip_descriptor):
+		extension = trip.Extensions[mfdzrte.trip_descriptor]
+		extension_dict = {}
+		if extension.HasField('route_url'):
+			extension_dict['routeUrl'] = extension.route_url
+		if extension.HasField('agency_id'):
+			extension_dict['agencyId'] = extension.agency_id
+		if extension.HasField('route_long_name'):
+			extension_dict['routeLongName'] = extension.route_long_name
+		if extension.HasField('route_type'):
+			extension_dict['routeType'] = extension.route_type
+		trip_dict['[transit_realtime.trip_descriptor]'] = extension_dict
+	return trip_dict
+
+def _stop_time_event_to_dict(event):
+	event_dict = {}
+	if event.HasField('delay'):
+		event_dict['delay'] = event.delay
+	if event.HasField('time'):
+		event_dict['time'] = str(event.time)
+	if event.HasField('uncertainty'):
+		event_dict['uncertainty'] = event.uncertainty
+	return event_dict
+
+def _stop_time_update_to_dict(update):
+	update_dict = {}
+	if update.HasField('stop_sequence'):
+		update_dict['stopSequence'] = update.stop_sequence
+	if update.HasField('arrival'):
+		update_dict['arrival'] = _stop_time_event_to_dict(update.arrival)
+	if update.HasField('departure'):
+		update_dict['departure'] = _stop_time_event_to_dict(update.departure)
+	if update.HasField('stop_id'):
+		update_dict['stopId'] = update.stop_id
+	if update.HasField('schedule_relationship'):
+		update_dict['scheduleRelationship'] = _STOP_SCHEDULE_RELATIONSHIP_NAMES[update.schedule_relationship]
+	if update.HasField('stop_time_properties'):
+		properties = update.stop_time_properties
+		properties_dict = {}
+		if properties.HasExtension(mfdzrte.stop_time_properties):
+			extension = properties.Extensions[mfdzrte.stop_time_properties]
+			extension_dict = {}
+			if extension.HasField('pickup_type'):
+				extension_dict['pickupType'] = _PICKUP_DROPOFF_TYPE_NAMES[extension.pickup_type]
+			if extension.HasField('dropoff_type'):
+				extension_dict['dropoffType'] = _PICKUP_DROPOFF_TYPE_NAMES[extension.dropoff_type]
+			properties_dict['[transit_realtime.stop_time_properties]'] = extension_dict
+		update_dict['stopTimeProperties'] = properties_dict
+	return update_dict
+
+
+class DepartureIndex():
+	"""
+	Trip ids sorted by the trips' next departure (as epoch), so the trips
+	departing before some instant can be looked up without touching all trips.
+	"""
+
+	def __init__(self):
+		# sorted (departure, trip_id) tuples
+		self._departures = []
+		self._departure_of = {}
+
+	def update(self, trip_id, departure):
+		"""
+		Sets the next departure of trip_id. If departure is None, the trip is removed.
+		"""
+		previous = self._departure_of.pop(trip_id, None)
+		if previous is not None:
+			del self._departures[bisect.bisect_left(self._departures, (previous, trip_id))]
+		if departure is not None:
+			self._departure_of[trip_id] = departure
+			bisect.insort(self._departures, (departure, trip_id))
+
+	def trip_ids_departing_before(self, epoch):
+		end = bisect.bisect_left(self._departures, (epoch,))
+		return [trip_id for _, trip_id in self._departures[:end]]
+
+
 class GtfsRtProducer():
+	"""
+	Produces GTFS-RT feeds of the recently added/deleted trips of the
+	trip store.
+
+	If a horizon is configured (globally via horizon_in_hours or for a
+	region via its gtfsrt_horizon_in_hours), feeds only contain the trip
+	instances departing before the feed's time plus this horizon,
+	otherwise those of the next 14 days.
+	"""
+	MAX_DAY_COUNT = 14
 
-	def __init__(self, trip_store):
+	def __init__(self, trip_store, horizon_in_hours=None):
 		self.trip_store = trip_store
+		self.horizon_in_hours = horizon_in_hours
+		regions = trip_store.region_service.regions if trip_store.region_service else {}
+		self._region_horizons = {region_id: region.gtfsrt_horizon_in_hours for region_id, region in regions.items()}
+		# Horizons of the feed of all trips and of the region feeds, which
+		# fall back to the global horizon
+		horizons = [horizon_in_hours, *(horizon or horizon_in_hours for horizon in self._region_horizons.values())]
+		# Service days covered by the longest horizon, starting today
+		self._day_count = self.MAX_DAY_COUNT if None in horizons else \
+			min(self.MAX_DAY_COUNT, 1 + math.ceil(max(horizons) / 24))
+		# Cache of built FeedEntities, their serialization and their
+		# departure per (trip_id, schedule_relationship), valid for the
+		# service day they were built for. Entities of trips in several
+		# regions are built and serialized only once for all region feeds.
+		self._entities_cache = {}
+		self._cache_date = None
+		# Recently added/deleted trips by next departure, and the ids of
+		# trips changed since the index was last updated
+		self._departure_index = DepartureIndex()
+		self._departure_index_updates = set()
+		# region_id or bbox -> FeedVersions
+		self._feed_versions = {}
+		trip_store.change_listeners.append(self.invalidate_trip)
 
-	def generate_feed(self, time, format='protobuf', bbox=None):
-		# See https://developers.google.com/transit/gtfs-realtime/reference
-		# https://github.com/mfdz/carpool-gtfs-rt/blob/master/src/main/java/de/mfdz/resource/CarpoolResource.java
-		gtfsrt_dict = {
-			'header': {
-				'gtfsRealtimeVersion': '1.0', 
-				'timestamp': int(time)
-			}, 
-			'entity': self._get_trip_updates(bbox)
-		}
-		feed = gtfs_realtime_pb2.FeedMessage()
-		ParseDict(gtfsrt_dict, feed)
+	def invalidate_trip(self, trip_id):
+		"""
+		Drops the cached entities of the given trip, so they will be
+		rebuilt on next feed generation.
+		"""
+		self._entities_cache.pop((trip_id, gtfs_realtime_pb2.TripDescriptor.ADDED), None)
+		self._entities_cache.pop((trip_id, gtfs_realtime_pb2.TripDescriptor.CANCELED), None)
+		self._departure_index_updates.add(trip_id)
+
+	def generate_feed(self, time, format='protobuf', bbox=None, region_id=None, since=None):
+		"""
+		Generates the feed for all recently added/deleted trips. If region_id
+		is given, trips are taken from the trip store's region index,
+		otherwise, if bbox is given, only trips intersecting bbox are included.
+
+		If since is given, a DIFFERENTIAL feed with the changes after
+		feed version since is returned, if these are still known.
+
+		The feed is stamped with the current feed version, which only
+		export_feed advances, so generating feeds on demand does not move
+		the consumers' since cursors.
+		"""
+		feed, versions = self._build_feed(time, bbox, region_id)
+		if since is not None:
+			feed = differential_feed(feed, versions, since) or feed
 
 		if "message" == format.lower():
 			return feed
@@ -37,109 +312,236 @@ class GtfsRtProducer():
 		else:
 			return feed.SerializeToString()
 
-	def export_feed(self, timestamp, file_path, bbox=None):
+	def export_feed(self, timestamp, file_path, bbox=None, region_id=None, spatial_index=False):
 		"""
-		Exports gtfs-rt feed as .json and .pbf file to file_path
+		Exports gtfs-rt feed as .pbf file to file_path, accompanied by
+		the entity versions as .versions.json, which are required to
+		serve differential updates. The JSON variant is not exported,
+		but created on request via feed_to_json.
+
+		If spatial_index is True, the bounds and agency of every entity's
+		trip are exported as .index.json, which allows to serve feeds for
+		arbitrary bboxes from this feed.
 		""" 
-		feed = self.generate_feed(timestamp, "message", bbox)
-		with open(f"{file_path}.pbf", "wb") as f:
-			f.write(feed.SerializeToString())
-		with open(f"{file_path}.json", "w") as f:
-			json.dump(MessageToDict(feed), f)
-
-	def _get_trip_updates(self, bbox = None):
-		trips = []
-		trips.extend(self._get_added(bbox))
-		trips.extend(self._get_deleted(bbox))
-		trip_updates = []
-		for num, trip in enumerate(trips):
-   			trip_updates.append( {
-   				'id': f'carpool-update-{num}', 
-  				'tripUpdate': trip
-  				}
-  			)
-		return trip_updates
+		header, trip_entities = self._build_feed_content(timestamp, bbox, region_id)
+		versions = self._versions_for(bbox, region_id)
+		if spatial_index:
+			# written before the feed, so a new feed is never accompanied by an outdated index
+			index = {
+				'version': header.timestamp,
+				'bounds': [[round(c, 6) for c in trip.bbox.bounds] for trip, _, _ in trip_entities],
+				'agencies': [trip.agency for trip, _, _ in trip_entities]
+			}
+			write_atomically(f"{file_path}.index.json", json.dumps(index).encode('utf-8'))
+		# A serialized FeedMessage is the concatenation of its serialized fields,
+		# so the feed is assembled from the entities serialized once per change
+		feed_bytes = gtfs_realtime_pb2.FeedMessage(header=header).SerializeToString()
+		write_atomically(f"{file_path}.pbf", b''.join([feed_bytes, *(blob for _, _, blob in trip_entities)]))
+		write_atomically(f"{file_path}.versions.json", json.dumps(versions.as_dict()).encode('utf-8'))
+		if os.path.exists(f"{file_path}.json"):
+			# exported by previous versions, would otherwise be served outdated via /gtfs
+			os.remove(f"{file_path}.json")
+
+	def _build_feed(self, time, bbox = None, region_id = None):
+		"""
+		Returns the full feed, stamped with the current feed version (or
+		time, if none was exported yet) without advancing it, and the
+		versions of its entities as returned by FeedVersions.preview.
+		"""
+		entities = [entity for _, entity, _ in self._get_trip_entities(bbox, region_id, time)]
+		versions = self._versions_for(bbox, region_id).preview(entities)
+		feed = gtfs_realtime_pb2.FeedMessage()
+		feed.header.gtfs_realtime_version = '1.0'
+		feed.header.timestamp = versions['version'] or int(time)
+		feed.entity.extend(entities)
+		return feed, versions
+
+	def _build_feed_content(self, time, bbox = None, region_id = None):
+		"""
+		Returns the feed header for a new feed version and the
+		(trip, entity, serialized entity) tuples of its entities.
+		"""
+		# See https://developers.google.com/transit/gtfs-realtime/reference
+		# https://github.com/mfdz/carpool-gtfs-rt/blob/master/src/main/java/de/mfdz/resource/CarpoolResource.java
+		trip_entities = self._get_trip_entities(bbox, region_id, time)
+		header = gtfs_realtime_pb2.FeedHeader()
+		header.gtfs_realtime_version = '1.0'
+		header.timestamp = self._versions_for(bbox, region_id).update(time, [entity for _, entity, _ in trip_entities])
+		return header, trip_entities
+
+	def _versions_for(self, bbox = None, region_id = None):
+		key = region_id or (tuple(bbox) if bbox else None)
+		versions = self._feed_versions.get(key)
+		if versions is None:
+			versions = FeedVersions()
+			self._feed_versions[key] = versions
+		return versions
+
+	def _get_entities(self, bbox = None, region_id = None):
+		return [entity for _, entity, _ in self._get_trip_entities(bbox, region_id)]
+
+	def _get_trip_entities(self, bbox = None, region_id = None, time = None):
+		today = datetime.today()
+		if self._cache_date != today.date():
+			# service days depend on the current day, so cached entities expire at midnight
+			self._entities_cache.clear()
+			self._departure_index = DepartureIndex()
+			self._departure_index_updates.update(self.trip_store.recent_trips.keys(), self.trip_store.deleted_trips.keys())
+			self._cache_date = today.date()
+
+		horizon = self._region_horizons.get(region_id) or self.horizon_in_hours
+		until = time + horizon * 3600 if horizon is not None and time is not None else None
+		trip_entities = []
+		trip_entities.extend(self._get_added(bbox, region_id, today, until))
+		trip_entities.extend(self._get_deleted(bbox, region_id, today, until))
+		return trip_entities
 
-	def _get_deleted(self, bbox = None):
+	def _get_deleted(self, bbox, region_id, today, until):
+		if until is None:
+			trips = self.trip_store.recently_deleted_trips(region_id)
+		else:
+			trips = self._trips_departing_before(until, self.trip_store.deleted_trips, region_id, today)
 		return self._get_updates(
-			self.trip_store.recently_deleted_trips(),
+			trips,
 			self._as_delete_updates,
-			bbox)
+			gtfs_realtime_pb2.TripDescriptor.CANCELED,
+			None if region_id else bbox,
+			today,
+			until)
 
-	def _get_added(self, bbox = None):
+	def _get_added(self, bbox, region_id, today, until):
+		if until is None:
+			trips = self.trip_store.recently_added_trips(region_id)
+		else:
+			trips = self._trips_departing_before(until, self.trip_store.recent_trips, region_id, today)
 		return self._get_updates(
-			self.trip_store.recently_added_trips(),
+			trips,
 			self._as_added_updates,
-			bbox)
-	
-	def _get_updates(self, trips, update_func, bbox = None):
+			gtfs_realtime_pb2.TripDescriptor.ADDED,
+			None if region_id else bbox,
+			today,
+			until)
+
+	def _trips_departing_before(self, until, trips, region_id, fromdate):
+		"""
+		Returns those of trips (recently added or deleted trips by id)
+		which depart before until and, if region_id is given, intersect
+		this region. Only trips departing before until are touched.
+		"""
+		self._update_departure_index(fromdate)
+		return [trip for trip in (trips.get(trip_id) for trip_id in self._departure_index.trip_ids_departing_before(until))
+			if trip is not None and (region_id is None or region_id in trip.region_ids)]
+
+	def _update_departure_index(self, fromdate):
+		# popped one by one, as trips may concurrently be invalidated
+		while self._departure_index_updates:
+			trip_id = self._departure_index_updates.pop()
+			trip = self.trip_store.recent_trips.get(trip_id) or self.trip_store.deleted_trips.get(trip_id)
+			departures = self._departures(trip, fromdate) if trip is not None else []
+			self._departure_index.update(trip_id, departures[0] if len(departures) > 0 else None)
+
+	def _departures(self, trip, fromdate):
+		"""
+		Returns the departure epochs of the trip's instances in service day order.
+		"""
+		_, day_epochs = self._service_days(fromdate).service_days_of(trip)
+		first_departure = trip.departure_seconds[0] if len(trip.departure_seconds) > 0 else 0
+		return (day_epochs + first_departure).tolist()
+
+	def _get_updates(self, trips, update_func, schedule_relationship, bbox, fromdate, until = None):
 		updates = []
-		today = datetime.today()
 		for t in trips:
 			if bbox == None or t.intersects(bbox):
-				updates.extend(update_func(t, today))
+				updates.extend((t, entity, blob) for entity, blob, departure
+					in self._cached_entities(t, update_func, schedule_relationship, fromdate)
+					if until is None or departure < until)
 		return updates
 
+	def _cached_entities(self, trip, update_func, schedule_relationship, fromdate):
+		key = (trip.trip_id, schedule_relationship)
+		cached = self._entities_cache.get(key)
+		# A changed trip is always a new Trip instance, so comparing identity
+		# protects against entries built concurrently to an invalidation
+		if cached is None or cached[0] is not trip:
+			entities = [self._as_entity(trip_update) for trip_update in update_func(trip, fromdate)]
+			departures = self._departures(trip, fromdate)
+			cached = (trip, [(entity, self._serialize_entity(entity), departure) for entity, departure in zip(entities, departures)])
+			self._entities_cache[key] = cached
+		return cached[1]
+
+	def _serialize_entity(self, entity):
+		# Serialized as FeedMessage.entity field, i.e. including tag and length,
+		# so feeds can be assembled by concatenation. The message lacks its
+		# required header, hence the partial serialization.
+		message = gtfs_realtime_pb2.FeedMessage()
+		message.entity.append(entity)
+		return message.SerializePartialToString()
+
+	def _as_entity(self, trip_update):
+		# trip_id and start_date identify a trip instance, so the entity id
+		# stays stable across feed versions
+		return gtfs_realtime_pb2.FeedEntity(
+			id=f'{trip_update.trip.trip_id}:{trip_update.trip.start_date}',
+			trip_update=trip_update)
+
+	def _service_days(self, fromdate):
+		day = fromdate.date() if isinstance(fromdate, datetime) else fromdate
+		# computed by the trip store once per day for all trips
+		return self.trip_store.active_days(day, self._day_count)
+
 	def _as_delete_updates(self, trip, fromdate):
-		return [{ 
-		    'trip': {
-		      'tripId': trip.trip_id, 
-		      'startTime': trip.start_time_str(),
-		      'startDate': trip_date, 
-		      'scheduleRelationship': 'CANCELED', 
-		      'routeId': trip.trip_id
-		    }
-		} for trip_date in trip.next_trip_dates(fromdate)]
-
-	def _to_seconds(self, fromdate, stop_time):
-		startdate = datetime.strptime(fromdate, '%Y%m%d')
-		m = re.search(r'(\d+):(\d+):(\d+)', stop_time)
-		delta = timedelta(
-			hours=int(m.group(1)),
-			minutes=int(m.group(2)),
-			seconds=int(m.group(3)))
-		return time.mktime((startdate + delta).timetuple())
+		trip_updates = []
+		trip_dates, _ = self._service_days(fromdate).service_days_of(trip)
+		for trip_date in trip_dates:
+			trip_update = gtfs_realtime_pb2.TripUpdate()
+			self._set_trip_descriptor(trip_update.trip, trip, trip_date, gtfs_realtime_pb2.TripDescriptor.CANCELED)
+			trip_updates.append(trip_update)
+		return trip_updates
+
+	def _set_trip_descriptor(self, descriptor, trip, trip_date, schedule_relationship):
+		descriptor.trip_id = trip.trip_id
+		descriptor.start_time = trip.start_time_str()
+		descriptor.start_date = trip_date
+		descriptor.schedule_relationship = schedule_relationship
+		descriptor.route_id = trip.trip_id
+
+	def _to_pickup_dropoff_type(self, stop_type):
+		if stop_type == STOP_TIMES_STOP_TYPE_COORDINATE_DRIVER:
+			return mfdzrte.MfdzStopTimePropertiesExtension.COORDINATE_WITH_DRIVER
+		return mfdzrte.MfdzStopTimePropertiesExtension.NONE
 	
-	def _to_stop_times(self, trip, fromdate):
-		return [{
-		      'stopSequence': stoptime.stop_sequence, 
-		      'arrival': {
-		        'time': self._to_seconds(fromdate, stoptime.arrival_time if stoptime.arrival_time is not None else stoptime.departure_time),
-		        'uncertainty': MFDZ_DEFAULT_UNCERTAINITY
-		      },
-		      'departure': {
-		        'time':  self._to_seconds(fromdate, stoptime.departure_time if stoptime.departure_time is not None else stoptime.arrival_time),
-		        'uncertainty': MFDZ_DEFAULT_UNCERTAINITY
-		      }, 
-		      'stopId': stoptime.stop_id, 
-		      'scheduleRelationship': 'SCHEDULED',
-		      'stop_time_properties': {
-		        '[transit_realtime.stop_time_properties]': {
-		          'dropoffType': 'COORDINATE_WITH_DRIVER' if stoptime.drop_off_type == STOP_TIMES_STOP_TYPE_COORDINATE_DRIVER else 'NONE',
-		          'pickupType': 'COORDINATE_WITH_DRIVER' if stoptime.pickup_type == STOP_TIMES_STOP_TYPE_COORDINATE_DRIVER else 'NONE'
-		        }
-		      }
-		    }
-			for stoptime in trip.stop_times]
+	def _append_stop_times(self, trip_update, trip, arrival_times, departure_times):
+		for stoptime, arrival_time, departure_time in zip(trip.stop_times, arrival_times, departure_times):
+			stop_time_update = trip_update.stop_time_update.add()
+			stop_time_update.stop_sequence = stoptime.stop_sequence
+			stop_time_update.arrival.time = arrival_time
+			stop_time_update.arrival.uncertainty = MFDZ_DEFAULT_UNCERTAINITY
+			stop_time_update.departure.time = departure_time
+			stop_time_update.departure.uncertainty = MFDZ_DEFAULT_UNCERTAINITY
+			stop_time_update.stop_id = stoptime.stop_id
+			stop_time_update.schedule_relationship = gtfs_realtime_pb2.TripUpdate.StopTimeUpdate.SCHEDULED
+			properties = stop_time_update.stop_time_properties.Extensions[mfdzrte.stop_time_properties]
+			properties.dropoff_type = self._to_pickup_dropoff_type(stoptime.drop_off_type)
+			properties.pickup_type = self._to_pickup_dropoff_type(stoptime.pickup_type)
 
 	def _as_added_updates(self, trip, fromdate):
 		try:
-			return [{ 
-			    'trip': {
-			      'tripId': trip.trip_id, 
-			      'startTime': trip.start_time_str(),
-			      'startDate': trip_date, 
-			      'scheduleRelationship': 'ADDED', 
-			      'routeId': trip.trip_id,
-			      '[transit_realtime.trip_descriptor]': { 
-						'routeUrl' : trip.url,
-					    'agencyId' : trip.agency,
-					    'route_long_name' : trip.route_long_name(),
-					    'route_type': RIDESHARING_ROUTE_TYPE
-				    	}
-			    },
-			    'stopTimeUpdate': self._to_stop_times(trip, trip_date)
-			} for trip_date in trip.next_trip_dates(fromdate)]
+			trip_updates = []
+			trip_dates, day_epochs = self._service_days(fromdate).service_days_of(trip)
+			# epochs of all stop times for all service days, one row per day
+			arrivals = (day_epochs[:, np.newaxis] + trip.arrival_seconds).tolist()
+			departures = (day_epochs[:, np.newaxis] + trip.departure_seconds).tolist()
+			for trip_date, arrival_times, departure_times in zip(trip_dates, arrivals, departures):
+				trip_update = gtfs_realtime_pb2.TripUpdate()
+				self._set_trip_descriptor(trip_update.trip, trip, trip_date, gtfs_realtime_pb2.TripDescriptor.ADDED)
+				extension = trip_update.trip.Extensions[mfdzrte.trip_descriptor]
+				extension.route_url = trip.url
+				extension.agency_id = trip.agency
+				extension.route_long_name = trip.route_long_name()
+				extension.route_type = RIDESHARING_ROUTE_TYPE
+				self._append_stop_times(trip_update, trip, arrival_times, departure_times)
+				trip_updates.append(trip_update)
+			return trip_updates
 		except AttributeError:
 			logger.exception(f"Error adding updates for trip {trip.trip_id}")
 			return []
@@ -0,0 +1,77 @@
+import io
+
+from amarillo.models.gtfs import GtfsRoute, GtfsTrip, GtfsStopTime, GtfsCalendar, GtfsCalendarDate, GtfsShape, GtfsStop
+from amarillo.utils.utils import open_atomically
+
+try:
+    import pyarrow
+    import pyarrow.csv
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    # optional dependency, see requirements.columnar.txt
+    pyarrow = None
+
+# GTFS files additionally exported as columnar files
+COLUMNAR_FILES = {
+    'routes.txt': GtfsRoute._fields,
+    'trips.txt': GtfsTrip._fields,
+    'stop_times.txt': GtfsStopTime._fields,
+    'calendar.txt': GtfsCalendar._fields,
+    'calendar_dates.txt': GtfsCalendarDate._fields,
+    'shapes.txt': GtfsShape._fields,
+    'stops.txt': GtfsStop._fields,
+}
+
+# All other fields, i.e. ids, names, dates and times (which may exceed 24:00:00), are strings
+INTEGER_FIELDS = {'route_type', 'stop_sequence', 'pickup_type', 'drop_off_type', 'timepoint', 'bikes_allowed',
+    'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday', 'exception_type', 'shape_pt_sequence'}
+FLOAT_FIELDS = {'stop_lat', 'stop_lon', 'shape_pt_lat', 'shape_pt_lon'}
+
+# Rows per parquet row group. Readers skip row groups, whose statistics
+# do not match a filter, so smaller groups allow finer filtering
+PARQUET_ROW_GROUP_SIZE = 65536
+
+
+def columnar_filename(gtfszip_filename, filename: str, format: str) -> str:
+    """
+    Returns the name of the columnar file of filename, next to gtfszip_filename,
+    e.g. amarillo.bb.stop_times.parquet for amarillo.bb.gtfs.zip.
+    """
+    prefix = str(gtfszip_filename).removesuffix('.zip').removesuffix('.gtfs')
+    return f"{prefix}.{filename.removesuffix('.txt')}.{format}"
+
+
+def write_columnar(content: bytes, filename: str, target_filename: str, format: str):
+    """
+    Writes the csv content of the GTFS file filename as Parquet or
+    uncompressed, memory-mappable Arrow IPC file target_filename.
+    """
+    if pyarrow is None:
+        raise RuntimeError("Columnar GTFS export requires pyarrow, see requirements.columnar.txt")
+    schema = _schema(COLUMNAR_FILES[filename])
+    if content:
+        table = pyarrow.csv.read_csv(io.BytesIO(content),
+            convert_options=pyarrow.csv.ConvertOptions(column_types=schema, include_columns=schema.names))
+    else:
+        # no rows, not even a header
+        table = schema.empty_table()
+
+    with open_atomically(target_filename) as f:
+        if format == 'parquet':
+            pyarrow.parquet.write_table(table, f, row_group_size=PARQUET_ROW_GROUP_SIZE)
+        else:
+            with pyarrow.ipc.new_file(f, schema) as writer:
+                writer.write_table(table)
+
+
+def _schema(fields):
+    return pyarrow.schema([(field, _type(field)) for field in fields])
+
+
+def _type(field):
+    if field in INTEGER_FIELDS:
+        return pyarrow.int32()
+    if field in FLOAT_FIELDS:
+        return pyarrow.float64()
+    return pyarrow.string()
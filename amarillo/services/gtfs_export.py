@@ -1,106 +1,407 @@
 
 from collections.abc import Iterable
-from datetime import datetime, timedelta
-from zipfile import ZipFile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from operator import attrgetter
+import multiprocessing
+from zipfile import ZipInfo, ZIP_DEFLATED, ZIP_STORED
 import csv
 import gettext
+import hashlib
+import io
 import logging
+import pandas as pd
 import re
+import struct
+import zlib
 
-from amarillo.utils.utils import assert_folder_exists
+from amarillo.utils.utils import open_atomically
+from amarillo.services.stops import carpooling_stops_mask
+from amarillo.services.gtfs_fragments import CALENDAR_VALIDITY_IN_DAYS, calendar_start_of, create_calendar_of
+from amarillo.services.gtfs_columnar import COLUMNAR_FILES, columnar_filename, write_columnar
 from amarillo.models.gtfs import GtfsTimeDelta, GtfsFeedInfo, GtfsAgency, GtfsRoute, GtfsStop, GtfsStopTime, GtfsTrip, GtfsCalendar, GtfsCalendarDate, GtfsShape, format_calendar
-from amarillo.services.stops import is_carpooling_stop
 from amarillo.services.gtfs_constants import *
 
 
 logger = logging.getLogger(__name__)
 
+# Timestamp of all zip entries, so exports of the same content are identical
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+class GtfsStopCatalog:
+    """
+    GTFS stops of all stops of one version of a StopsStore. The stops are
+    converted vectorized, and the stops.txt rows of the stops to always
+    export are rendered once per bbox, so exports reuse them until the
+    stop sources are reloaded.
+    """
+
+    def __init__(self, stopstore):
+        self.version = stopstore.version
+        frames = [stopSet["stops"][['id', 'stop_name', 'x', 'y']] for stopSet in stopstore.stopsDataFrames]
+        stops = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['id', 'stop_name', 'x', 'y'])
+        # stops without id are numbered consecutively
+        has_id = stops['id'].map(bool).astype(bool)
+        tmp_ids = 'tmp-' + (~has_id).cumsum().astype(str)
+        self._stops = pd.DataFrame({
+            'stop_id': stops['id'].where(has_id, tmp_ids),
+            'stop_lat': stops['y'].astype(float),
+            'stop_lon': stops['x'].astype(float),
+            'stop_name': stops['stop_name'].where(stops['stop_name'].notna(), 'k.A.'),
+        })
+        self._records = list(self._stops.itertuples(index=False, name=None))
+        # for duplicate ids, the last stop wins
+        self._index = {stop_id: i for i, stop_id in enumerate(self._stops['stop_id'].tolist())}
+        # bbox -> (ids of stops to always export, their rendered stops.txt rows)
+        self._always_exported = {}
+
+    def get(self, stop_id, default = None):
+        i = self._index.get(stop_id)
+        return default if i is None else GtfsStop(*self._records[i])
+
+    def always_exported_stops(self, bbox = None):
+        """
+        Returns the ids and the rendered stops.txt rows (without header) of the
+        stops, which shall be exported to GTFS regardless, if they are part of a
+        trip or not. These are all stops within bbox or, if no bbox is given,
+        all carpooling stops.
+
+        This is necessary, as potential stops are required 
+        to be part of the GTFS to be referenced later on 
+        by dynamicly added trips.
+        """
+        key = tuple(bbox) if bbox else None
+        if key not in self._always_exported:
+            stops = self._stops
+            if bbox:
+                selected = stops[stops.stop_lon.between(bbox[0], bbox[2]) & stops.stop_lat.between(bbox[1], bbox[3])]
+            else:
+                selected = stops[carpooling_stops_mask(stops.stop_id, stops.stop_name)]
+            # a repeated stop id is exported once, at its first position, with the values of its last occurrence
+            stop_ids = selected.stop_id.drop_duplicates().tolist()
+            rows = selected.drop_duplicates('stop_id', keep='last').set_index('stop_id').reindex(stop_ids)
+            csv_rows = io.StringIO()
+            csv.writer(csv_rows).writerows(zip(stop_ids, rows.stop_lat.tolist(), rows.stop_lon.tolist(), rows.stop_name.tolist()))
+            self._always_exported[key] = (frozenset(stop_ids), csv_rows.getvalue())
+        return self._always_exported[key]
+
+
+class MultiRegionGtfsExport:
+    """
+    Exports the GTFS feeds of several regions. Trips are partitioned by
+    region in a single pass, the stops to export are taken from stop_catalog,
+    which is created, if not given or outdated. Afterwards the region feeds
+    are written in parallel by up to max_workers worker processes, or
+    serially, if the worker processes fail. If a GtfsFeedHistory is
+    given, every exported feed is recorded in it.
+    export_options are passed to each region's GtfsExport.
+    """
+
+    def __init__(self, agencies, feed_info, ridestore, stopstore, regions, max_workers = None, stop_catalog = None,
+            history = None, **export_options):
+        self.agencies = agencies
+        self.feed_info = feed_info
+        self.ridestore = ridestore
+        self.stopstore = stopstore
+        self.regions = list(regions)
+        self.max_workers = max_workers or multiprocessing.cpu_count()
+        self.stop_catalog = stop_catalog
+        self.history = history
+        self.export_options = export_options
+
+    def export(self, gtfszip_filename_template):
+        """
+        Exports the feed of every region as zip file gtfszip_filename_template,
+        formatted with the region_id.
+        """
+        if self.stop_catalog is None or self.stop_catalog.version != self.stopstore.version:
+            self.stop_catalog = GtfsStopCatalog(self.stopstore)
+        tasks = [(self.export_options, self.history, region, gtfszip_filename_template.format(region_id=region.id), *partition)
+            for region, partition in zip(self.regions, self._partition())]
+        if self.max_workers == 1 or len(tasks) <= 1:
+            for task in tasks:
+                self._run_export(self.agencies, self.feed_info, *task)
+            return
+
+        # Spawned instead of forked workers, as forking this multi-threaded process is unsafe
+        failed_tasks = []
+        try:
+            with ProcessPoolExecutor(min(self.max_workers, len(tasks)), multiprocessing.get_context('spawn')) as executor:
+                futures = [(task, executor.submit(self._run_export, self.agencies, self.feed_info, *task)) for task in tasks]
+                for task, future in futures:
+                    try:
+                        future.result()
+                    except BrokenProcessPool:
+                        failed_tasks.append(task)
+        except BrokenProcessPool:
+            # raised by submit, if the pool broke before all tasks were submitted
+            failed_tasks = tasks
+        if failed_tasks:
+            logger.error("GTFS export worker processes failed, exporting %s region(s) serially", len(failed_tasks))
+            for task in failed_tasks:
+                self._run_export(self.agencies, self.feed_info, *task)
+
+    @staticmethod
+    def _run_export(agencies, feed_info, export_options, history, region, gtfszip_filename, fragments, always_exported_stops, stored_stops):
+        try:
+            exporter = GtfsExport(agencies, feed_info, None, None, region.bbox, region.id, **export_options)
+            exporter.always_exported_stop_ids, exporter.always_exported_stops_csv = always_exported_stops
+            exporter.stored_stops = stored_stops
+            exporter._write_feed(gtfszip_filename, fragments)
+            if history is not None:
+                history.record(region.id, gtfszip_filename, exporter.feed_version)
+        except Exception:
+            logger.exception("Failed to export GTFS feed for region %s", region.id)
+
+    def _partition(self):
+        """
+        Returns for each region its trips, its always exported stops and
+        the stored stops its trips refer to.
+        """
+        region_ids = [region.id for region in self.regions]
+        trips_by_region = {region_id: [] for region_id in region_ids}
+        active_days = self.ridestore.active_days(datetime.today(), CALENDAR_VALIDITY_IN_DAYS + 1)
+        for trip in dict(self.ridestore.trips).values():
+            if not active_days.has_remaining_service(trip):
+                continue
+            if self.ridestore.region_service is not None:
+                trip_region_ids = trip.region_ids
+            else:
+                trip_region_ids = [region.id for region in self.regions if trip.intersects(region.bbox)]
+            for region_id in trip_region_ids:
+                if region_id in trips_by_region:
+                    trips_by_region[region_id].append(trip)
+
+        partitions = []
+        for region in self.regions:
+            always_exported_stops = self.stop_catalog.always_exported_stops(region.bbox)
+            fragments = [self.ridestore.gtfs_fragments(trip) for trip in trips_by_region[region.id]]
+            referenced_stops = {}
+            for trip_fragments in fragments:
+                for stop_id, _ in trip_fragments.stops:
+                    if stop_id not in always_exported_stops[0]:
+                        stop = self.stop_catalog.get(stop_id)
+                        if stop is not None:
+                            referenced_stops[stop_id] = stop
+            partitions.append((fragments, always_exported_stops, referenced_stops))
+        return partitions
+
+
+class CompressedZipWriter:
+    """
+    Writes a zip file of already compressed entries to a binary file. The
+    entries are compressed beforehand in parallel, which ZipFile does not
+    support, so the local headers, central directory and end record are
+    written here. Sizes, offsets and entry counts beyond the limits of
+    the zip format are written as zip64 extra fields and end records.
+    """
+
+    # made by Unix (external_attr holds the file mode), zip spec version 2.0
+    VERSION_MADE_BY = 3 << 8 | 20
+    VERSION_NEEDED = {ZIP_STORED: 10, ZIP_DEFLATED: 20}
+    ZIP64_VERSION = 45
+    ZIP64_LIMIT = 0xFFFFFFFF
+    ZIP_FILECOUNT_LIMIT = 0xFFFF
+    LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+    CENTRAL_HEADER = struct.Struct('<4s6H3L5H2L')
+    END_RECORD = struct.Struct('<4s4H2LH')
+    ZIP64_END_RECORD = struct.Struct('<4sQ2H2L4Q')
+    ZIP64_END_LOCATOR = struct.Struct('<4sLQL')
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.offset = 0
+        self.central_headers = []
+
+    def write(self, zinfo: ZipInfo, content: bytes):
+        """
+        Writes the entry zinfo with its compressed content. zinfo's
+        compress_type, CRC, file_size and compress_size must be set.
+        """
+        filename = zinfo.filename.encode('ascii')
+        year, month, day, hour, minute, second = zinfo.date_time
+        dos_time = hour << 11 | minute << 5 | second // 2
+        dos_date = (year - 1980) << 9 | month << 5 | day
+        version_needed = self.VERSION_NEEDED[zinfo.compress_type]
+        made_by = self.VERSION_MADE_BY
+
+        # sizes and offsets exceeding the limit are replaced by 0xFFFFFFFF
+        # and given in a zip64 extra field, sizes always both together
+        file_size, compress_size, offset = zinfo.file_size, zinfo.compress_size, self.offset
+        local_extra = b''
+        central_zip64_fields = []
+        if max(file_size, compress_size) > self.ZIP64_LIMIT:
+            local_extra = struct.pack('<2H2Q', 1, 16, file_size, compress_size)
+            central_zip64_fields = [file_size, compress_size]
+            file_size = compress_size = 0xFFFFFFFF
+            version_needed = self.ZIP64_VERSION
+        if offset > self.ZIP64_LIMIT:
+            central_zip64_fields.append(offset)
+            offset = 0xFFFFFFFF
+        central_extra = b''
+        if central_zip64_fields:
+            central_extra = struct.pack(f'<2H{len(central_zip64_fields)}Q', 1, 8 * len(central_zip64_fields), *central_zip64_fields)
+            version_needed = self.ZIP64_VERSION
+            made_by = made_by & 0xFF00 | self.ZIP64_VERSION
+
+        self.fp.write(self.LOCAL_HEADER.pack(b'PK\x03\x04', version_needed, 0, zinfo.compress_type,
+            dos_time, dos_date, zinfo.CRC, compress_size, file_size, len(filename), len(local_extra)))
+        self.fp.write(filename)
+        self.fp.write(local_extra)
+        self.fp.write(content)
+        self.central_headers.append(self.CENTRAL_HEADER.pack(b'PK\x01\x02', made_by, version_needed, 0,
+            zinfo.compress_type, dos_time, dos_date, zinfo.CRC, compress_size, file_size, len(filename),
+            len(central_extra), 0, 0, 0, zinfo.external_attr, offset) + filename + central_extra)
+        self.offset += self.LOCAL_HEADER.size + len(filename) + len(local_extra) + len(content)
+
+    def close(self):
+        """
+        Writes the central directory and end record, preceded by the zip64
+        end record and locator, if the entries exceed the zip limits.
+        """
+        central_directory = b''.join(self.central_headers)
+        entries = len(self.central_headers)
+        self.fp.write(central_directory)
+        end_offset = self.offset + len(central_directory)
+        if (entries > self.ZIP_FILECOUNT_LIMIT or len(central_directory) > self.ZIP64_LIMIT
+                or self.offset > self.ZIP64_LIMIT):
+            self.fp.write(self.ZIP64_END_RECORD.pack(b'PK\x06\x06', self.ZIP64_END_RECORD.size - 12,
+                self.VERSION_MADE_BY & 0xFF00 | self.ZIP64_VERSION, self.ZIP64_VERSION, 0, 0,
+                entries, entries, len(central_directory), self.offset))
+            self.fp.write(self.ZIP64_END_LOCATOR.pack(b'PK\x06\x07', 0, end_offset, 1))
+        self.fp.write(self.END_RECORD.pack(b'PK\x05\x06', 0, 0, min(entries, 0xFFFF), min(entries, 0xFFFF),
+            min(len(central_directory), 0xFFFFFFFF), min(self.offset, 0xFFFFFFFF), 0))
+
+
 class GtfsExport:
     
-    stops_counter = 0
     trips_counter = 0
-    routes_counter = 0
 
-    stored_stops = {}
-    
-    def __init__(self, agencies, feed_info, ridestore, stopstore, bbox = None):
+    def __init__(self, agencies, feed_info, ridestore, stopstore, bbox = None, region_id = None, stop_catalog = None,
+            compression = ZIP_DEFLATED, compresslevel = None, columnar_format = None):
+        # stops referenced by trips, which are not always exported
         self.stops = {}
-        self.routes = []
-        self.calendar_dates = []
-        self.calendar = []
-        self.trips = []
-        self.stop_times = []
-        self.calendar = []
-        self.shapes = []
+        # stops to look up referenced stops, e.g. a GtfsStopCatalog
+        self.stored_stops = {}
+        self.always_exported_stop_ids = frozenset()
+        self.always_exported_stops_csv = ''
         self.agencies = agencies
         self.feed_info = feed_info
         self.stopstore = stopstore
         self.ridestore = ridestore
         self.bbox = bbox
+        self.region_id = region_id
+        self.stop_catalog = stop_catalog
+        # ZIP_STORED or ZIP_DEFLATED, compresslevel as for zlib.compress
+        if compression not in CompressedZipWriter.VERSION_NEEDED:
+            raise ValueError(f"Unsupported compression method {compression}")
+        self.compression = compression
+        self.compresslevel = compresslevel
+        # 'parquet' or 'arrow', to additionally export trips, stop_times etc. as columnar files
+        self.columnar_format = columnar_format
+        self._columnar_exports = []
+        # content hash of the last exported feed
+        self.feed_version = None
             
-    def export(self, gtfszip_filename, gtfsfolder):
-        assert_folder_exists(gtfsfolder)
-        self._prepare_gtfs_feed(self.ridestore, self.stopstore)
-        self._write_csvfile(gtfsfolder, 'agency.txt', self.agencies)
-        self._write_csvfile(gtfsfolder, 'feed_info.txt', self.feed_info)
-        self._write_csvfile(gtfsfolder, 'routes.txt', self.routes)
-        self._write_csvfile(gtfsfolder, 'trips.txt', self.trips)
-        self._write_csvfile(gtfsfolder, 'calendar.txt', self.calendar)
-        self._write_csvfile(gtfsfolder, 'calendar_dates.txt', self.calendar_dates)
-        self._write_csvfile(gtfsfolder, 'stops.txt', self.stops.values())
-        self._write_csvfile(gtfsfolder, 'stop_times.txt', self.stop_times)
-        self._write_csvfile(gtfsfolder, 'shapes.txt', self.shapes)
-        self._zip_files(gtfszip_filename, gtfsfolder)
-
-    def _zip_files(self, gtfszip_filename, gtfsfolder):
-        gtfsfiles = ['agency.txt', 'feed_info.txt', 'routes.txt', 'trips.txt', 
-                'calendar.txt', 'calendar_dates.txt', 'stops.txt', 'stop_times.txt', 'shapes.txt']
-        with ZipFile(gtfszip_filename, 'w') as gtfszip:
-            for gtfsfile in gtfsfiles:
-                gtfszip.write(gtfsfolder+'/'+gtfsfile, gtfsfile)
-        
-    def _prepare_gtfs_feed(self, ridestore, stopstore):
+    def export(self, gtfszip_filename):
         """
-        Prepares all gtfs objects in memory before they are written
-        to their respective streams.
-        
-        For all wellknown stops a GTFS stop is created and
-        afterwards all ride offers are transformed into their
-        gtfs equivalents.
+        Exports the GTFS feed as zip file gtfszip_filename. The feed is
+        concatenated from the pre-rendered rows of each trip, which the
+        ridestore keeps until the trip changes, while they are written to
+        their zip entry. The entries are compressed in parallel threads.
+        Rows are ordered by trip_id and feed_info's feed_version is a hash
+        of all other files, so exports of the same trips and stops are
+        byte-identical. If columnar_format is set, trips, stop_times etc.
+        are converted from the same rendered rows to columnar files next
+        to the zip. The zip is written to a temporary file first, which
+        then replaces gtfszip_filename, so consumers never download a
+        partially written feed.
         """
-        for stopSet in stopstore.stopsDataFrames:
-            for stop in stopSet["stops"].itertuples():
-                self._load_stored_stop(stop)
-        cloned_trips = dict(ridestore.trips)
-        for url, trip in cloned_trips.items():
-            if self.bbox is None or trip.intersects(self.bbox):
-                self._convert_trip(trip)
-    
-    def _convert_trip(self, trip):
+        if self.stop_catalog is None or self.stop_catalog.version != self.stopstore.version:
+            self.stop_catalog = GtfsStopCatalog(self.stopstore)
+        self.stored_stops = self.stop_catalog
+        self.always_exported_stop_ids, self.always_exported_stops_csv = self.stop_catalog.always_exported_stops(self.bbox)
+        fragments = [self.ridestore.gtfs_fragments(trip) for trip in self._trips_to_export(self.ridestore)]
+        self._write_feed(gtfszip_filename, fragments)
+
+    def _write_feed(self, gtfszip_filename, fragments):
+        feed_start_date = calendar_start_of(datetime.today())
+        fragments = sorted(fragments, key=attrgetter('trip_id'))
+        self._gtfszip_filename = gtfszip_filename
+        self._columnar_exports = []
+        # Entries are rendered one after another, while the previous ones
+        # are compressed by other threads, as zlib releases the GIL
+        with ThreadPoolExecutor() as executor:
+            entries = [
+                self._compress_entry(executor, 'agency.txt', self._write_csv, self.agencies),
+                self._compress_entry(executor, 'routes.txt', self._write_rows, GtfsRoute._fields, (f.route for f in fragments)),
+                self._compress_entry(executor, 'trips.txt', self._write_rows, GtfsTrip._fields, (f.trip for f in fragments)),
+                self._compress_entry(executor, 'calendar.txt', self._write_csv,
+                    (create_calendar_of(f.service_id, f.weekdays, feed_start_date, f.service_date) for f in self._unique_by(fragments, 'service_id'))),
+                self._compress_entry(executor, 'calendar_dates.txt', self._write_rows, GtfsCalendarDate._fields,
+                    (f.calendar_dates for f in self._unique_by(fragments, 'service_id'))),
+                # stop_times are rendered before stops, as they collect the stops to export
+                self._compress_entry(executor, 'stop_times.txt', self._write_rows, GtfsStopTime._fields,
+                    (row for f in fragments for row in self._stop_times_and_collect_stops(f))),
+                self._compress_entry(executor, 'stops.txt', self._write_stops),
+                self._compress_entry(executor, 'shapes.txt', self._write_rows, GtfsShape._fields,
+                    (f.shapes for f in self._unique_by(fragments, 'shape_id'))),
+            ]
+            self.feed_version = self._feed_version([entry.result() for entry in entries])
+            feed_info = self.feed_info
+            if feed_info is not None:
+                feed_info = feed_info._replace(feed_version=self.feed_version)
+            entries.append(self._compress_entry(executor, 'feed_info.txt', self._write_csv, feed_info))
+            with open_atomically(gtfszip_filename) as f:
+                gtfszip = CompressedZipWriter(f)
+                for entry in entries:
+                    zinfo, content, _ = entry.result()
+                    gtfszip.write(zinfo, content)
+                gtfszip.close()
+            # the zip is published already, so a failed columnar file
+            # is only logged and does not fail the feed's export
+            for columnar_export in self._columnar_exports:
+                try:
+                    columnar_export.result()
+                except Exception:
+                    logger.exception("Failed to export columnar files of GTFS feed %s", gtfszip_filename)
+
+    def _feed_version(self, entries):
+        """
+        Returns a hash of the content of the given entries, so the feed
+        version only changes, if the feed's content changes.
+        """
+        feed_hash = hashlib.sha1()
+        for zinfo, _, content_hash in entries:
+            feed_hash.update(zinfo.filename.encode('utf-8'))
+            feed_hash.update(content_hash)
+        return feed_hash.hexdigest()[:16]
+
+    def _unique_by(self, fragments, attribute):
+        """
+        Yields the first of all fragments with the same value of attribute.
+        """
+        seen = set()
+        for f in fragments:
+            value = getattr(f, attribute)
+            if value not in seen:
+                seen.add(value)
+                yield f
+
+    def _trips_to_export(self, ridestore):
         """
-        Appends all required gtfs records for this trip to the
-        GTFS feeds files. I.e. it creates a new route, trip,
-        calendar, calendar_dates (in case it's no regular trip or
-        some dates are exceptionally served/unserved), stop_times 
-        and shapes. 
+        Returns the ridestore's trips within region_id or bbox, which run on
+        any day of the calendar's validity or later.
         """
-        self.routes_counter += 1
-        calendar = self._create_calendar(trip)
-        trip_calendar_dates = []
-        if not trip.runs_regularly:
-            trip_calendar_dates = [self._create_calendar_date(trip)]
+        active_days = ridestore.active_days(datetime.today(), CALENDAR_VALIDITY_IN_DAYS + 1)
+        if self.region_id is not None:
+            # region membership is precomputed by the ridestore's region index
+            trips = ridestore.trips_in_region(self.region_id)
         else:
-            # Append exceptions from regular schedule to calendar_dates
-            trip_calendar_dates.extend([GtfsCalendarDate(trip.trip_id, self._convert_stop_date(d), CALENDAR_DATES_EXCEPTION_TYPE_ADDED) for d in trip.additional_service_days or []])
-            trip_calendar_dates.extend([GtfsCalendarDate(trip.trip_id, self._convert_stop_date(d), CALENDAR_DATES_EXCEPTION_TYPE_REMOVED) for d in trip.non_service_days or []])
-                
-        self.routes.append(self._create_route(trip, calendar, trip_calendar_dates))
-        self.calendar.append(calendar)
-        self.calendar_dates.extend(trip_calendar_dates)
-        self.trips.append(self._create_trip(trip, self.routes_counter))
-        self._append_stops_and_stop_times(trip)
-        self._append_shapes(trip, self.routes_counter)
-    
+            trips = [trip for trip in dict(ridestore.trips).values() if self.bbox is None or trip.intersects(self.bbox)]
+        return [trip for trip in trips if active_days.has_remaining_service(trip)]
+
     def _trip_headsign(self, destination):
         destination = destination.replace('(Deutschland)', '')
         destination = destination.replace(', Deutschland', '')
@@ -124,135 +425,92 @@ class GtfsExport:
             logger.exception(ex)
             return destination
    
-    def _create_route(self, trip, calendar: GtfsCalendar, calendar_dates: list[GtfsCalendarDate]): 
-        calendar_desc = format_calendar(calendar, calendar_dates)
-        return GtfsRoute(trip.agency, trip.trip_id, trip.route_long_name(), RIDESHARING_ROUTE_TYPE, trip.url, "", calendar_desc)
-        
-    def _create_calendar(self, trip):
-        # TODO currently, calendar is not provided by Fahrgemeinschaft.de interface.
-        # We could apply some heuristics like requesting multiple days and extrapolate
-        # if multiple trips are found, but better would be to have these provided by the
-        # offical interface. Then validity periods should be provided as well (not
-        # sure if these are available)
-        # For fahrgemeinschaft.de, regurlar trips are recognizable via their url
-        # which contains "regelmaessig". However, we don't know on which days of the week,
-        # nor until when. As a first guess, if datetime is a mo-fr, we assume each workday,
-        # if it's sa/su, only this...
-        
-        feed_start_date = datetime.today()
-        stop_date = self._convert_stop_date(feed_start_date)
-        return GtfsCalendar(trip.trip_id, stop_date, self._convert_stop_date(feed_start_date + timedelta(days=31)), *(trip.weekdays))
-    
-    def _create_calendar_date(self, trip):
-        return GtfsCalendarDate(trip.trip_id, self._convert_stop_date(trip.start), CALENDAR_DATES_EXCEPTION_TYPE_ADDED)
-    
-    def _create_trip(self, trip, shape_id):
-        return GtfsTrip(trip.trip_id, trip.trip_id, trip.trip_id, shape_id, trip.trip_headsign, NO_BIKES_ALLOWED)
-    
-    def _convert_stop(self, stop):
+    def _stop_times_and_collect_stops(self, fragments):
         """
-        Converts a stop represented as pandas row to a gtfs stop.
-        Expected attributes of stop: id, stop_name, x, y (in wgs84)
+        Yields the trip's stop_times rows and marks their stops to be exported.
         """
-        if stop.id:
-            id = stop.id
-        else:
-            self.stops_counter += 1
-            id = "tmp-{}".format(self.stops_counter)
-
-        stop_name = "k.A." if stop.stop_name is None else stop.stop_name
-        return GtfsStop(id, stop.y, stop.x, stop_name)
-
-    def _extract_stop_from_trip(self, stop_id, trip):
-        matched_stop = next(stop for stop in trip.stops if stop.id == stop_id)
-        if matched_stop is not None:
-            return GtfsStop(matched_stop.id, matched_stop.lat, matched_stop.lon, matched_stop.name )
-        return None
-        
-    def _append_stops_and_stop_times(self, trip):
         # Assumptions: 
         # arrival_time = departure_time
         # pickup_type, drop_off_type for origin: = coordinate/none
         # pickup_type, drop_off_type for destination: = none/coordinate
         # timepoint = approximate for origin and destination (not sure what consequences this might have for trip planners)
-        for stop_time in trip.stop_times:
-            if stop_time.stop_id in self.stops:
-                # Append stop_time
-                self.stop_times.append(stop_time)
+        for row, (stop_id, trip_stop) in zip(fragments.stop_times, fragments.stops):
+            if stop_id in self.always_exported_stop_ids or stop_id in self.stops:
+                yield row
                 continue
             
             # retrieve stop from stored_stops and mark it to be exported
-            wkn_stop = self.stored_stops.get(stop_time.stop_id)
+            wkn_stop = self.stored_stops.get(stop_id)
             if wkn_stop is None:
                 # if the stop is provided by the trip's agency, add it
-                wkn_stop = self._extract_stop_from_trip(stop_time.stop_id, trip)
+                wkn_stop = trip_stop
                 if wkn_stop is None:
-                    logger.warning("No stop found in stop_store for %s. Will skip stop_time %s of trip %s", stop_time.stop_id, stop_time.stop_sequence, trip.trip_id)
+                    logger.warning("No stop found in stop_store for %s. Will skip its stop_time of trip %s", stop_id, fragments.trip_id)
                     continue
             
-            self.stops[stop_time.stop_id] = wkn_stop
-            # Append stop_time
-            self.stop_times.append(stop_time)
+            self.stops[stop_id] = wkn_stop
+            yield row
         
-    def _append_shapes(self, trip, shape_id):
-        counter = 0
-        for point in trip.path.coordinates:
-                counter += 1
-                self.shapes.append(GtfsShape(shape_id, point[0], point[1], counter))
-            
-    def _stop_hash(self, stop):
-        return "{}#{}#{}".format(stop.stop_name,stop.x,stop.y)
-        
-    def _should_always_export(self, stop):
-        """ 
-        Returns true, if the given stop shall be exported to GTFS,
-        regardless, if it's part of a trip or not.
+    def _compress_entry(self, executor, filename, write, *args):
+        """
+        Renders the zip entry filename by write(csvfile, *args) and returns
+        the future of its ZipInfo, compressed content and content hash.
+        """
+        csvfile = io.StringIO()
+        write(csvfile, *args)
+        content = csvfile.getvalue().encode('utf-8')
+        if self.columnar_format is not None and filename in COLUMNAR_FILES:
+            self._columnar_exports.append(executor.submit(write_columnar, content, filename,
+                columnar_filename(self._gtfszip_filename, filename, self.columnar_format), self.columnar_format))
+        return executor.submit(self._compress, filename, content)
 
-        This is necessary, as potential stops are required 
-        to be part of the GTFS to be referenced later on 
-        by dynamicly added trips.
+    def _compress(self, filename, content):
+        zinfo = ZipInfo(filename, date_time=ZIP_DATE_TIME)
+        zinfo.compress_type = self.compression
+        zinfo.external_attr = 0o600 << 16
+        zinfo.file_size = len(content)
+        zinfo.CRC = zlib.crc32(content)
+        content_hash = hashlib.sha1(content).digest()
+        if self.compression == ZIP_DEFLATED:
+            level = zlib.Z_DEFAULT_COMPRESSION if self.compresslevel is None else self.compresslevel
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+            content = compressor.compress(content) + compressor.flush()
+        zinfo.compress_size = len(content)
+        return zinfo, content, content_hash
+
+    def _write_stops(self, csvfile):
+        if self.always_exported_stops_csv or self.stops:
+            writer = csv.DictWriter(csvfile, GtfsStop._fields)
+            writer.writeheader()
+            csvfile.write(self.always_exported_stops_csv)
+            writer.writerows(stop._asdict() for stop in self.stops.values())
+
+    def _write_rows(self, csvfile, fields, rows):
         """
-        if self.bbox:
-            return (self.bbox[0] <= stop.stop_lon <= self.bbox[2] and 
-                self.bbox[1] <= stop.stop_lat <= self.bbox[3])
-        else:
-            return is_carpooling_stop(stop.stop_id, stop.stop_name)
-            
-    def _load_stored_stop(self, stop):
-        gtfsstop = self._convert_stop(stop)
-        stop_hash = self._stop_hash(stop)
-        self.stored_stops[gtfsstop.stop_id] = gtfsstop
-        if self._should_always_export(gtfsstop):
-            self.stops[gtfsstop.stop_id] = gtfsstop
-
-    def _get_stop_by_hash(self, stop_hash):
-        return self.stops.get(stop_hash, self.stored_stops.get(stop_hash))
-    
-    def _get_or_create_stop(self, stop):
-        stop_hash = self._stop_hash(stop)
-        gtfsstop = self.stops.get(stop_hash)
-        if gtfsstop is None:
-            gtfsstop = self.stored_stops.get(stop_hash, self._convert_stop(stop))
-            self.stops[stop_hash] = gtfsstop
-        return gtfsstop
-            
-    def _convert_stop_date(self, date_time):
-        return date_time.strftime("%Y%m%d")
-    
-    def _write_csvfile(self, gtfsfolder, filename, content):
-        with open(gtfsfolder+"/"+filename, 'w', newline="\n", encoding="utf-8") as csvfile:
-            self._write_csv(csvfile, content)
-    
+        Writes pre-rendered csv rows, preceded by a header, if there are any.
+        """
+        header_written = False
+        for row in rows:
+            if row and not header_written:
+                csv.writer(csvfile).writerow(fields)
+                header_written = True
+            csvfile.write(row)
+
     def _write_csv(self, csvfile, content):
+        """
+        Writes a single record or an iterable of records as csv. The header
+        is derived from the first record, so nothing is written for no records.
+        """
         if hasattr(content, '_fields'):
             writer = csv.DictWriter(csvfile, content._fields)
             writer.writeheader()
             writer.writerow(content._asdict())
-        else:
-            if content:
-                writer = csv.DictWriter(csvfile, next(iter(content))._fields)
-                writer.writeheader()
-                for record in content:
-                    writer.writerow(record._asdict())
+        elif content:
+            writer = None
+            for record in content:
+                if writer is None:
+                    writer = csv.DictWriter(csvfile, record._fields)
+                    writer.writeheader()
+                writer.writerow(record._asdict())
 
     
\ No newline at end of file
@@ -0,0 +1,126 @@
+from collections import namedtuple
+from datetime import datetime, timedelta
+import csv
+import hashlib
+import io
+
+from amarillo.models.gtfs import GtfsRoute, GtfsStop, GtfsTrip, GtfsCalendar, GtfsCalendarDate, GtfsShape, format_calendar
+from amarillo.services.gtfs_constants import *
+
+# Days after the export date, until which calendar.txt's services are valid
+CALENDAR_VALIDITY_IN_DAYS = 31
+# calendar.txt's services start on the first day of the export date's week,
+# so the feed does not change daily
+CALENDAR_PERIOD_IN_DAYS = 7
+
+# Pre-rendered csv rows of a trip for routes.txt, trips.txt, calendar_dates.txt,
+# stop_times.txt (one per stop_time) and shapes.txt. stops holds for every
+# stop_time its stop_id and the trip's own stop with this id (or None), to
+# fall back on, if the stop is not stored. calendar.txt of regular trips
+# depends on the export date, so its row is rendered on export from
+# service_id and weekdays. One-time trips are valid on their service_date only.
+# Trips with equal services or shapes share their service_id or shape_id,
+# whose rows are exported only once.
+GtfsTripFragments = namedtuple('GtfsTripFragments', 'trip_id service_id weekdays service_date route trip calendar_dates stop_times shape_id shapes stops')
+
+
+def create_trip_fragments(trip) -> GtfsTripFragments:
+    """
+    Renders the GTFS rows of trip, which a GtfsExport concatenates.
+    """
+    calendar_dates = create_calendar_dates(trip)
+    # services and shapes are identified by their content, so trips with
+    # the same weekdays and exceptions or the same path share them.
+    # The calendar's date range of regular trips is the same for all trips of a feed.
+    service_id = _content_id((tuple(trip.weekdays), tuple((cd.date, cd.exception_type) for cd in calendar_dates)))
+    shape_id = _content_id(tuple((point[0], point[1]) for point in trip.path.coordinates))
+    return GtfsTripFragments(
+        trip.trip_id,
+        service_id,
+        tuple(trip.weekdays),
+        None if trip.runs_regularly else trip.start,
+        _render_rows([_create_route(trip, calendar_dates)]),
+        _render_rows([_create_trip(trip, shape_id, service_id)]),
+        _render_rows(calendar_date._replace(service_id=service_id) for calendar_date in calendar_dates),
+        tuple(_render_rows([stop_time]) for stop_time in trip.stop_times),
+        shape_id,
+        _render_rows(_create_shapes(trip, shape_id)),
+        tuple((stop_time.stop_id, _extract_stop_from_trip(stop_time.stop_id, trip)) for stop_time in trip.stop_times))
+
+
+def create_calendar_dates(trip):
+    """
+    Returns the calendar_dates of this trip, i.e. its date, if it's
+    no regular trip, or the dates exceptionally served/unserved, ordered
+    by date, so equal exceptions result in equal services.
+    """
+    if not trip.runs_regularly:
+        return [GtfsCalendarDate(trip.trip_id, convert_stop_date(trip.start), CALENDAR_DATES_EXCEPTION_TYPE_ADDED)]
+    # Exceptions from regular schedule
+    trip_calendar_dates = [GtfsCalendarDate(trip.trip_id, convert_stop_date(d), CALENDAR_DATES_EXCEPTION_TYPE_ADDED) for d in trip.additional_service_days or []]
+    trip_calendar_dates.extend([GtfsCalendarDate(trip.trip_id, convert_stop_date(d), CALENDAR_DATES_EXCEPTION_TYPE_REMOVED) for d in trip.non_service_days or []])
+    return sorted(trip_calendar_dates, key=lambda calendar_date: (calendar_date.date, calendar_date.exception_type))
+
+
+def create_calendar_of(service_id, weekdays, feed_start_date, service_date = None):
+    """
+    Returns the calendar of a service, which is valid on service_date only,
+    if given, otherwise from feed_start_date on for the calendar's validity.
+    """
+    if service_date is not None:
+        return GtfsCalendar(service_id, convert_stop_date(service_date), convert_stop_date(service_date), *weekdays)
+    stop_date = convert_stop_date(feed_start_date)
+    return GtfsCalendar(service_id, stop_date, convert_stop_date(feed_start_date + timedelta(days=CALENDAR_VALIDITY_IN_DAYS + CALENDAR_PERIOD_IN_DAYS - 1)), *weekdays)
+
+
+def calendar_start_of(export_date):
+    """
+    Returns the start date of calendar.txt's services for feeds exported
+    on export_date, i.e. the first day of export_date's week. Services are
+    valid for a whole period longer, so they still cover CALENDAR_VALIDITY_IN_DAYS
+    after export_date.
+    """
+    return (export_date - timedelta(days=export_date.weekday())).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def convert_stop_date(date_time):
+    return date_time.strftime("%Y%m%d")
+
+
+def _create_route(trip, calendar_dates: list[GtfsCalendarDate]):
+    # TODO currently, calendar is not provided by Fahrgemeinschaft.de interface.
+    # We could apply some heuristics like requesting multiple days and extrapolate
+    # if multiple trips are found, but better would be to have these provided by the
+    # offical interface. Then validity periods should be provided as well (not
+    # sure if these are available)
+    # For fahrgemeinschaft.de, regurlar trips are recognizable via their url
+    # which contains "regelmaessig". However, we don't know on which days of the week,
+    # nor until when. As a first guess, if datetime is a mo-fr, we assume each workday,
+    # if it's sa/su, only this...
+    calendar_desc = format_calendar(create_calendar_of(trip.trip_id, trip.weekdays, datetime.today()), calendar_dates)
+    return GtfsRoute(trip.agency, trip.trip_id, trip.route_long_name(), RIDESHARING_ROUTE_TYPE, trip.url, "", calendar_desc)
+
+
+def _create_trip(trip, shape_id, service_id):
+    return GtfsTrip(trip.trip_id, trip.trip_id, service_id, shape_id, trip.trip_headsign, NO_BIKES_ALLOWED)
+
+
+def _create_shapes(trip, shape_id):
+    return [GtfsShape(shape_id, point[0], point[1], counter) for counter, point in enumerate(trip.path.coordinates, 1)]
+
+
+def _extract_stop_from_trip(stop_id, trip):
+    matched_stop = next((stop for stop in trip.stops if stop.id == stop_id), None)
+    if matched_stop is not None:
+        return GtfsStop(matched_stop.id, matched_stop.lat, matched_stop.lon, matched_stop.name )
+    return None
+
+
+def _content_id(content):
+    return hashlib.sha1(repr(content).encode('utf-8')).hexdigest()[:16]
+
+
+def _render_rows(records):
+    rows = io.StringIO()
+    csv.writer(rows).writerows(records)
+    return rows.getvalue()
@@ -1,9 +1,9 @@
 from amarillo.models.Carpool import Region
-from amarillo.services.gtfs_export import GtfsExport, GtfsFeedInfo, GtfsAgency
-from amarillo.services.gtfs import GtfsRtProducer
+from amarillo.services.config import config
+from amarillo.services.gtfs_export import MultiRegionGtfsExport, GtfsFeedInfo, GtfsAgency
 from amarillo.utils.container import container
 from glob import glob
-from datetime import date
+from zipfile import ZIP_DEFLATED, ZIP_STORED
 import json
 import schedule
 import threading
@@ -13,7 +13,7 @@ import logging
 logger = logging.getLogger(__name__)
 
 regions = {}
-for region_file_name in glob('conf/region/*.json'):
+for region_file_name in sorted(glob('conf/region/*.json')):
     with open(region_file_name) as region_file:
         dict = json.load(region_file)
         region = Region(**dict)
@@ -21,7 +21,7 @@ for region_file_name in glob('conf/region/*.json'):
         regions[region_id] = region
 
 agencies = []
-for agency_file_name in glob('conf/agency/*.json'):
+for agency_file_name in sorted(glob('conf/agency/*.json')):
     with open(agency_file_name) as agency_file:
         dict = json.load(agency_file)
         agency = GtfsAgency(dict["id"], dict["name"], dict["url"], dict["timezone"], dict["lang"], dict["email"])
@@ -32,6 +32,10 @@ for agency_file_name in glob('conf/agency/*.json'):
 with open('conf/feed_info.json', 'r') as f:
     feed_info_template = json.load(f)
 
+stop_catalog = None
+
+zip_compressions = {'deflated': ZIP_DEFLATED, 'stored': ZIP_STORED}
+
 def run_schedule():
 	while 1:
 		try:
@@ -42,9 +46,11 @@ def run_schedule():
 
 def midnight():
 	container['stops_store'].load_stop_sources()
-	container['trips_store'].unflag_unrecent_updates()
+	# the TripStore is changed by the enhancement pipeline's thread only
+	container['enhancement_pipeline'].unflag_unrecent_updates()
 	container['carpools'].purge_outdated_offers()
 	generate_gtfs()
+	generate_gtfs_rt()
 
 def generate_gtfs():
 	logger.info("Generate GTFS")
@@ -56,28 +62,35 @@ def generate_gtfs():
 		feed_info_template.get('feed_lang',''),
 		feed_info_template.get('feed_contact_email',''),
 		feed_info_template.get('feed_contact_url',''),
-		date.today().isoformat())
+		# set by the export to a hash of the feed's content
+		None)
 
-	for region in regions.values():
-		
-		exporter = GtfsExport(
-			agencies, 
-			feed_info, 
-			container['trips_store'], 
-			container['stops_store'], 
-			region.bbox)
-		exporter.export(f"data/gtfs/amarillo.{region.id}.gtfs.zip", "data/tmp/")
+	global stop_catalog
+	exporter = MultiRegionGtfsExport(
+		agencies, 
+		feed_info, 
+		container['trips_store'], 
+		container['stops_store'], 
+		regions.values(),
+		config.gtfs_export_workers,
+		stop_catalog,
+		container['gtfs_history'],
+		compression=zip_compressions[config.gtfs_zip_compression],
+		compresslevel=config.gtfs_zip_compresslevel,
+		columnar_format=config.gtfs_columnar_format)
+	exporter.export("data/gtfs/amarillo.{region_id}.gtfs.zip")
+	# reused by subsequent exports until the stop sources are reloaded
+	stop_catalog = exporter.stop_catalog
 
 def generate_gtfs_rt():
-	logger.info("Generate GTFS-RT")
-	producer = GtfsRtProducer(container['trips_store'])
-	for region in regions.values():
-		rt = producer.export_feed(time.time(), f"data/gtfs/amarillo.{region.id}.gtfsrt", bbox=region.bbox)
+	# Regenerated by the publisher's thread, which otherwise only
+	# regenerates feeds of regions with changed trips
+	container['gtfsrt_publisher'].publish_all()
 
 def start_schedule():
 	schedule.every().day.at("00:00").do(midnight)
-	schedule.every(60).seconds.do(generate_gtfs_rt)
 	# Create all feeds once at startup
 	schedule.run_all()
+	container['gtfsrt_publisher'].start()
 	job_thread = threading.Thread(target=run_schedule, daemon=True)
 	job_thread.start()
\ No newline at end of file
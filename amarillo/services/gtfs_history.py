@@ -0,0 +1,171 @@
+from collections import namedtuple
+import csv
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+from zipfile import ZipFile
+
+from amarillo.models.gtfs import GtfsRoute, GtfsTrip, GtfsStopTime, GtfsCalendar, GtfsCalendarDate, GtfsShape, GtfsStop
+from amarillo.utils.utils import assert_folder_exists, write_atomically
+
+logger = logging.getLogger(__name__)
+
+# Files compared between feed versions, with their fields and the field
+# identifying the rows, which belong together, e.g. the stop_times of a trip
+DIFF_FILES = {
+    'routes.txt': (GtfsRoute._fields, 'route_id'),
+    'trips.txt': (GtfsTrip._fields, 'trip_id'),
+    'stop_times.txt': (GtfsStopTime._fields, 'trip_id'),
+    'calendar.txt': (GtfsCalendar._fields, 'service_id'),
+    'calendar_dates.txt': (GtfsCalendarDate._fields, 'service_id'),
+    'shapes.txt': (GtfsShape._fields, 'shape_id'),
+    'stops.txt': (GtfsStop._fields, 'stop_id'),
+}
+
+ADDED = 'added'
+CHANGED = 'changed'
+REMOVED = 'removed'
+
+# A row of filename, which was added, changed or removed
+GtfsChange = namedtuple('GtfsChange', 'filename change record')
+
+
+class GtfsFeedHistory:
+    """
+    GtfsFeedHistory keeps the last max_versions published GTFS feeds of
+    each region, identified by their feed_version, i.e. the hash of their
+    content, together with a fingerprint per trip, service, shape and stop.
+    The changes between two kept versions are derived from these, so
+    consumers can update their copy of a feed incrementally.
+    """
+
+    def __init__(self, directory: str = 'data/gtfs-history', max_versions: int = 7):
+        self.directory = directory
+        self.max_versions = max_versions
+
+    def record(self, region_id: str, gtfszip_filename: str, feed_version: str):
+        """
+        Keeps the just published feed gtfszip_filename as feed_version of
+        region_id and removes the versions published least recently beyond
+        max_versions.
+        """
+        if self.max_versions < 1:
+            return
+        assert_folder_exists(self._region_directory(region_id))
+        zip_filename = self._zip_filename(region_id, feed_version)
+        if os.path.exists(zip_filename):
+            # unchanged feed published again
+            os.utime(zip_filename)
+        else:
+            fingerprints = self._fingerprints(gtfszip_filename)
+            write_atomically(self._fingerprints_filename(region_id, feed_version), json.dumps(fingerprints).encode('utf-8'))
+            # The published file is replaced by the next export, so a hard link keeps this version.
+            # The zip is added last, as it marks the version as available.
+            tmp_filename = f'{zip_filename}.{os.getpid()}.tmp'
+            try:
+                os.link(gtfszip_filename, tmp_filename)
+            except OSError:
+                shutil.copyfile(gtfszip_filename, tmp_filename)
+            os.replace(tmp_filename, zip_filename)
+        for outdated_version in self.versions(region_id)[self.max_versions:]:
+            logger.info("Remove GTFS feed version %s of region %s", outdated_version, region_id)
+            for filename in [self._zip_filename(region_id, outdated_version), self._fingerprints_filename(region_id, outdated_version)]:
+                try:
+                    os.remove(filename)
+                except FileNotFoundError:
+                    pass
+
+    def versions(self, region_id: str) -> list[str]:
+        """
+        Returns the kept feed versions of region_id, latest first.
+        """
+        region_directory = self._region_directory(region_id)
+        try:
+            filenames = os.listdir(region_directory)
+        except FileNotFoundError:
+            return []
+        published = []
+        for filename in filenames:
+            if filename.endswith('.gtfs.zip'):
+                try:
+                    published.append((os.stat(os.path.join(region_directory, filename)).st_mtime_ns, filename.removesuffix('.gtfs.zip')))
+                except FileNotFoundError:
+                    pass
+        return [version for _, version in sorted(published, reverse=True)]
+
+    def diff(self, region_id: str, since: str, until: str, filenames = None):
+        """
+        Returns the changes from feed version since to version until as
+        iterator of GtfsChange, or None, if one of the versions is not kept.
+        For added or changed trips, services, shapes and stops, all their
+        rows of version until are returned, which replace their previous
+        rows. For removed ones, their rows of version since are returned.
+        """
+        if region_id != os.path.basename(region_id) or since != os.path.basename(since) or until != os.path.basename(until):
+            return None
+        try:
+            with open(self._fingerprints_filename(region_id, since)) as f:
+                old_fingerprints = json.load(f)
+            with open(self._fingerprints_filename(region_id, until)) as f:
+                new_fingerprints = json.load(f)
+            # opened right away, so the versions may be removed while the changes are read
+            old_zip = ZipFile(self._zip_filename(region_id, since))
+        except FileNotFoundError:
+            return None
+        try:
+            new_zip = ZipFile(self._zip_filename(region_id, until))
+        except FileNotFoundError:
+            old_zip.close()
+            return None
+        return self._changes(old_zip, new_zip, old_fingerprints, new_fingerprints, filenames or list(DIFF_FILES))
+
+    def _changes(self, old_zip, new_zip, old_fingerprints, new_fingerprints, filenames):
+        with old_zip, new_zip:
+            for filename in filenames:
+                _, key = DIFF_FILES[filename]
+                old = old_fingerprints.get(filename, {})
+                new = new_fingerprints.get(filename, {})
+                changes = {key_value: ADDED for key_value in new.keys() - old.keys()}
+                changes.update({key_value: CHANGED for key_value in new.keys() & old.keys() if new[key_value] != old[key_value]})
+                removed = old.keys() - new.keys()
+                if changes:
+                    for record in self._records(new_zip, filename):
+                        change = changes.get(record[key])
+                        if change is not None:
+                            yield GtfsChange(filename, change, record)
+                if removed:
+                    for record in self._records(old_zip, filename):
+                        if record[key] in removed:
+                            yield GtfsChange(filename, REMOVED, record)
+
+    def _fingerprints(self, gtfszip_filename):
+        """
+        Returns per file a hash of the rows of every trip, service, shape or stop.
+        """
+        fingerprints = {}
+        with ZipFile(gtfszip_filename) as gtfszip:
+            for filename, (fields, key) in DIFF_FILES.items():
+                hashes = {}
+                for record in self._records(gtfszip, filename):
+                    row = '\x1f'.join(record[field] or '' for field in fields) + '\n'
+                    hashes.setdefault(record[key], hashlib.sha1()).update(row.encode('utf-8'))
+                fingerprints[filename] = {key_value: row_hash.hexdigest()[:16] for key_value, row_hash in hashes.items()}
+        return fingerprints
+
+    def _records(self, gtfszip, filename):
+        if filename not in gtfszip.namelist():
+            return
+        with io.TextIOWrapper(gtfszip.open(filename), encoding='utf-8', newline='') as csvfile:
+            yield from csv.DictReader(csvfile)
+
+    def _region_directory(self, region_id):
+        return os.path.join(self.directory, region_id)
+
+    def _zip_filename(self, region_id, feed_version):
+        return os.path.join(self._region_directory(region_id), f'{feed_version}.gtfs.zip')
+
+    def _fingerprints_filename(self, region_id, feed_version):
+        return os.path.join(self._region_directory(region_id), f'{feed_version}.fingerprints.json')
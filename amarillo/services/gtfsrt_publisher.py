@@ -0,0 +1,110 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class GtfsRtPublisher:
+    """
+    GtfsRtPublisher exports GTFS-RT feeds when trips change. The TripStore
+    notifies it on every put and delete. Changes are collected for
+    debounce_in_s seconds after the first one, then only the feeds of the
+    affected regions and the feed of all trips are regenerated. At least
+    every heartbeat_in_s seconds, all feeds are regenerated, so their
+    timestamp stays fresh.
+    """
+
+    def __init__(self, producer, trip_store, region_ids, feed_dir: str = 'data/gtfs',
+            debounce_in_s: float = 2, heartbeat_in_s: float = 60):
+        self.producer = producer
+        self.trip_store = trip_store
+        self.region_ids = list(region_ids)
+        self.feed_dir = feed_dir
+        self.debounce_in_s = debounce_in_s
+        self.heartbeat_in_s = heartbeat_in_s
+        self._condition = threading.Condition()
+        # regions whose feed must be regenerated, None if no change is pending
+        self._pending_region_ids = None
+        self._first_change = None
+        self._last_full_publication = None
+        # trip_id -> ids of the regions whose feeds currently contain the trip
+        self._published_region_ids = {}
+        trip_store.change_listeners.append(self.trip_changed)
+
+    def trip_changed(self, trip_id):
+        """
+        Marks the feeds of all regions the trip was or is contained in as changed.
+        """
+        trip = self.trip_store.trips.get(trip_id) or self.trip_store.deleted_trips.get(trip_id)
+        region_ids = set(trip.region_ids) if trip is not None else set()
+        with self._condition:
+            previous_region_ids = self._published_region_ids.pop(trip_id, set())
+            if region_ids:
+                self._published_region_ids[trip_id] = region_ids
+            self._mark_changed(region_ids | previous_region_ids)
+
+    def publish_all(self):
+        """
+        Marks the feeds of all regions as changed, e.g. because the
+        service day changed.
+        """
+        with self._condition:
+            self._mark_changed(self.region_ids)
+
+    def _mark_changed(self, region_ids):
+        if self._pending_region_ids is None:
+            self._pending_region_ids = set()
+            self._first_change = time.monotonic()
+        self._pending_region_ids.update(region_ids)
+        self._condition.notify()
+
+    def publish_pending(self):
+        """
+        Regenerates the feeds of all regions marked as changed and the
+        feed of all trips. If no change is pending or the heartbeat is due,
+        all feeds are regenerated.
+        """
+        with self._condition:
+            region_ids = self._pending_region_ids
+            self._pending_region_ids = None
+            self._first_change = None
+            now = time.monotonic()
+            if region_ids is None or self._last_full_publication is None or \
+                    now >= self._last_full_publication + self.heartbeat_in_s:
+                region_ids = self.region_ids
+                self._last_full_publication = now
+
+        logger.info("Generate GTFS-RT for regions %s", sorted(region_ids))
+        timestamp = time.time()
+        for region_id in self.region_ids:
+            if region_id in region_ids:
+                self.producer.export_feed(timestamp, f"{self.feed_dir}/amarillo.{region_id}.gtfsrt", region_id=region_id)
+        # Feed of all trips, from which feeds for arbitrary bboxes are served
+        self.producer.export_feed(timestamp, f"{self.feed_dir}/amarillo.gtfsrt", spatial_index=True)
+
+    def _seconds_until_publication(self):
+        if self._first_change is not None:
+            publication = self._first_change + self.debounce_in_s
+        elif self._last_full_publication is not None:
+            publication = self._last_full_publication + self.heartbeat_in_s
+        else:
+            publication = time.monotonic()
+        return publication - time.monotonic()
+
+    def run(self):
+        while True:
+            with self._condition:
+                timeout = self._seconds_until_publication()
+                if timeout > 0:
+                    self._condition.wait(timeout)
+                    continue
+            try:
+                self.publish_pending()
+            except Exception:
+                logger.exception("GTFS-RT publication failed")
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name='gtfsrt-publisher', daemon=True)
+        thread.start()
+        return thread
@@ -1,6 +1,9 @@
 import json
 from glob import glob
-from typing import Dict
+from typing import Dict, List
+
+from shapely import STRtree
+from shapely.geometry import box
 
 from amarillo.models.Carpool import Region
 
@@ -17,6 +20,13 @@ class RegionService:
                 region_id = region.id
                 self.regions[region_id] = region
 
+        self._region_ids = list(self.regions)
+        self._region_tree = STRtree([box(*self.regions[region_id].bbox) for region_id in self._region_ids])
+
     def get_region(self, region_id: str) -> Region:
         region = self.regions.get(region_id)
         return region
+
+    def region_ids_intersecting(self, geometry) -> List[str]:
+        """Returns the ids of all regions whose bbox intersects the given geometry."""
+        return [self._region_ids[i] for i in self._region_tree.query(geometry, predicate='intersects')]
@@ -1,3 +1,13 @@
+import asyncio
+from concurrent.futures import Future
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+
+import httpx
 import requests
 import logging
 
@@ -9,9 +19,193 @@ class RoutingException(Exception):
         # to use the same Message header as the parent class
         super().__init__(message)
 
+
+class RoutingCache:
+    """
+    RoutingCache keeps routing results in an SQLite database, so routes
+    between the same points survive restarts and are requested only once.
+    Results are keyed by their points, rounded to precision decimal places
+    (5 is about 1 m), expire ttl_in_s seconds after they were requested,
+    and the least recently used ones are evicted beyond max_entries.
+
+    Expired and least recently used results are deleted only once the
+    cache grows beyond max_entries, and then evict_ratio of max_entries
+    at once, so most puts are a single insert. Lookups update the
+    access times in batches of ACCESS_BATCH_SIZE.
+
+    Attributes:
+        hits        number of lookups answered from the cache
+        misses      number of lookups not answered from the cache
+    """
+
+    ACCESS_BATCH_SIZE = 100
+
+    def __init__(self, filename: str = 'data/routing-cache.sqlite', max_entries: int = 100000,
+            ttl_in_s: float = 30 * 86400, precision: int = 5, evict_ratio: float = 0.1):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.ttl_in_s = ttl_in_s
+        self.precision = precision
+        self.evict_ratio = evict_ratio
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # opened on first use, so merely creating a RoutingCache creates no file
+        self._connection = None
+        self._size = 0
+        # key -> access time of looked up results not yet written
+        self._accessed = {}
+
+    def key(self, points, *params) -> str:
+        coordinates = ';'.join(f'{point.x:.{self.precision}f},{point.y:.{self.precision}f}' for point in points)
+        return '|'.join([coordinates, *map(str, params)])
+
+    def get(self, key: str):
+        """
+        Returns the cached result for key, or None, if it is not cached or expired.
+        """
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute('SELECT result FROM routes WHERE key = ? AND created >= ?', (key, now - self.ttl_in_s)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._accessed[key] = now
+            if len(self._accessed) >= self.ACCESS_BATCH_SIZE:
+                self._write_accessed(connection)
+                connection.commit()
+        return json.loads(row[0])
+
+    def put(self, key: str, result):
+        """
+        Caches result for key and, if the cache grew beyond max_entries,
+        evicts expired and least recently used results.
+        """
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            if connection.execute('SELECT 1 FROM routes WHERE key = ?', (key,)).fetchone() is None:
+                self._size += 1
+            connection.execute('INSERT OR REPLACE INTO routes (key, result, created, accessed) VALUES (?, ?, ?, ?)',
+                (key, json.dumps(result), now, now))
+            self._accessed.pop(key, None)
+            if self._size > self.max_entries:
+                self._evict(connection, now)
+            connection.commit()
+
+    def flush(self):
+        """
+        Writes the access times of looked up results not yet written.
+        """
+        with self._lock:
+            if self._connection is not None:
+                self._write_accessed(self._connection)
+                self._connection.commit()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_ratio': self.hits / lookups if lookups else None}
+
+    def _write_accessed(self, connection):
+        connection.executemany('UPDATE routes SET accessed = ? WHERE key = ?',
+            ((accessed, key) for key, accessed in self._accessed.items()))
+        self._accessed.clear()
+
+    def _evict(self, connection, now):
+        self._write_accessed(connection)
+        connection.execute('DELETE FROM routes WHERE created < ?', (now - self.ttl_in_s,))
+        self._size = connection.execute('SELECT COUNT(*) FROM routes').fetchone()[0]
+        retained = self.max_entries - int(self.max_entries * self.evict_ratio)
+        if self._size > retained:
+            connection.execute('DELETE FROM routes WHERE key IN (SELECT key FROM routes ORDER BY accessed LIMIT ?)',
+                (self._size - retained,))
+            self._size = retained
+
+    def _connect(self):
+        if self._connection is None:
+            directory = os.path.dirname(self.filename)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # shared by all threads, access is serialized by _lock
+            self._connection = sqlite3.connect(self.filename, check_same_thread=False)
+            self._connection.execute('CREATE TABLE IF NOT EXISTS routes (key TEXT PRIMARY KEY, result TEXT, created REAL, accessed REAL)')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS routes_accessed ON routes (accessed)')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS routes_created ON routes (created)')
+            self._connection.commit()
+            self._size = self._connection.execute('SELECT COUNT(*) FROM routes').fetchone()[0]
+        return self._connection
+
+
+class SingleFlight:
+    """
+    SingleFlight lets concurrent calls with the same key share a single
+    execution of the called function and its result or exception.
+
+    Attributes:
+        shared      number of calls which joined an execution in flight
+    """
+
+    def __init__(self):
+        self.shared = 0
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args):
+        with self._lock:
+            future = self._calls.get(key)
+            joined = future is not None
+            if joined:
+                self.shared += 1
+            else:
+                future = self._calls[key] = Future()
+        if joined:
+            return future.result()
+        try:
+            result = fn(*args)
+        except BaseException as err:
+            future.set_exception(err)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+class AsyncSingleFlight:
+    """
+    AsyncSingleFlight lets concurrently awaited calls with the same key
+    share a single task running the called coroutine function. A caller
+    being cancelled does not cancel the task the others are waiting for.
+
+    Attributes:
+        shared      number of calls which joined a task in flight
+    """
+
+    def __init__(self):
+        self.shared = 0
+        self._tasks = {}
+
+    async def do(self, key, fn, *args):
+        task = self._tasks.get(key)
+        if task is not None:
+            self.shared += 1
+        else:
+            task = self._tasks[key] = asyncio.ensure_future(fn(*args))
+            task.add_done_callback(lambda _: self._tasks.pop(key, None))
+        return await asyncio.shield(task)
+
+
 class RoutingService():
-    def __init__(self, gh_url = 'https://api.mfdz.de/gh'):
+    def __init__(self, gh_url = 'https://api.mfdz.de/gh', cache: RoutingCache = None, timeout_in_s: float = None):
         self.gh_service_url = gh_url
+        self.cache = cache
+        self.timeout_in_s = timeout_in_s
+        # concurrent requests for the same points share one GraphHopper request
+        self.in_flight = SingleFlight()
 
     def path_for_stops(self, points):
     	# Retrieve graphhopper route traversing given points
@@ -22,26 +216,207 @@ class RoutingService():
             return {}
 	
     def _get_directions(self, points):
+        if self.cache is None:
+            return self.in_flight.do(_points_key(points), self._request_directions, points)
+        key = self.cache.key(points, self.gh_service_url)
+        directions = self.cache.get(key)
+        if directions is None:
+            directions = self.in_flight.do(key, self._request_and_cache_directions, key, points)
+            logger.debug("Routing cache %s, %s requests shared", self.cache.stats(), self.in_flight.shared)
+        return directions
+
+    def _request_and_cache_directions(self, key, points):
+        directions = self._request_directions(points)
+        self.cache.put(key, directions)
+        return directions
+
+    def _request_directions(self, points):
         req_url = self._create_url(points, True, True)
         logger.debug("Get directions via: {}".format(req_url))
-        response = requests.get(req_url)
-        status = response.status_code
-        if status == 200:
-            # Found route between points
-            return response.json()
-        else:
-            try:
-                message = response.json().get('message')
-            except:
-                raise RoutingException("Get directions failed with status code {}".format(status))
-            else:
-                raise RoutingException(message)
+        response = requests.get(req_url, timeout=self.timeout_in_s)
+        return _directions_from_response(response)
 
     def _create_url(self, points, calc_points = False, instructions = False):
         """ Creates GH request URL """
-        locations = ""
-        for point in points:
-            locations += "point={0}%2C{1}&".format(point.y, point.x)
-            
-        return "{0}/route?{1}instructions={2}&calc_points={3}&points_encoded=false&profile=car".format(
-            self.gh_service_url, locations, instructions, calc_points)    
+        return _directions_url(self.gh_service_url, points, calc_points, instructions)
+
+
+def _points_key(points):
+    return tuple((point.x, point.y) for point in points)
+
+
+def _directions_url(gh_service_url, points, calc_points = False, instructions = False):
+    locations = ""
+    for point in points:
+        locations += "point={0}%2C{1}&".format(point.y, point.x)
+
+    return "{0}/route?{1}instructions={2}&calc_points={3}&points_encoded=false&profile=car".format(
+        gh_service_url, locations, instructions, calc_points)
+
+
+def _directions_from_response(response):
+    status = response.status_code
+    if status == 200:
+        # Found route between points
+        return response.json()
+    else:
+        try:
+            message = response.json().get('message')
+        except:
+            raise RoutingException("Get directions failed with status code {}".format(status))
+        else:
+            raise RoutingException(message)
+
+
+class RoutingUnavailableException(RoutingException):
+    """
+    Raised if GraphHopper could not be reached, timed out or is
+    overloaded, in contrast to a RoutingException for a route it
+    could not find.
+    """
+
+
+class CircuitBreaker:
+    """
+    CircuitBreaker opens after failure_threshold consecutive failed
+    requests, so further requests fail fast instead of piling up at an
+    unavailable backend. After reset_timeout_in_s, a single trial request
+    is let through, which closes the breaker on success or reopens it.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout_in_s: float = 30, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_in_s = reset_timeout_in_s
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = None
+
+    def allow_request(self) -> bool:
+        if self.state == self.OPEN and self.clock() - self._opened_at >= self.reset_timeout_in_s:
+            self.state = self.HALF_OPEN
+            return True
+        return self.state == self.CLOSED
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning("Routing circuit breaker opened after %s failed requests", self.failures)
+            self.state = self.OPEN
+            self._opened_at = self.clock()
+
+
+class AsyncRoutingService:
+    """
+    AsyncRoutingService requests routes from GraphHopper via a pool of
+    keep-alive connections, with at most max_in_flight requests at once.
+    Requests time out after timeout_in_s and are retried up to retries
+    times with exponential backoff and jitter if GraphHopper is
+    unreachable, overloaded or fails. While the circuit breaker is open,
+    requests fail immediately with a RoutingUnavailableException.
+
+    The HTTP client is created on first use in the running event loop,
+    aclose() closes it again.
+    """
+
+    RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+    def __init__(self, gh_url = 'https://api.mfdz.de/gh', cache: RoutingCache = None, max_in_flight: int = 8,
+            timeout_in_s: float = 10, retries: int = 2, retry_backoff_in_s: float = 0.5,
+            breaker: CircuitBreaker = None, transport: httpx.AsyncBaseTransport = None):
+        self.gh_service_url = gh_url
+        self.cache = cache
+        self.max_in_flight = max_in_flight
+        self.timeout_in_s = timeout_in_s
+        self.retries = retries
+        self.retry_backoff_in_s = retry_backoff_in_s
+        self.breaker = breaker or CircuitBreaker()
+        self.transport = transport
+        # concurrent requests for the same points share one GraphHopper request
+        self.in_flight = AsyncSingleFlight()
+        self._client = None
+        self._in_flight = None
+
+    async def path_for_stops(self, points):
+        """
+        Retrieves the graphhopper route traversing the given points.
+        """
+        directions = await self._get_directions(points)
+        if directions and len(directions.get("paths"))>0:
+            return directions.get("paths")[0]
+        else:
+            return {}
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            self._in_flight = None
+
+    async def _get_directions(self, points):
+        if self.cache is None:
+            return await self.in_flight.do(_points_key(points), self._request_directions, points)
+        key = self.cache.key(points, self.gh_service_url)
+        # the cache blocks on SQLite, so it is accessed outside of the event loop
+        directions = await asyncio.to_thread(self.cache.get, key)
+        if directions is None:
+            directions = await self.in_flight.do(key, self._request_and_cache_directions, key, points)
+        return directions
+
+    async def _request_and_cache_directions(self, key, points):
+        directions = await self._request_directions(points)
+        await asyncio.to_thread(self.cache.put, key, directions)
+        return directions
+
+    async def _request_directions(self, points):
+        if not self.breaker.allow_request():
+            raise RoutingUnavailableException("Routing circuit breaker is open, GraphHopper seems unavailable")
+        req_url = _directions_url(self.gh_service_url, points, True, True)
+        available = False
+        # Any other exit than an answer of GraphHopper, including cancellation
+        # and unreadable responses, counts as failure, so a trial request of
+        # a half-open breaker always closes or reopens it
+        try:
+            for attempt in range(self.retries + 1):
+                if attempt > 0:
+                    await asyncio.sleep(random.uniform(0, self.retry_backoff_in_s * 2 ** (attempt - 1)))
+                try:
+                    response = await self._get(req_url)
+                except httpx.TransportError as err:
+                    error = RoutingUnavailableException("Get directions failed: {}".format(repr(err)))
+                else:
+                    if response.status_code not in self.RETRY_STATUS_CODES:
+                        try:
+                            directions = _directions_from_response(response)
+                        except RoutingException:
+                            # GraphHopper could not find a route, but is available
+                            available = True
+                            raise
+                        available = True
+                        return directions
+                    error = RoutingUnavailableException("Get directions failed with status code {}".format(response.status_code))
+                logger.debug("Attempt %s to get directions via %s failed: %s", attempt + 1, req_url, error)
+            raise error
+        finally:
+            if available:
+                self.breaker.record_success()
+            else:
+                self.breaker.record_failure()
+
+    async def _get(self, req_url):
+        if self._client is None:
+            limits = httpx.Limits(max_connections=self.max_in_flight, max_keepalive_connections=self.max_in_flight)
+            self._client = httpx.AsyncClient(limits=limits, timeout=self.timeout_in_s, transport=self.transport)
+            self._in_flight = asyncio.Semaphore(self.max_in_flight)
+        async with self._in_flight:
+            logger.debug("Get directions via: {}".format(req_url))
+            return await self._client.get(req_url)    
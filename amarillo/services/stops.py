@@ -19,10 +19,26 @@ from .stop_importer import CsvStopsImporter, GeojsonStopsImporter, GtfsStopsImpo
 logger = logging.getLogger(__name__)
 
 
+# mfdz: or bbnavi: prefixed stops are custom stops which are explicitly meant to be carpooling stops
+CARPOOLING_STOP_ID_PREFIXES = ('mfdz:', 'bbnavi:')
+# Lower case parts of the names of carpooling stops
+CARPOOLING_STOP_NAME_PARTS = ('mitfahr', 'p&m')
+
+
 def is_carpooling_stop(stop_id, name):
     stop_name = name.lower()
-    # mfdz: or bbnavi: prefixed stops are custom stops which are explicitly meant to be carpooling stops
-    return stop_id.startswith('mfdz:') or stop_id.startswith('bbnavi:') or 'mitfahr' in stop_name or 'p&m' in stop_name
+    return stop_id.startswith(CARPOOLING_STOP_ID_PREFIXES) or any(part in stop_name for part in CARPOOLING_STOP_NAME_PARTS)
+
+
+def carpooling_stops_mask(stop_ids: pd.Series, names: pd.Series) -> pd.Series:
+    """
+    Returns is_carpooling_stop for all stops given as Series of ids and names.
+    """
+    stop_names = names.str.lower()
+    mask = stop_ids.str.startswith(CARPOOLING_STOP_ID_PREFIXES)
+    for part in CARPOOLING_STOP_NAME_PARTS:
+        mask |= stop_names.str.contains(part, regex=False)
+    return mask
 
 
 class StopsStore:
@@ -31,6 +47,8 @@ class StopsStore:
         self.projection = Transformer.from_crs('EPSG:4326', internal_projection, always_xy=True).transform
         self.stopsDataFrames = []
         self.stop_sources = stop_sources if stop_sources is not None else []
+        # changes whenever stopsDataFrames are replaced
+        self.version = 0
 
     def load_stop_sources(self):
         """Imports stops from  stop_sources and registers them with
@@ -74,6 +92,7 @@ class StopsStore:
 
         if not error_occured:
             self.stopsDataFrames = stopsDataFrames
+            self.version += 1
 
     def find_additional_stops_around(self, line, stops=None):
         """Returns a GeoDataFrame with all stops in vicinity of the
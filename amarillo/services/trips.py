@@ -2,19 +2,172 @@ from amarillo.services.config import config
 from amarillo.models.gtfs import GtfsTimeDelta, GtfsStopTime
 from amarillo.models.Carpool import MAX_STOPS_PER_TRIP, Carpool, Weekday, StopTime, PickupDropoffType
 from amarillo.services.gtfs_constants import *
-from amarillo.services.routing import RoutingService, RoutingException
+from amarillo.services.gtfs_fragments import create_trip_fragments
+from amarillo.services.routing import AsyncRoutingService, CircuitBreaker, RoutingService, RoutingException
 from amarillo.services.stops import is_carpooling_stop
 from amarillo.utils.utils import assert_folder_exists, is_older_than_days, yesterday, geodesic_distance_in_m
 from shapely.geometry import Point, LineString, box
 from geojson_pydantic.geometries import LineString as GeoJSONLineString
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, time as dt_time
 import numpy as np
 import os
 import json
 import logging
+import re
+import time
 
 logger = logging.getLogger(__name__)
 
+
+def seconds_after_midnight(gtfs_time):
+    """
+    Converts a time string HH:MM:SS or HH:MM (HH may exceed 23) to seconds after midnight.
+    """
+    m = re.search(r'(\d+):(\d+)(?::(\d+))?', gtfs_time)
+    return int(m.group(1)) * 3600 + int(m.group(2)) * 60 + int(m.group(3) or 0)
+
+
+class ServiceDayTable:
+    """
+    Dates, weekdays and epochs of day_count service days starting at
+    start_date. It is computed once per day and shared by all trips, so
+    the service days and stop time epochs of a trip can be computed via
+    array operations.
+    """
+
+    def __init__(self, start_date, day_count=14):
+        self.start_date = start_date
+        self.dates = [start_date + timedelta(n) for n in range(day_count)]
+        self.date_strs = [d.strftime("%Y%m%d") for d in self.dates]
+        self.dates64 = np.array(self.dates, dtype='datetime64[D]')
+        self.weekdays = np.array([d.weekday() for d in self.dates])
+        self.epochs = np.array([service_day_epoch(d) for d in self.dates], dtype=np.int64)
+
+    def service_days_of(self, trip):
+        """
+        Returns the dates (as YYYYMMDD) the trip runs on and the epochs
+        of these service days as numpy array.
+        """
+        if not trip.runs_regularly:
+            return [trip.start.strftime("%Y%m%d")], np.array([service_day_epoch(trip.start.date())], dtype=np.int64)
+
+        active = trip.weekdays_mask[self.weekdays]
+        if len(trip.non_service_days64) > 0:
+            active &= ~np.isin(self.dates64, trip.non_service_days64)
+        if len(trip.additional_service_days64) > 0:
+            active |= np.isin(self.dates64, trip.additional_service_days64)
+        indices = np.flatnonzero(active)
+        return [self.date_strs[i] for i in indices], self.epochs[indices]
+
+
+class ActiveDays:
+    """
+    Bitset of the active service days of trips within the days of a
+    ServiceDayTable, one row of packed bits per trip. It is computed once
+    per day for all trips at once, applying weekdays, additional and non
+    service days vectorized, so whether a trip runs on a date is answered
+    in O(1). Trips changed later are added when first asked for.
+    """
+
+    def __init__(self, table: ServiceDayTable, trips=()):
+        self.table = table
+        self.start_date = table.start_date
+        self.day_count = len(table.dates)
+        # trip_id -> (trip, packed bits of its active days)
+        self._rows = {}
+        self.add(trips)
+
+    def add(self, trips):
+        trips = list(trips)
+        if len(trips) == 0:
+            return
+        rows = np.packbits(self._active_days(trips), axis=1, bitorder='little')
+        for trip, row in zip(trips, rows):
+            self._rows[trip.trip_id] = (trip, row)
+
+    def _active_days(self, trips):
+        """
+        Returns a boolean matrix with a row per trip and a column per day.
+        """
+        weekdays_masks = np.array([trip.weekdays_mask for trip in trips], dtype=bool).reshape(len(trips), 7)
+        active = weekdays_masks[:, self.table.weekdays]
+        # exception dates only apply to regular trips, others run on their start date only
+        no_days = np.array([], dtype='datetime64[D]')
+        self._set_days(active, [trip.non_service_days64 if trip.runs_regularly else no_days for trip in trips], False)
+        self._set_days(active, [trip.additional_service_days64 if trip.runs_regularly else no_days for trip in trips], True)
+        self._set_days(active, [no_days if trip.runs_regularly else np.array([trip.start.date()], dtype='datetime64[D]') for trip in trips], True)
+        return active
+
+    def _set_days(self, active, days_per_trip, value):
+        counts = [len(days) for days in days_per_trip]
+        if sum(counts) == 0:
+            return
+        trip_indices = np.repeat(np.arange(len(days_per_trip)), counts)
+        day_indices = (np.concatenate(days_per_trip) - self.table.dates64[0]).astype(np.int64)
+        within = (day_indices >= 0) & (day_indices < self.day_count)
+        active[trip_indices[within], day_indices[within]] = value
+
+    def _row(self, trip):
+        cached = self._rows.get(trip.trip_id)
+        # A changed trip is always a new Trip instance
+        if cached is None or cached[0] is not trip:
+            self.add([trip])
+            cached = self._rows[trip.trip_id]
+        return cached[1]
+
+    def runs_on(self, trip, service_date) -> bool:
+        """
+        Returns whether trip runs on service_date.
+        """
+        if isinstance(service_date, datetime):
+            service_date = service_date.date()
+        day = (service_date - self.start_date).days
+        if 0 <= day < self.day_count:
+            return bool(self._row(trip)[day >> 3] >> (day & 7) & 1)
+        # outside of the table's days
+        if not trip.runs_regularly:
+            return trip.start.date() == service_date
+        service_date64 = np.datetime64(service_date, 'D')
+        if service_date64 in trip.additional_service_days64:
+            return True
+        return bool(trip.weekdays_mask[service_date.weekday()]) and service_date64 not in trip.non_service_days64
+
+    def has_remaining_service(self, trip) -> bool:
+        """
+        Returns whether trip runs on any day of the table's days or later.
+        """
+        if not trip.runs_regularly:
+            return trip.start.date() >= self.start_date
+        if self._row(trip).any():
+            return True
+        additional_service_days64 = trip.additional_service_days64
+        return len(additional_service_days64) > 0 and additional_service_days64.max() > self.table.dates64[-1]
+
+    def service_days_of(self, trip):
+        """
+        Returns the dates (as YYYYMMDD) the trip runs on and the epochs
+        of these service days as numpy array. A trip, which is not
+        running regularly, is returned with its start date, if it is not
+        in the past, even if it is beyond the table's days.
+        """
+        if not trip.runs_regularly:
+            if trip.start.date() < self.start_date:
+                return [], np.array([], dtype=np.int64)
+            return [trip.start.strftime("%Y%m%d")], np.array([service_day_epoch(trip.start.date())], dtype=np.int64)
+
+        indices = np.flatnonzero(np.unpackbits(self._row(trip), count=self.day_count, bitorder='little'))
+        return [self.table.date_strs[i] for i in indices], self.table.epochs[indices]
+
+
+def service_day_epoch(service_date):
+    """
+    Returns the epoch GTFS stop times of service_date are relative to,
+    i.e. noon minus 12h local time, which differs from midnight on days
+    with DST changes.
+    """
+    return int(time.mktime(datetime.combine(service_date, dt_time(12)).timetuple())) - 12 * 3600
+
+
 class Trip:
 
     def __init__(self, trip_id, route_name, headsign, url, calendar, departureTime, path, agency, lastUpdated, stop_times, bbox, additional_service_days, non_service_days, stops):
@@ -44,10 +197,20 @@ class Trip:
         self.lastUpdated = lastUpdated
         self.stop_times = stop_times
         self.bbox = bbox
+        # ids of the regions this trip intersects, assigned by TripStore
+        self.region_ids = set()
         self.route_name = route_name
         self.trip_headsign = headsign
         self.additional_service_days = additional_service_days
         self.non_service_days = non_service_days
+        # Precomputed arrays for vectorized service day/stop time calculation
+        self.weekdays_mask = np.array(self.weekdays, dtype=bool)
+        self.additional_service_days64 = np.array(additional_service_days or [], dtype='datetime64[D]')
+        self.non_service_days64 = np.array(non_service_days or [], dtype='datetime64[D]')
+        self.arrival_seconds = np.array([seconds_after_midnight(st.arrival_time if st.arrival_time is not None else st.departure_time)
+            for st in stop_times], dtype=np.int64)
+        self.departure_seconds = np.array([seconds_after_midnight(st.departure_time if st.departure_time is not None else st.arrival_time)
+            for st in stop_times], dtype=np.int64)
 
     def __repr__(self):
         return f'Trip(trip_id={self.trip_id}key: value for key, value , route_name={self.route_name})'
@@ -62,12 +225,10 @@ class Trip:
         return self.start_time.strftime("%H:%M:%S")
 
     def next_trip_dates(self, start_date, day_count=14):
-        if self.runs_regularly:
-            for single_date in (start_date + timedelta(n) for n in range(day_count)):
-                if self.weekdays[single_date.weekday()]==1 and single_date not in self.non_service_days or single_date in self.additional_service_days:
-                    yield single_date.strftime("%Y%m%d")
-        else:
-            yield self.start.strftime("%Y%m%d")
+        if isinstance(start_date, datetime):
+            start_date = start_date.date()
+        dates, _ = ServiceDayTable(start_date, day_count).service_days_of(self)
+        yield from dates
 
     def route_long_name(self):
         return self.route_name
@@ -83,51 +244,130 @@ class TripStore():
 
     Attributes:
         stops_store     Stops store
+        region_service  Optional region service. If given, trips are
+                        indexed by the regions they intersect.
+        routing_cache   Optional RoutingCache of the routes requested
+                        to enhance carpools.
     """
 
-    def __init__(self, stops_store, agency_conf_service):
-        self.transformer = TripTransformer(stops_store, agency_conf_service)
+    def __init__(self, stops_store, agency_conf_service, region_service=None, routing_cache=None):
+        self.transformer = TripTransformer(stops_store, agency_conf_service, routing_cache)
         self.stops_store = stops_store
+        self.region_service = region_service
         self.trips = {}
         self.deleted_trips = {}
         self.recent_trips = {}
+        # region_id -> ids of trips (current or recently deleted) intersecting this region
+        self.region_index = {region_id: set() for region_id in (region_service.regions if region_service else [])}
+        # Callables notified with the trip_id whenever a trip is put or deleted
+        self.change_listeners = []
+        # trip_id -> (trip, its pre-rendered GTFS rows)
+        self._gtfs_fragments = {}
+        # day_count -> ActiveDays of current and deleted trips, starting today
+        self._active_days = {}
           
     def put_carpool(self, carpool: Carpool):
         """
         Adds carpool to the TripStore.
         """
-        id = "{}:{}".format(carpool.agency, carpool.id)
-        filename = f'data/enhanced/{carpool.agency}/{carpool.id}.json'
         try:
-            existing_carpool = self._load_enhanced_carpool_if_exists(carpool.agency, carpool.id)
-            if existing_carpool is not None:
-                logger.info(f"Received put for already enhanced carpool {carpool.agency}:{carpool.id}.")
-                # todo must compare agains unenhanced
-            if existing_carpool and existing_carpool.lastUpdated == carpool.lastUpdated:
-                logger.info(f"Skip enhancement for {carpool.agency}:{carpool.id} as existing is equivalent.")
-                enhanced_carpool = existing_carpool
-            else:
-                if len(carpool.stops) < 2 or self.distance_in_m(carpool) < 1000:
-                    logger.warning("Failed to add carpool %s:%s to TripStore, distance too low", carpool.agency, carpool.id)
-                    self.handle_failed_carpool_enhancement(carpool)
+            enhanced_carpool = self._equivalent_enhanced_carpool(carpool)
+            if enhanced_carpool is None:
+                if not self._is_enhanceable(carpool):
                     return
                 enhanced_carpool = self.transformer.enhance_carpool(carpool)
-                if len(enhanced_carpool.stops) < 2:
-                    logger.warning("Failed to add carpool %s:%s to TripStore, less than two stops after enhancement", carpool.agency, carpool.id)
-                    self.handle_failed_carpool_enhancement(carpool)
+                if not self._store_enhanced_carpool(carpool, enhanced_carpool):
                     return
-                assert_folder_exists(f'data/enhanced/{carpool.agency}/')
-                with open(filename, 'w', encoding='utf-8') as f:
-                    f.write(enhanced_carpool.model_dump_json())
-                logger.info("Added enhanced carpool %s:%s", carpool.agency, carpool.id)
 
             return self._load_as_trip(enhanced_carpool)
-        except RoutingException as err:
-            logger.warning("Failed to add carpool %s:%s to TripStore due to RoutingException %s", carpool.agency, carpool.id, getattr(err, 'message', repr(err)))
-            self.handle_failed_carpool_enhancement(carpool)
         except Exception as err:
-            logger.error("Failed to add carpool %s:%s to TripStore.", carpool.agency, carpool.id, exc_info=True)
+            self._handle_put_error(carpool, err)
+
+    async def put_carpool_async(self, carpool: Carpool):
+        """
+        Adds carpool to the TripStore like put_carpool, but awaits its
+        route, so many carpools can be enhanced concurrently.
+        """
+        enhanced_carpool = await self.enhance_carpool_async(carpool)
+        if enhanced_carpool is not None:
+            return self.put_enhanced_carpools([enhanced_carpool])[0]
+
+    async def enhance_carpool_async(self, carpool: Carpool):
+        """
+        Returns the enhanced carpool, which is only enhanced (awaiting its
+        route) if no equivalent enhanced carpool exists yet, or None if the
+        carpool could not be enhanced. It is stored only once it is put via
+        put_enhanced_carpools, so a discarded enhancement leaves no file.
+        """
+        try:
+            enhanced_carpool = self._equivalent_enhanced_carpool(carpool)
+            if enhanced_carpool is None:
+                if not self._is_enhanceable(carpool):
+                    return None
+                enhanced_carpool = await self.transformer.enhance_carpool_async(carpool)
+                if not self._has_enough_stops(carpool, enhanced_carpool):
+                    return None
+            return enhanced_carpool
+        except Exception as err:
+            self._handle_put_error(carpool, err)
+
+    def put_enhanced_carpools(self, enhanced_carpools):
+        """
+        Stores already enhanced carpools, adds them to the TripStore and
+        returns their trips (None for those which could not be added).
+        """
+        trips = []
+        for enhanced_carpool in enhanced_carpools:
+            try:
+                self._write_enhanced_carpool(enhanced_carpool)
+                trips.append(self._load_as_trip(enhanced_carpool))
+            except Exception as err:
+                self._handle_put_error(enhanced_carpool, err)
+                trips.append(None)
+        return trips
+
+    def _equivalent_enhanced_carpool(self, carpool: Carpool):
+        existing_carpool = self._load_enhanced_carpool_if_exists(carpool.agency, carpool.id)
+        if existing_carpool is not None:
+            logger.info(f"Received put for already enhanced carpool {carpool.agency}:{carpool.id}.")
+            # todo must compare agains unenhanced
+        if existing_carpool and existing_carpool.lastUpdated == carpool.lastUpdated:
+            logger.info(f"Skip enhancement for {carpool.agency}:{carpool.id} as existing is equivalent.")
+            return existing_carpool
+        return None
+
+    def _is_enhanceable(self, carpool: Carpool):
+        if len(carpool.stops) < 2 or self.distance_in_m(carpool) < 1000:
+            logger.warning("Failed to add carpool %s:%s to TripStore, distance too low", carpool.agency, carpool.id)
             self.handle_failed_carpool_enhancement(carpool)
+            return False
+        return True
+
+    def _store_enhanced_carpool(self, carpool: Carpool, enhanced_carpool: Carpool):
+        if not self._has_enough_stops(carpool, enhanced_carpool):
+            return False
+        self._write_enhanced_carpool(enhanced_carpool)
+        return True
+
+    def _has_enough_stops(self, carpool: Carpool, enhanced_carpool: Carpool):
+        if len(enhanced_carpool.stops) < 2:
+            logger.warning("Failed to add carpool %s:%s to TripStore, less than two stops after enhancement", carpool.agency, carpool.id)
+            self.handle_failed_carpool_enhancement(carpool)
+            return False
+        return True
+
+    def _write_enhanced_carpool(self, enhanced_carpool: Carpool):
+        assert_folder_exists(f'data/enhanced/{enhanced_carpool.agency}/')
+        with open(f'data/enhanced/{enhanced_carpool.agency}/{enhanced_carpool.id}.json', 'w', encoding='utf-8') as f:
+            f.write(enhanced_carpool.model_dump_json())
+        logger.info("Added enhanced carpool %s:%s", enhanced_carpool.agency, enhanced_carpool.id)
+
+    def _handle_put_error(self, carpool: Carpool, err: Exception):
+        if isinstance(err, RoutingException):
+            logger.warning("Failed to add carpool %s:%s to TripStore due to RoutingException %s", carpool.agency, carpool.id, getattr(err, 'message', repr(err)))
+        else:
+            logger.error("Failed to add carpool %s:%s to TripStore.", carpool.agency, carpool.id, exc_info=err)
+        self.handle_failed_carpool_enhancement(carpool)
 
     def handle_failed_carpool_enhancement(sellf, carpool: Carpool):
         assert_folder_exists(f'data/failed/{carpool.agency}/')
@@ -141,11 +381,67 @@ class TripStore():
         s2 = carpool.stops[-1]
         return geodesic_distance_in_m((s1.lon, s1.lat), (s2.lon, s2.lat))
 
-    def recently_added_trips(self):
-        return list(self.recent_trips.values())
+    def recently_added_trips(self, region_id=None):
+        return self._trips_by_region(self.recent_trips, region_id)
 
-    def recently_deleted_trips(self):
-        return list(self.deleted_trips.values())
+    def recently_deleted_trips(self, region_id=None):
+        return self._trips_by_region(self.deleted_trips, region_id)
+
+    def trips_in_region(self, region_id):
+        """
+        Returns all current trips intersecting the region with the given id.
+        """
+        return self._trips_by_region(self.trips, region_id)
+
+    def _trips_by_region(self, trips, region_id):
+        if region_id is None:
+            return list(trips.values())
+        trip_ids = list(self.region_index.get(region_id, ()))
+        return [trip for trip in (trips.get(trip_id) for trip_id in trip_ids)
+            if trip is not None and region_id in trip.region_ids]
+
+    def active_days(self, start_date, day_count):
+        """
+        Returns the ActiveDays of all current and recently deleted trips
+        for day_count days starting at start_date, computed once per day.
+        """
+        if isinstance(start_date, datetime):
+            start_date = start_date.date()
+        active_days = self._active_days.get(day_count)
+        if active_days is None or active_days.start_date != start_date:
+            trips = list(self.trips.values()) + list(self.deleted_trips.values())
+            active_days = ActiveDays(ServiceDayTable(start_date, day_count), trips)
+            self._active_days[day_count] = active_days
+        return active_days
+
+    def gtfs_fragments(self, trip):
+        """
+        Returns the pre-rendered GTFS rows of trip, which are rendered
+        once per trip and rerendered only when the trip changed.
+        """
+        cached = self._gtfs_fragments.get(trip.trip_id)
+        # A changed trip is always a new Trip instance
+        if cached is None or cached[0] is not trip:
+            cached = (trip, create_trip_fragments(trip))
+            if self.trips.get(trip.trip_id) is trip:
+                self._gtfs_fragments[trip.trip_id] = cached
+        return cached[1]
+
+    def _update_region_index(self, trip_id):
+        """
+        Indexes trip_id for all regions, which either its current or its
+        recently deleted trip intersect.
+        """
+        region_ids = set()
+        for trips in (self.trips, self.deleted_trips):
+            trip = trips.get(trip_id)
+            if trip is not None:
+                region_ids.update(trip.region_ids)
+        for region_id, trip_ids in self.region_index.items():
+            if region_id in region_ids:
+                trip_ids.add(trip_id)
+            else:
+                trip_ids.discard(trip_id)
 
     def _load_enhanced_carpool_if_exists(self, agency_id: str, carpool_id: str):
         if carpool_exists(agency_id, carpool_id, 'data/enhanced'):
@@ -161,9 +457,17 @@ class TripStore():
     def _load_as_trip(self, carpool: Carpool):
         trip = self.transformer.transform_to_trip(carpool)
         id = trip.trip_id
+        if self.region_service is not None:
+            trip.region_ids = set(self.region_service.region_ids_intersecting(trip.bbox))
         self.trips[id] = trip
+        # A re-added trip supersedes its former deletion, which otherwise
+        # would be published as cancellation of the very same trip
+        self.deleted_trips.pop(id, None)
         if not is_older_than_days(carpool.lastUpdated, 1):
             self.recent_trips[id] = trip
+        self._update_region_index(id)
+        self._gtfs_fragments.pop(id, None)
+        self._notify_trip_changed(id)
         logger.debug("Added trip %s", id)
 
         return trip
@@ -180,12 +484,22 @@ class TripStore():
 
         if self.recent_trips.get(agencyScopedCarpoolId):
             del self.recent_trips[agencyScopedCarpoolId]
+        self._update_region_index(agencyScopedCarpoolId)
+        self._gtfs_fragments.pop(agencyScopedCarpoolId, None)
 
         if carpool_exists(agency_id, carpool_id):
             remove_carpool_file(agency_id, carpool_id)
 
+        self._notify_trip_changed(agencyScopedCarpoolId)
         logger.debug("Deleted trip %s", id)
 
+    def _notify_trip_changed(self, trip_id):
+        for listener in self.change_listeners:
+            try:
+                listener(trip_id)
+            except Exception:
+                logger.exception("Change listener failed for trip %s", trip_id)
+
     def unflag_unrecent_updates(self):
         """
         Trips that were last updated before yesterday, are not recent
@@ -201,17 +515,23 @@ class TripStore():
             t = self.deleted_trips.get(key)
             if t and t.lastUpdated.date() < yesterday():
                 del self.deleted_trips[key]
+                self._update_region_index(key)
 
 
 class TripTransformer:
     REPLACEMENT_STOPS_SERACH_RADIUS_IN_M = 1000
     SIMPLIFY_TOLERANCE = 0.0001
 
-    router = RoutingService(config.graphhopper_base_url)
-
-    def __init__(self, stops_store, agency_conf_service):
+    def __init__(self, stops_store, agency_conf_service, routing_cache=None):
         self.stops_store = stops_store
         self.agency_conf_service = agency_conf_service
+        self.router = RoutingService(config.graphhopper_base_url, routing_cache, config.routing_timeout_in_s)
+        self.async_router = AsyncRoutingService(config.graphhopper_base_url, routing_cache,
+            max_in_flight=config.routing_max_in_flight,
+            timeout_in_s=config.routing_timeout_in_s,
+            retries=config.routing_retries,
+            retry_backoff_in_s=config.routing_retry_backoff_in_s,
+            breaker=CircuitBreaker(config.routing_circuit_breaker_failures, config.routing_circuit_breaker_reset_in_s))
 
 
     def transform_to_trip(self, carpool):
@@ -253,30 +573,61 @@ class TripTransformer:
         agency_conf = self.agency_conf_service.get_agency_conf(carpool.agency)
         return agency_conf.replace_carpool_stops_by_closest_transit_stops
 
+    def _should_use_supplied_path(self, carpool):
+        agency_conf = self.agency_conf_service.get_agency_conf(carpool.agency)
+        return agency_conf.use_supplied_path and carpool.path is not None and len(carpool.path.coordinates) > 1
+
+    def _needs_routing(self, carpool):
+        return self._should_add_dropoff_pickup_stops(carpool) and not self._should_use_supplied_path(carpool)
+
+    def _speed_profile(self, carpool):
+        agency_conf = self.agency_conf_service.get_agency_conf(carpool.agency)
+        return agency_conf.speed_profile or config.default_speed_profile
+
     def enhance_carpool(self, carpool):
+        self._replace_stops_if_configured(carpool)
+        routing_result = self._path_for_ride(carpool) if self._needs_routing(carpool) else None
+        return self._enhance_carpool(carpool, routing_result)
+
+    async def enhance_carpool_async(self, carpool):
+        """
+        Enhances carpool like enhance_carpool, but awaits its route.
+        """
+        self._replace_stops_if_configured(carpool)
+        routing_result = await self._path_for_ride_async(carpool) if self._needs_routing(carpool) else None
+        return self._enhance_carpool(carpool, routing_result)
+
+    def _replace_stops_if_configured(self, carpool):
         if self._should_replace_carpool_stops_by_closest_transit_stops(carpool):
             carpool.stops = self._replace_stops_by_transit_stops(carpool, self.REPLACEMENT_STOPS_SERACH_RADIUS_IN_M)
 
+    def _enhance_carpool(self, carpool, routing_result):
         trip_id = f"{carpool.agency}:{carpool.id}"
         enhanced_carpool = carpool.model_copy(deep=True)
         should_add_dropoff_pickup_stops = self._should_add_dropoff_pickup_stops(carpool)
         
 
         if should_add_dropoff_pickup_stops:
-            if carpool.path is not None:
-                # To enhance stops, we need a path with distance/time points as returned by GraphHopper
-                # A simple linestring is not sufficient
-                logger.warning("For {}, supplied path will be overriden, as agency is configured to enhance dropoff/pickup stops")
-            
-            routing_result = self._path_for_ride(carpool)
-            lineString_shapely_wgs84 = LineString(coordinates=routing_result["points"]["coordinates"]).simplify(0.0001)
-            lineString_wgs84 = GeoJSONLineString(type="LineString", coordinates=list(lineString_shapely_wgs84.coords))
-            enhanced_carpool.path = lineString_wgs84
+            if routing_result is None:
+                # Agency supplied path is used, stop times are estimated by the speed profile
+                enhanced_carpool.path = carpool.path
+            else:
+                if carpool.path is not None:
+                    # To enhance stops, we need a path with distance/time points as returned by GraphHopper
+                    # A simple linestring is not sufficient
+                    logger.warning("For %s, supplied path will be overriden, as agency is configured to enhance dropoff/pickup stops", trip_id)
+
+                lineString_shapely_wgs84 = LineString(coordinates=routing_result["points"]["coordinates"]).simplify(0.0001)
+                lineString_wgs84 = GeoJSONLineString(type="LineString", coordinates=list(lineString_shapely_wgs84.coords))
+                enhanced_carpool.path = lineString_wgs84
 
             if should_add_dropoff_pickup_stops:
                 virtual_stops = self.stops_store.find_additional_stops_around(enhanced_carpool.path, carpool.stops)
                 if not virtual_stops.empty:
-                    virtual_stops["time"] = self._estimate_times(routing_result, virtual_stops['distance'])
+                    if routing_result is None:
+                        virtual_stops["time"] = self._estimate_times_by_speed_profile(self._speed_profile(carpool), virtual_stops['distance'])
+                    else:
+                        virtual_stops["time"] = self._estimate_times(routing_result, virtual_stops['distance'])
                     logger.debug("Virtual stops found: {}".format(virtual_stops))
                 if len(virtual_stops) > MAX_STOPS_PER_TRIP:
                     # in case we found more than MAX_STOPS_PER_TRIP, we retain first and last
@@ -324,6 +675,10 @@ class TripTransformer:
         points = self._stop_coords(carpool.stops)
         return self.router.path_for_stops(points)
 
+    async def _path_for_ride_async(self, carpool):
+        points = self._stop_coords(carpool.stops)
+        return await self.async_router.path_for_stops(points)
+
     def _stop_coords(self, stops):
         # Retrieve coordinates of all officially announced stops (start, intermediate, target)
         return [Point(stop.lon, stop.lat) for stop in stops]
@@ -355,6 +710,22 @@ class TripTransformer:
                 stop_times.append(cumulated_time)
         return stop_times
 
+    def _estimate_times_by_speed_profile(self, speed_profile, distances_from_start):
+        """
+        Estimates the times (in ms) to drive distances_from_start (in m),
+        driving with the speed (km/h) of speed_profile, which starts at
+        the given distance (km) from start.
+        """
+        speed_profile = sorted(speed_profile)
+        starts_in_m = np.array([start for start, _ in speed_profile], dtype=float) * 1000
+        starts_in_m[0] = 0
+        # m/ms
+        speeds = np.array([speed for _, speed in speed_profile], dtype=float) / 3600
+        times_at_starts = np.concatenate(([0], np.cumsum(np.diff(starts_in_m) / speeds[:-1])))
+        distances = np.asarray(distances_from_start, dtype=float)
+        indices = np.maximum(np.searchsorted(starts_in_m, distances, side='right') - 1, 0)
+        return times_at_starts[indices] + (distances - starts_in_m[indices]) / speeds[indices]
+
     def _stops_and_stop_times(self, start_time, trip_id, stops_frame):
         # Assumptions:
         # arrival_time = departure_time
@@ -0,0 +1,76 @@
+from datetime import datetime
+from zipfile import ZipFile
+
+import pytest
+
+from amarillo.models.Carpool import Carpool
+from amarillo.services.agencyconf import AgencyConfService
+from amarillo.services.gtfs_export import GtfsExport
+from amarillo.services.stops import StopsStore
+from amarillo.services.trips import TripStore
+from amarillo.tests.sampledata import agency_conf_without_enhancement, carpool_with_path
+
+
+@pytest.fixture
+def agency_conf_service():
+    """
+    AgencyConfService configuring agency mfdz without enhancement, so
+    carpools like carpool_with_path can be added without routing.
+    """
+    agency_conf_service = AgencyConfService()
+    agency_conf_service.agency_id_to_agency_conf['mfdz'] = agency_conf_without_enhancement
+    return agency_conf_service
+
+
+@pytest.fixture
+def trips_store(agency_conf_service):
+    """
+    TripStore without stops and regions, which adds carpools of agency
+    mfdz without routing.
+    """
+    return TripStore(StopsStore(), agency_conf_service)
+
+
+@pytest.fixture
+def make_carpool():
+    """
+    Creates carpool_with_path, last updated now, with the given changes.
+    """
+    def make_carpool(**changes):
+        return Carpool(**{**carpool_with_path, 'lastUpdated': datetime.now(), **changes})
+    return make_carpool
+
+
+@pytest.fixture
+def put_carpool(trips_store, make_carpool):
+    """
+    Puts carpool_with_path with the given changes into trips_store and
+    returns its trip.
+    """
+    def put_carpool(**changes):
+        return trips_store.put_carpool(make_carpool(**changes))
+    return put_carpool
+
+
+@pytest.fixture
+def export_gtfs(tmp_path, trips_store):
+    """
+    Exports the trips of trips_store as tmp_path / filename and returns
+    the exporter.
+    """
+    def export_gtfs(filename='test.gtfs.zip', feed_info=None, **kwargs):
+        exporter = GtfsExport(None, feed_info, trips_store, StopsStore(), **kwargs)
+        exporter.export(tmp_path / filename)
+        return exporter
+    return export_gtfs
+
+
+@pytest.fixture
+def gtfs_rows():
+    """
+    Reads the rows of the entry filename of a GTFS zip, without header.
+    """
+    def gtfs_rows(gtfszip_filename, filename):
+        with ZipFile(gtfszip_filename) as gtfszip:
+            return gtfszip.read(filename).decode('utf-8').splitlines()[1:]
+    return gtfs_rows
@@ -1,4 +1,5 @@
 from amarillo.models.Carpool import Carpool, StopTime, Weekday
+from amarillo.models.AgencyConf import AgencyConf
 
 # TODO use meanigful values for id and lat, lon
 stops_1234 = [
@@ -125,3 +126,24 @@ carpool_with_unchanged_stops = Carpool(
     departureTime="07:00",
     departureDate=['monday','tuesday',],
 )
+
+# Carpool with stop ids, times and path, which can be added to a TripStore
+# without routing, if its agency is configured as agency_conf_without_enhancement
+carpool_with_path = {
+    'id': "Drei",
+    'agency': "mfdz",
+    'deeplink': "https://mfdz.de/trip/333",
+    'stops': [
+        {'id': "mfdz:12073:001", 'name': "abc", 'lat': 53.11901, 'lon': 14.015776, 'departureTime': "08:00"},
+        {'id': "de:12073:900340137::3", 'name': "xyz", 'lat': 53.011459, 'lon': 13.94945, 'arrivalTime': "08:20"}],
+    'departureTime': "08:00",
+    'departureDate': "2099-05-30",
+    'path': {'type': 'LineString', 'coordinates': [[14.015776, 53.11901], [13.98, 53.06], [13.94945, 53.011459]]},
+}
+
+agency_conf_without_enhancement = AgencyConf(
+    agency_id="mfdz",
+    api_key="THISKEYMUSTBECHANGED",
+    add_dropoffs_and_pickups=False,
+    replace_carpool_stops_by_closest_transit_stops=False,
+)
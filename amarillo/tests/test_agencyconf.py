@@ -1,7 +1,19 @@
+from amarillo.models.AgencyConf import AgencyConf
 from amarillo.services.agencyconf import AgencyConfService
+from pydantic import ValidationError
+import pytest
 
 
 def test_agency_conf():
     service = AgencyConfService()
     assert service.get_agency_conf('matchrider') is not None
     assert len(service.get_agency_conf('matchrider').offers_download_http_headers) > 0
+
+def test_agency_conf_accepts_speed_profile():
+    agency_conf = AgencyConf(agency_id='mfdz', api_key='THISKEYMUSTBECHANGED', speed_profile=[(0, 30), (5, 60)])
+    assert agency_conf.speed_profile == [(0, 30), (5, 60)]
+
+@pytest.mark.parametrize('speed_profile', [[], [(1, 30)], [(0, 30), (5, 0)], [(0, -30)], [(0, 30), (5, 60), (5, 90)], [(0, 30), (30, 90), (5, 60)]])
+def test_agency_conf_rejects_invalid_speed_profile(speed_profile):
+    with pytest.raises(ValidationError):
+        AgencyConf(agency_id='mfdz', api_key='THISKEYMUSTBECHANGED', speed_profile=speed_profile)
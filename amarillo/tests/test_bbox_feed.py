@@ -0,0 +1,54 @@
+import os
+import time
+
+from fastapi import HTTPException
+import pytest
+
+from amarillo.routers.gtfsrt import _parse_bbox
+from amarillo.services.bbox_feed import BboxFeedService
+from amarillo.services.feed_cache import FeedCache
+from amarillo.services.gtfs import GtfsRtProducer
+from amarillo.services.gtfsrt.gtfs_realtime_pb2 import FeedMessage
+
+
+def test_bbox_feed(tmp_path, trips_store, put_carpool):
+    put_carpool()
+    put_carpool(id='Stuttgart', path={'type': 'LineString', 'coordinates': [[9.1, 48.7], [9.2, 48.8]]})
+    GtfsRtProducer(trips_store).export_feed(time.time(), str(tmp_path / 'amarillo.gtfsrt'), spatial_index=True)
+    service = BboxFeedService(FeedCache(), str(tmp_path / 'amarillo.gtfsrt'))
+
+    feed = service.get_feed([13.5, 52.5, 14.5, 53.5])
+    assert [e.id for e in FeedMessage.FromString(feed.content).entity] == ['mfdz:Drei:20990530']
+    assert service.get_feed([13.5, 52.5, 14.5, 53.5]) is feed
+
+    feed = service.get_feed([5, 45, 15, 55], agency='mfdz')
+    assert len(FeedMessage.FromString(feed.content).entity) == 2
+
+    feed = service.get_feed([5, 45, 15, 55], agency='other')
+    assert len(FeedMessage.FromString(feed.content).entity) == 0
+
+def test_bbox_feed_keeps_serving_last_matching_index_while_republished(tmp_path, trips_store, put_carpool):
+    put_carpool()
+    producer = GtfsRtProducer(trips_store)
+    producer.export_feed(time.time(), str(tmp_path / 'amarillo.gtfsrt'), spatial_index=True)
+    service = BboxFeedService(FeedCache(), str(tmp_path / 'amarillo.gtfsrt'))
+    bbox = [13.5, 52.5, 14.5, 53.5]
+    assert len(FeedMessage.FromString(service.get_feed(bbox).content).entity) == 1
+
+    # only the feed, but not yet its index is replaced
+    put_carpool(id='Vier')
+    (tmp_path / 'next').mkdir()
+    producer.export_feed(time.time() + 1, str(tmp_path / 'next' / 'amarillo.gtfsrt'), spatial_index=True)
+    os.replace(tmp_path / 'next' / 'amarillo.gtfsrt.pbf', tmp_path / 'amarillo.gtfsrt.pbf')
+    service._results.clear()
+    assert len(FeedMessage.FromString(service.get_feed(bbox).content).entity) == 1
+
+    os.replace(tmp_path / 'next' / 'amarillo.gtfsrt.index.json', tmp_path / 'amarillo.gtfsrt.index.json')
+    assert len(FeedMessage.FromString(service.get_feed(bbox).content).entity) == 2
+
+def test_parse_bbox_rejects_non_finite_coordinates():
+    assert _parse_bbox('8.9,48.4,9.3,48.9') == [8.9, 48.4, 9.3, 48.9]
+    for bbox in ['nan,48.4,9.3,48.9', '-inf,48.4,inf,48.9', '8.9,48.4,9.3']:
+        with pytest.raises(HTTPException) as err:
+            _parse_bbox(bbox)
+        assert err.value.status_code == 400
@@ -0,0 +1,17 @@
+from amarillo.services import config as config_module
+from amarillo.services.config import Config
+from pydantic import ValidationError
+import pytest
+
+
+def test_columnar_format_requires_pyarrow(monkeypatch):
+    monkeypatch.setattr(config_module, 'find_spec', lambda name: None)
+
+    assert Config(_env_file='config').gtfs_columnar_format is None
+    with pytest.raises(ValidationError):
+        Config(_env_file='config', gtfs_columnar_format='parquet')
+
+@pytest.mark.parametrize('speed_profile', [[], [(1, 30)], [(0, 30), (5, 0)], [(0, 30), (30, 90), (5, 60)]])
+def test_default_speed_profile_rejects_invalid_profile(speed_profile):
+    with pytest.raises(ValidationError):
+        Config(_env_file='config', default_speed_profile=speed_profile)
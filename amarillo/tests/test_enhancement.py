@@ -0,0 +1,102 @@
+from amarillo.tests.sampledata import carpool_with_path, agency_conf_without_enhancement
+from amarillo.models.Carpool import Carpool
+from amarillo.services.enhancement import EnhancementPipeline
+from amarillo.services.routing import AsyncRoutingService
+from datetime import datetime
+import asyncio
+import httpx
+import os
+import threading
+
+
+def carpools(count):
+    # with distinct origins, so their routes are requested separately
+    return [Carpool(**{**carpool_with_path, 'id': f'c{i}',
+        'stops': [{**carpool_with_path['stops'][0], 'lon': 14.0 + i / 1000}, carpool_with_path['stops'][1]]},
+        lastUpdated=datetime.now()) for i in range(count)]
+
+def test_pipeline_adds_enhanced_carpools_in_batches(trips_store):
+    batches = []
+    put_enhanced_carpools = trips_store.put_enhanced_carpools
+    trips_store.put_enhanced_carpools = lambda enhanced: batches.append(len(enhanced)) or put_enhanced_carpools(enhanced)
+    pipeline = EnhancementPipeline(trips_store, workers=4, queue_size=5, batch_size=10)
+    pipeline.start()
+
+    for carpool in carpools(30):
+        pipeline.put_carpool(carpool)
+    pipeline.join()
+
+    assert sorted(trips_store.trips) == sorted(f'mfdz:c{i}' for i in range(30))
+    assert sum(batches) == 30
+    assert max(batches) <= 10
+
+def test_pipeline_discards_enhancements_of_deleted_carpools(trips_store):
+    pipeline = EnhancementPipeline(trips_store)
+    pipeline.start()
+
+    carpool, other = carpools(2)
+    pipeline.put_carpool(carpool)
+    pipeline.delete_carpool(carpool.agency, carpool.id)
+    pipeline.put_carpool(other)
+    pipeline.join()
+
+    assert list(trips_store.trips) == ['mfdz:c1']
+
+def test_pipeline_stores_no_enhancement_of_carpool_deleted_while_routed(agency_conf_service, trips_store):
+    requested = threading.Event()
+
+    async def handler(request):
+        requested.set()
+        await asyncio.sleep(0.05)
+        return httpx.Response(200, json={'paths': [{
+            'points': {'coordinates': carpool_with_path['path']['coordinates']},
+            'instructions': [{'distance': 13000, 'time': 1000000}]}]})
+
+    agency_conf_service.agency_id_to_agency_conf['mfdz'] = agency_conf_without_enhancement.model_copy(update={'add_dropoffs_and_pickups': True})
+    trips_store.transformer.async_router = AsyncRoutingService('http://gh', transport=httpx.MockTransport(handler))
+    pipeline = EnhancementPipeline(trips_store)
+    pipeline.start()
+
+    [carpool] = carpools(1)
+    pipeline.put_carpool(carpool)
+    assert requested.wait(1)
+    pipeline.delete_carpool(carpool.agency, carpool.id)
+    pipeline.join()
+
+    assert trips_store.trips == {}
+    assert not os.path.exists(f'data/enhanced/{carpool.agency}/{carpool.id}.json')
+
+def test_pipeline_unflags_unrecent_updates_in_its_thread(trips_store):
+    threads = []
+    trips_store.unflag_unrecent_updates = lambda: threads.append(threading.current_thread().name)
+    pipeline = EnhancementPipeline(trips_store)
+    pipeline.start()
+
+    pipeline.unflag_unrecent_updates()
+
+    assert threads == ['enhancement-pipeline']
+
+def test_pipeline_awaits_routes_concurrently(agency_conf_service, trips_store):
+    in_flight = []
+    max_in_flight = []
+
+    async def handler(request):
+        in_flight.append(request)
+        max_in_flight.append(len(in_flight))
+        await asyncio.sleep(0.05)
+        in_flight.remove(request)
+        return httpx.Response(200, json={'paths': [{
+            'points': {'coordinates': carpool_with_path['path']['coordinates']},
+            'instructions': [{'distance': 13000, 'time': 1000000}]}]})
+
+    agency_conf_service.agency_id_to_agency_conf['mfdz'] = agency_conf_without_enhancement.model_copy(update={'add_dropoffs_and_pickups': True})
+    trips_store.transformer.async_router = AsyncRoutingService('http://gh', transport=httpx.MockTransport(handler))
+    pipeline = EnhancementPipeline(trips_store, workers=8)
+    pipeline.start()
+
+    for carpool in carpools(16):
+        pipeline.put_carpool(carpool)
+    pipeline.join()
+
+    assert len(trips_store.trips) == 16
+    assert max(max_in_flight) == 8
@@ -0,0 +1,103 @@
+import gzip
+import os
+
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from amarillo.services.feed_cache import CachedFile, DigestStaticFiles, FeedCache, FileDigests, cached_file_response, digest_file_response
+
+
+def request_with_headers(**headers):
+    return Request({'type': 'http', 'headers': [(k.replace('_', '-').encode(), v.encode()) for k, v in headers.items()]})
+
+
+def publish(filename, content):
+    with open(f'{filename}.tmp', 'wb') as f:
+        f.write(content)
+    os.replace(f'{filename}.tmp', filename)
+
+
+def test_feed_cache_reloads_only_published_versions(tmp_path):
+    filename = str(tmp_path / 'feed.pbf')
+    cache = FeedCache()
+    assert cache.get(filename) is None
+
+    publish(filename, b'version 1')
+    cached = cache.get(filename)
+    assert cached.content == b'version 1'
+    assert cache.get(filename) is cached
+
+    publish(filename, b'version 2')
+    assert cache.get(filename).content == b'version 2'
+    assert cache.get(filename).etag != cached.etag
+
+
+def test_cached_file_response(tmp_path):
+    filename = str(tmp_path / 'feed.pbf')
+    publish(filename, b'feed content')
+    cached = FeedCache().get(filename)
+
+    response = cached_file_response(request_with_headers(), cached, 'application/x-protobuf')
+    assert response.status_code == 200
+    assert response.body == b'feed content'
+    assert response.headers['etag'] == cached.etag
+
+    response = cached_file_response(request_with_headers(accept_encoding='gzip, deflate'), cached, 'application/x-protobuf')
+    assert response.headers['content-encoding'] == 'gzip'
+    assert gzip.decompress(response.body) == b'feed content'
+
+    response = cached_file_response(request_with_headers(if_none_match=cached.etag), cached, 'application/x-protobuf')
+    assert response.status_code == 304
+    assert response.body == b''
+
+
+def test_digest_file_response_etag_depends_on_content_only(tmp_path):
+    filename = str(tmp_path / 'feed.gtfs.zip')
+    digests = FileDigests()
+    app = FastAPI()
+
+    @app.get('/feed')
+    def get_feed(request: Request):
+        return digest_file_response(request, digests, filename, 'application/zip')
+
+    app.mount('/static', DigestStaticFiles(directory=str(tmp_path), digests=digests))
+    client = TestClient(app)
+
+    publish(filename, b'feed content')
+    etag = client.get('/feed').headers['etag']
+    publish(filename, b'feed content')
+    for path in ['/feed', '/static/feed.gtfs.zip']:
+        response = client.get(path)
+        assert response.headers['etag'] == etag
+        assert response.content == b'feed content'
+        assert client.get(path, headers={'If-None-Match': etag}).status_code == 304
+        response = client.get(path, headers={'Range': 'bytes=5-11'})
+        assert response.status_code == 206
+        assert response.content == b'content'
+
+    publish(filename, b'new feed content')
+    response = client.get('/feed', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['etag'] != etag
+
+def test_cached_file_response_respects_gzip_qvalues(tmp_path):
+    filename = str(tmp_path / 'feed.pbf')
+    publish(filename, b'feed content')
+    cached = FeedCache().get(filename)
+
+    for accept_encoding, gzipped in [('gzip;q=0', False), ('GZIP; q=0.5', True), ('*', True),
+            ('*;q=0.1, gzip;q=0', False), ('deflate', False), ('identity, *;q=0', False)]:
+        response = cached_file_response(request_with_headers(accept_encoding=accept_encoding), cached, 'application/x-protobuf')
+        assert ('content-encoding' in response.headers) == gzipped, accept_encoding
+
+def test_bounded_derivations_keep_fixed_derivations(tmp_path):
+    filename = str(tmp_path / 'feed.pbf')
+    publish(filename, b'feed content')
+    cached = FeedCache().get(filename)
+    message = cached.derive('message', bytes.upper)
+
+    for since in range(CachedFile.MAX_DERIVED + 10):
+        cached.derive_bounded(('since', since), lambda content: object())
+    assert cached.derive('message', lambda content: None) is message
+    assert len(cached._bounded_derived) == CachedFile.MAX_DERIVED
+    assert ('since', 9) not in cached._bounded_derived
@@ -1,11 +1,25 @@
 from amarillo.tests.sampledata import carpool_1234, data1, carpool_repeating_json, carpool_with_exception_dates, stop_issue
-from amarillo.services.gtfs_export import GtfsExport
-from amarillo.services.gtfs import GtfsRtProducer
+from amarillo.services import gtfs_export
+from amarillo.services.gtfs_export import CompressedZipWriter, GtfsExport, GtfsFeedInfo, GtfsStopCatalog, MultiRegionGtfsExport
+from amarillo.services.gtfs_fragments import create_calendar_dates
+from amarillo.services.regions import RegionService
+from amarillo.services.gtfs import DepartureIndex, GtfsRtProducer, feed_to_json
 from amarillo.services.stops import StopsStore
 from amarillo.services.trips import TripStore
 from amarillo.services.agencyconf import AgencyConfService
 from amarillo.models.Carpool import Carpool
+from amarillo.utils.utils import assert_folder_exists
+from amarillo.services.gtfsrt.gtfs_realtime_pb2 import FeedHeader, FeedMessage, TripDescriptor, TripUpdate
+from google.protobuf.json_format import ParseDict, MessageToDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_LZMA, ZIP_STORED
+import json
+import multiprocessing
+import os
+import runpy
+import shutil
 import time
 import pytest
 
@@ -17,7 +31,8 @@ def test_gtfs_generation():
     trips_store.put_carpool(cp)
 
     exporter = GtfsExport(None, None, trips_store, stops_store)
-    exporter.export('target/tests/test_gtfs_generation/test.gtfs.zip', "target/tests/test_gtfs_generation")
+    assert_folder_exists('target/tests/test_gtfs_generation')
+    exporter.export('target/tests/test_gtfs_generation/test.gtfs.zip')
 
 def test_gtfs_generation_with_exception_dates():
     cp = Carpool(**carpool_with_exception_dates)
@@ -25,11 +40,231 @@ def test_gtfs_generation_with_exception_dates():
     trips_store = TripStore(stops_store, AgencyConfService())
     trips_store.put_carpool(cp)
 
-    exporter = GtfsExport(None, None, trips_store, stops_store)
-    exporter._prepare_gtfs_feed(trips_store, stops_store)
-    assert len(exporter.calendar_dates) == 2
-    assert exporter.calendar_dates[0].date == '20250102'
-    assert exporter.calendar_dates[0].exception_type == 1
+    calendar_dates = create_calendar_dates(next(iter(trips_store.trips.values())))
+    assert len(calendar_dates) == 2
+    assert calendar_dates[0].date == '20250102'
+    assert calendar_dates[0].exception_type == 1
+
+def test_gtfs_export_replaces_zip_atomically(tmp_path, put_carpool, export_gtfs, gtfs_rows):
+    put_carpool()
+    gtfszip_filename = tmp_path / 'test.gtfs.zip'
+    gtfszip_filename.write_bytes(b'previous')
+
+    export_gtfs()
+
+    assert [path.name for path in tmp_path.iterdir()] == ['test.gtfs.zip']
+    assert gtfs_rows(gtfszip_filename, 'trips.txt')[0].startswith('mfdz:Drei,mfdz:Drei,')
+    assert len(gtfs_rows(gtfszip_filename, 'stop_times.txt')) == 2
+    assert len(gtfs_rows(gtfszip_filename, 'stops.txt')) == 2
+
+def test_gtfs_export_compressed_entries_equal_stored_entries(tmp_path, agency_conf_service, make_carpool):
+    stops_store = StopsStore([{'url': 'amarillo/tests/stops.csv', 'vicinity': 50}])
+    stops_store.load_stop_sources()
+    trips_store = TripStore(stops_store, agency_conf_service)
+    trips_store.put_carpool(make_carpool())
+
+    GtfsExport(None, None, trips_store, stops_store, compression=ZIP_STORED).export(tmp_path / 'stored.gtfs.zip')
+    GtfsExport(None, None, trips_store, stops_store, compression=ZIP_DEFLATED, compresslevel=9).export(tmp_path / 'deflated.gtfs.zip')
+
+    with ZipFile(tmp_path / 'stored.gtfs.zip') as stored, ZipFile(tmp_path / 'deflated.gtfs.zip') as deflated:
+        assert stored.testzip() is None
+        assert deflated.testzip() is None
+        assert deflated.namelist() == stored.namelist()
+        assert {info.compress_type for info in deflated.infolist()} == {ZIP_DEFLATED}
+        assert deflated.getinfo('stop_times.txt').compress_size < deflated.getinfo('stop_times.txt').file_size
+        for name in stored.namelist():
+            assert deflated.read(name) == stored.read(name)
+
+@pytest.mark.parametrize('zip64', [False, True])
+@pytest.mark.parametrize('compression, compresslevel', [(ZIP_STORED, None), (ZIP_DEFLATED, None), (ZIP_DEFLATED, 1), (ZIP_DEFLATED, 9)])
+def test_gtfs_export_is_valid_zip(monkeypatch, put_carpool, export_gtfs, compression, compresslevel, zip64):
+    if zip64:
+        # lowered limits force zip64 extra fields and end records for every entry
+        monkeypatch.setattr(CompressedZipWriter, 'ZIP64_LIMIT', 0)
+        monkeypatch.setattr(CompressedZipWriter, 'ZIP_FILECOUNT_LIMIT', 0)
+    put_carpool()
+
+    exporter = export_gtfs(compression=compression, compresslevel=compresslevel)
+
+    with ZipFile(exporter._gtfszip_filename) as gtfszip:
+        assert gtfszip.testzip() is None
+        assert len(gtfszip.namelist()) == 9
+        assert gtfszip.read('trips.txt').startswith(b'route_id,trip_id,')
+
+def test_gtfs_export_rejects_unsupported_compression():
+    with pytest.raises(ValueError):
+        GtfsExport(None, None, None, None, compression=ZIP_LZMA)
+
+def test_gtfs_export_of_unchanged_trips_is_identical(tmp_path, put_carpool, export_gtfs, gtfs_rows):
+    put_carpool(id='Vier')
+    put_carpool()
+    feed_info = GtfsFeedInfo('mfdz', 'MITFAHR|DE|ZENTRALE', 'http://www.mitfahrdezentrale.de', 'de', 'info@mfdz.de', '', None)
+
+    first_version = export_gtfs('first.gtfs.zip', feed_info).feed_version
+    time.sleep(1)
+    export_gtfs('second.gtfs.zip', feed_info)
+
+    assert (tmp_path / 'first.gtfs.zip').read_bytes() == (tmp_path / 'second.gtfs.zip').read_bytes()
+    assert [row.split(',')[1] for row in gtfs_rows(tmp_path / 'first.gtfs.zip', 'trips.txt')] == ['mfdz:Drei', 'mfdz:Vier']
+    assert gtfs_rows(tmp_path / 'first.gtfs.zip', 'feed_info.txt')[0].split(',')[-1] == first_version
+
+    put_carpool(deeplink='https://mfdz.de/trip/4')
+    assert export_gtfs('third.gtfs.zip', feed_info).feed_version != first_version
+
+def test_gtfs_export_writes_columnar_files(tmp_path, put_carpool, export_gtfs):
+    pyarrow = pytest.importorskip('pyarrow')
+    import pyarrow.parquet
+    put_carpool()
+
+    export_gtfs(columnar_format='parquet')
+    export_gtfs(columnar_format='arrow')
+
+    stop_times = pyarrow.parquet.read_table(tmp_path / 'test.stop_times.parquet', filters=[('stop_sequence', '=', 2)])
+    assert stop_times.column('trip_id').to_pylist() == ['mfdz:Drei']
+    with pyarrow.memory_map(str(tmp_path / 'test.trips.arrow')) as source:
+        trips = pyarrow.ipc.open_file(source).read_all()
+    assert trips.column('trip_headsign').to_pylist() == ['xyz']
+    assert trips.schema.field('bikes_allowed').type == pyarrow.int32()
+    assert pyarrow.parquet.read_table(tmp_path / 'test.calendar_dates.parquet').num_rows == 1
+
+def test_gtfs_export_skips_trips_without_remaining_service(tmp_path, put_carpool, export_gtfs, gtfs_rows):
+    put_carpool()
+    put_carpool(id='Vier', departureDate='2022-05-30')
+
+    export_gtfs()
+
+    assert [row.split(',')[1] for row in gtfs_rows(tmp_path / 'test.gtfs.zip', 'trips.txt')] == ['mfdz:Drei']
+
+def test_gtfs_export_shares_shapes_and_services_of_equal_trips(tmp_path, trips_store, put_carpool, export_gtfs, gtfs_rows):
+    put_carpool()
+    put_carpool(id='Vier')
+    put_carpool(id='Fuenf', departureDate=['monday'])
+
+    export_gtfs()
+
+    gtfszip_filename = tmp_path / 'test.gtfs.zip'
+    trips = {row.split(',')[1]: row.split(',') for row in gtfs_rows(gtfszip_filename, 'trips.txt')}
+    calendar = gtfs_rows(gtfszip_filename, 'calendar.txt')
+    calendar_dates = gtfs_rows(gtfszip_filename, 'calendar_dates.txt')
+    shapes = gtfs_rows(gtfszip_filename, 'shapes.txt')
+    assert trips['mfdz:Drei'][2:4] == trips['mfdz:Vier'][2:4]
+    assert trips['mfdz:Fuenf'][2] != trips['mfdz:Drei'][2]
+    assert trips['mfdz:Fuenf'][3] == trips['mfdz:Drei'][3]
+    assert sorted(row.split(',')[0] for row in calendar) == sorted({trip[2] for trip in trips.values()})
+    assert [row.split(',')[0] for row in calendar_dates] == [trips['mfdz:Drei'][2]]
+    assert {row.split(',')[0] for row in shapes} == {trips['mfdz:Drei'][3]}
+    assert len(shapes) == len(trips_store.trips['mfdz:Drei'].path.coordinates)
+
+def test_gtfs_export_of_unchanged_trips_is_identical_within_a_week(tmp_path, monkeypatch, put_carpool, export_gtfs, gtfs_rows):
+    put_carpool(departureDate='2099-06-01')
+    put_carpool(id='Vier', departureDate=['monday'])
+    export_date = None
+    class ExportDatetime(datetime):
+        @classmethod
+        def today(cls):
+            return export_date
+    monkeypatch.setattr(gtfs_export, 'datetime', ExportDatetime)
+
+    export_date = ExportDatetime(2026, 10, 20, 8, 15)
+    tuesday_version = export_gtfs('tuesday.gtfs.zip').feed_version
+    export_date = ExportDatetime(2026, 10, 25, 23, 45)
+    sunday_version = export_gtfs('sunday.gtfs.zip').feed_version
+
+    assert tuesday_version == sunday_version
+    calendar = {row.split(',')[0]: row.split(',')[1:3] for row in gtfs_rows(tmp_path / 'sunday.gtfs.zip', 'calendar.txt')}
+    assert sorted(calendar.values()) == [['20261019', '20261125'], ['20990601', '20990601']]
+
+def test_trips_with_reordered_exceptions_share_their_service(trips_store, put_carpool):
+    exceptions = [{'date': '2099-06-08', 'exceptionType': 'removed'}, {'date': '2099-06-03', 'exceptionType': 'added'},
+        {'date': '2099-06-01', 'exceptionType': 'removed'}]
+    drei = trips_store.gtfs_fragments(put_carpool(departureDate=['monday'], exceptionDates=exceptions))
+    vier = trips_store.gtfs_fragments(put_carpool(id='Vier', departureDate=['monday'], exceptionDates=exceptions[::-1]))
+
+    assert drei.service_id == vier.service_id
+    assert drei.calendar_dates == vier.calendar_dates
+    assert [row.split(',')[1:] for row in drei.calendar_dates.splitlines()] == [['20990601', '2'], ['20990603', '1'], ['20990608', '2']]
+
+def test_multi_region_gtfs_export_equals_region_export(tmp_path, agency_conf_service, make_carpool):
+    stops_store = StopsStore([{'url': 'amarillo/tests/stops.csv', 'vicinity': 50}])
+    stops_store.load_stop_sources()
+    region_service = RegionService()
+    trips_store = TripStore(stops_store, agency_conf_service, region_service)
+    trips_store.put_carpool(make_carpool())
+    regions = [region_service.get_region('bb'), region_service.get_region('bw')]
+
+    MultiRegionGtfsExport(None, None, trips_store, stops_store, regions, max_workers=2).export(
+        str(tmp_path / 'multi.{region_id}.gtfs.zip'))
+
+    for region in regions:
+        GtfsExport(None, None, trips_store, stops_store, region.bbox, region.id).export(tmp_path / f'{region.id}.gtfs.zip')
+        with ZipFile(tmp_path / f'{region.id}.gtfs.zip') as expected, ZipFile(tmp_path / f'multi.{region.id}.gtfs.zip') as actual:
+            assert actual.namelist() == expected.namelist()
+            for name in expected.namelist():
+                assert actual.read(name) == expected.read(name)
+
+def test_multi_region_gtfs_export_falls_back_to_serial_export(tmp_path, agency_conf_service, make_carpool, gtfs_rows, monkeypatch):
+    class BrokenProcessPoolExecutor:
+        def __init__(self, *args):
+            pass
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            return False
+
+        def submit(self, *args):
+            future = Future()
+            future.set_exception(BrokenProcessPool())
+            return future
+
+    monkeypatch.setattr(gtfs_export, 'ProcessPoolExecutor', BrokenProcessPoolExecutor)
+    region_service = RegionService()
+    trips_store = TripStore(StopsStore(), agency_conf_service, region_service)
+    trips_store.put_carpool(make_carpool())
+    regions = [region_service.get_region('bb'), region_service.get_region('bw')]
+
+    MultiRegionGtfsExport(None, None, trips_store, StopsStore(), regions, max_workers=2).export(
+        str(tmp_path / 'multi.{region_id}.gtfs.zip'))
+
+    assert len(gtfs_rows(tmp_path / 'multi.bb.gtfs.zip', 'trips.txt')) == 1
+    assert (tmp_path / 'multi.bw.gtfs.zip').exists()
+
+ENHANCER_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'enhancer.py'))
+
+def _run_enhancer_as_spawned_main(working_directory):
+    os.chdir(working_directory)
+    # what a spawned worker process does with the parent's main script
+    runpy.run_path(ENHANCER_PATH, run_name='__mp_main__')
+    return 'imported'
+
+def test_enhancer_entrypoint_is_import_safe_in_spawned_workers(tmp_path):
+    shutil.copytree('conf', tmp_path / 'conf')
+    (tmp_path / 'conf' / 'feed_info.json').write_text(json.dumps({'feed_id': 'mfdz', 'feed_publisher_name': 'MITFAHR|DE|ZENTRALE',
+        'feed_publisher_url': 'http://www.mitfahrdezentrale.de/', 'feed_lang': 'de', 'feed_contact_email': 'info@null.com'}))
+
+    with ProcessPoolExecutor(1, multiprocessing.get_context('spawn')) as executor:
+        assert executor.submit(_run_enhancer_as_spawned_main, str(tmp_path)).result(timeout=60) == 'imported'
+    # neither the enhancer services were configured nor its folders created
+    assert not (tmp_path / 'data').exists()
+
+def test_stop_catalog_renders_always_exported_stops_once_per_version(tmp_path):
+    stops_store = StopsStore([{'url': 'amarillo/tests/stops.csv', 'vicinity': 50}])
+    stops_store.load_stop_sources()
+    catalog = GtfsStopCatalog(stops_store)
+
+    stop_ids, csv_rows = catalog.always_exported_stops([14.0, 53.0, 14.1, 53.2])
+    assert stop_ids == {'mfdz:y', 'mfdz:Ang001'}
+    assert csv_rows.splitlines() == ['mfdz:y,53.1,14.01,Stop y', 'mfdz:Ang001,53.11901,14.015776,Mitfahrbank Biesenbrow']
+    assert catalog.always_exported_stops([14.0, 53.0, 14.1, 53.2])[1] is csv_rows
+    assert catalog.get('mfdz:x') == ('mfdz:x', 52.11901, 14.2, 'Stop x')
+
+    exporter = GtfsExport(None, None, TripStore(stops_store, AgencyConfService()), stops_store, stop_catalog=catalog)
+    exporter.export(tmp_path / 'test.gtfs.zip')
+    assert exporter.stop_catalog is catalog
+    stops_store.load_stop_sources()
+    exporter.export(tmp_path / 'test.gtfs.zip')
+    assert exporter.stop_catalog is not catalog
 
 def test_correct_stops():
     cp = Carpool(**stop_issue)
@@ -40,6 +275,10 @@ def test_correct_stops():
     assert len(trips_store.trips) == 1
 
 
+def as_trip_updates(trip_update_dicts):
+    return [ParseDict(trip_update_dict, TripUpdate()) for trip_update_dict in trip_update_dicts]
+
+
 class TestTripConverter:
 
     def setup_method(self, method):
@@ -54,7 +293,7 @@ class TestTripConverter:
         converter = GtfsRtProducer(self.trips_store)
         json = converter._as_delete_updates(trip, datetime(2022,4,11))
 
-        assert json == [{
+        assert json == as_trip_updates([{
             'trip': {
               'tripId': 'mfdz:Eins', 
               'startTime': '23:59:00',
@@ -62,7 +301,7 @@ class TestTripConverter:
               'scheduleRelationship': 'CANCELED', 
               'routeId': 'mfdz:Eins'
             }
-        }]
+        }])
 
     def test_as_one_time_trip_as_added_update(self):
         cp = Carpool(**data1)
@@ -71,7 +310,7 @@ class TestTripConverter:
         
         converter = GtfsRtProducer(self.trips_store)
         json = converter._as_added_updates(trip, datetime(2022,4,11))
-        assert json == [{
+        assert json == as_trip_updates([{
             'trip': {
               'tripId': 'mfdz:Eins', 
               'startTime': '23:59:00',
@@ -124,7 +363,7 @@ class TestTripConverter:
                     }
                   }
                 }]
-        }]
+        }])
 
     def test_as_periodic_trip_as_delete_update(self):
         cp = Carpool(**carpool_repeating_json)
@@ -134,7 +373,7 @@ class TestTripConverter:
         converter = GtfsRtProducer(self.trips_store)
         json = converter._as_delete_updates(trip, datetime(2022,4,11))
 
-        assert json == [{
+        assert json == as_trip_updates([{
                 'trip': {
                   'tripId': 'mfdz:Zwei', 
                   'startTime': '15:00:00',
@@ -152,4 +391,139 @@ class TestTripConverter:
                   'routeId': 'mfdz:Zwei'
                 }
             }
-        ]
\ No newline at end of file
+        ])
+
+
+class TestGtfsRtProducer:
+
+    @pytest.fixture(autouse=True)
+    def setup_producer(self, trips_store, put_carpool):
+        self.trips_store = trips_store
+        self.put_carpool = put_carpool
+        self.producer = GtfsRtProducer(self.trips_store)
+
+    def test_generate_feed(self):
+        self.put_carpool()
+
+        feed = self.producer.generate_feed(time.time(), 'message')
+
+        assert len(feed.entity) == 1
+        assert feed.entity[0].id == 'mfdz:Drei:20990530'
+        assert feed.entity[0].trip_update.trip.trip_id == 'mfdz:Drei'
+        assert len(feed.entity[0].trip_update.stop_time_update) == 2
+
+    def test_cached_entities_are_dropped_on_put_and_delete(self):
+        self.put_carpool()
+        entities = self.producer._get_entities()
+        assert self.producer._get_entities()[0] is entities[0]
+
+        self.put_carpool(departureTime='08:10')
+        entities = self.producer._get_entities()
+        assert entities[0].trip_update.trip.start_time == '08:10:00'
+
+        self.trips_store.delete_carpool('mfdz', 'Drei')
+        entities = self.producer._get_entities()
+        assert len(entities) == 1
+        assert entities[0].trip_update.trip.schedule_relationship == TripDescriptor.CANCELED
+
+    def export_version(self, tmp_path):
+        self.producer.export_feed(time.time(), tmp_path / 'feed')
+        return self.producer._versions_for().version
+
+    def test_generate_differential_feed(self, tmp_path):
+        self.put_carpool()
+        self.put_carpool(id='Vier')
+        version = self.export_version(tmp_path)
+
+        self.put_carpool(id='Vier', departureDate='2099-05-31')
+        self.put_carpool(id='Fuenf')
+        feed = self.producer.generate_feed(time.time(), 'message', since=version)
+
+        assert feed.header.incrementality == FeedHeader.DIFFERENTIAL
+        assert [(e.id, e.is_deleted) for e in feed.entity] == [
+            ('mfdz:Vier:20990531', False), ('mfdz:Fuenf:20990530', False), ('mfdz:Vier:20990530', True)]
+
+        next_version = self.export_version(tmp_path)
+        assert next_version > version
+        assert len(self.producer.generate_feed(time.time(), 'message', since=next_version).entity) == 0
+
+    def test_generate_feed_does_not_advance_feed_version(self, tmp_path):
+        self.put_carpool()
+        version = self.export_version(tmp_path)
+        self.put_carpool(id='Vier')
+
+        for _ in range(2):
+            feed = self.producer.generate_feed(time.time() + 10, 'message', since=version)
+            assert feed.header.timestamp == version
+            assert [e.id for e in feed.entity] == ['mfdz:Vier:20990530']
+        assert self.producer._versions_for().version == version
+
+    def test_generate_full_feed_for_unknown_version(self, tmp_path):
+        self.put_carpool()
+        version = self.export_version(tmp_path)
+
+        feed = self.producer.generate_feed(time.time(), 'message', since=version - 1)
+
+        assert feed.header.incrementality == FeedHeader.FULL_DATASET
+        assert len(feed.entity) == 1
+
+    def test_feed_to_json_equals_message_to_dict(self, tmp_path):
+        self.put_carpool()
+        self.put_carpool(id='Vier', departureDate=['monday', 'friday'])
+        version = self.export_version(tmp_path)
+        self.trips_store.delete_carpool('mfdz', 'Vier')
+
+        for feed in [self.producer.generate_feed(time.time(), 'message'),
+                     self.producer.generate_feed(time.time(), 'message', since=version)]:
+            assert json.loads(feed_to_json(feed)) == MessageToDict(feed)
+
+    def test_exported_feed_is_assembled_from_serialized_entities(self, tmp_path):
+        self.put_carpool()
+        self.put_carpool(id='Vier', departureDate=['monday', 'friday'])
+        self.trips_store.delete_carpool('mfdz', 'Drei')
+
+        self.producer.export_feed(time.time(), tmp_path / 'feed')
+
+        content = (tmp_path / 'feed.pbf').read_bytes()
+        feed = FeedMessage.FromString(content)
+        assert feed.SerializeToString() == content
+        assert feed.entity[:] == self.producer._get_entities()
+        assert feed.header.timestamp == self.producer._versions_for().version
+
+    def test_generate_feed_within_horizon(self):
+        producer = GtfsRtProducer(self.trips_store, horizon_in_hours=36)
+        self.put_carpool(departureDate=['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday'])
+        self.put_carpool(id='Vier')
+        now = time.time()
+
+        feed = producer.generate_feed(now, 'message')
+
+        all_entities = self.producer.generate_feed(now, 'message').entity
+        assert len(all_entities) == 15
+        expected = [e.id for e in all_entities if e.trip_update.stop_time_update[0].departure.time < now + 36 * 3600]
+        assert 2 <= len(expected) <= 3
+        assert sorted(e.id for e in feed.entity) == sorted(expected)
+
+
+def test_service_days_cover_longest_effective_horizon(agency_conf_service):
+    region_service = RegionService()
+    region_service.regions['bb'] = region_service.regions['bb'].model_copy(update={'gtfsrt_horizon_in_hours': 60})
+    trips_store = TripStore(StopsStore(), agency_conf_service, region_service)
+
+    # regions without own horizon use the global one
+    assert GtfsRtProducer(trips_store, horizon_in_hours=36)._day_count == 4
+    assert GtfsRtProducer(trips_store, horizon_in_hours=72)._day_count == 4
+    assert GtfsRtProducer(trips_store)._day_count == GtfsRtProducer.MAX_DAY_COUNT
+
+
+def test_departure_index():
+    index = DepartureIndex()
+    index.update('a', 300)
+    index.update('b', 100)
+    index.update('c', 200)
+    index.update('b', 400)
+    index.update('c', None)
+
+    assert index.trip_ids_departing_before(300) == []
+    assert index.trip_ids_departing_before(301) == ['a']
+    assert index.trip_ids_departing_before(1000) == ['a', 'b']
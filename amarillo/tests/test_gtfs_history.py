@@ -0,0 +1,57 @@
+from amarillo.services import gtfs_export
+from amarillo.services.gtfs_export import GtfsExport, MultiRegionGtfsExport
+from amarillo.services.gtfs_history import GtfsFeedHistory, ADDED, CHANGED, REMOVED
+from amarillo.services.regions import RegionService
+from amarillo.services.stops import StopsStore
+import os
+
+
+def publish(trips_store, history, gtfszip_filename):
+    exporter = GtfsExport(None, None, trips_store, StopsStore())
+    exporter.export(gtfszip_filename)
+    history.record('bb', str(gtfszip_filename), exporter.feed_version)
+    return exporter.feed_version
+
+
+def test_gtfs_feed_history_diff_between_versions(tmp_path, trips_store, put_carpool):
+    history = GtfsFeedHistory(str(tmp_path / 'history'), max_versions=2)
+    gtfszip_filename = tmp_path / 'bb.gtfs.zip'
+
+    put_carpool()
+    v1 = publish(trips_store, history, gtfszip_filename)
+    assert publish(trips_store, history, gtfszip_filename) == v1
+    assert history.versions('bb') == [v1]
+
+    put_carpool(deeplink='https://mfdz.de/trip/4')
+    put_carpool(id='Vier')
+    os.utime(history._zip_filename('bb', v1), ns=(0, 0))
+    v2 = publish(trips_store, history, gtfszip_filename)
+    assert history.versions('bb') == [v2, v1]
+
+    changes = [(c.filename, c.change, c.record.get('trip_id') or c.record.get('route_id')) for c in history.diff('bb', v1, v2)]
+    assert ('routes.txt', CHANGED, 'mfdz:Drei') in changes
+    assert ('routes.txt', ADDED, 'mfdz:Vier') in changes
+    assert ('trips.txt', ADDED, 'mfdz:Vier') in changes
+    assert [c for c in changes if c[0] == 'stop_times.txt'] == [('stop_times.txt', ADDED, 'mfdz:Vier')] * 2
+    assert not [c for c in changes if c[0] in ['shapes.txt', 'calendar.txt', 'stops.txt']]
+
+    trips_store.delete_carpool('mfdz', 'Vier')
+    os.utime(history._zip_filename('bb', v2), ns=(1, 1))
+    v3 = publish(trips_store, history, gtfszip_filename)
+    assert history.versions('bb') == [v3, v2]
+    assert history.diff('bb', v1, v3) is None
+    changes = [(c.filename, c.change) for c in history.diff('bb', v2, v3, ['trips.txt'])]
+    assert changes == [('trips.txt', REMOVED)]
+
+def test_multi_region_export_records_feed_despite_failed_columnar_export(tmp_path, monkeypatch, trips_store, put_carpool):
+    def fail_columnar(*args):
+        raise RuntimeError("Columnar GTFS export requires pyarrow")
+    monkeypatch.setattr(gtfs_export, 'write_columnar', fail_columnar)
+    history = GtfsFeedHistory(str(tmp_path / 'history'))
+    put_carpool()
+
+    MultiRegionGtfsExport(None, None, trips_store, StopsStore(), [RegionService().get_region('bb')], history=history,
+        columnar_format='parquet').export(str(tmp_path / 'amarillo.{region_id}.gtfs.zip'))
+
+    assert (tmp_path / 'amarillo.bb.gtfs.zip').exists()
+    assert len(history.versions('bb')) == 1
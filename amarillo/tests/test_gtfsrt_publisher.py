@@ -0,0 +1,39 @@
+from amarillo.services.gtfs import GtfsRtProducer
+from amarillo.services.gtfsrt_publisher import GtfsRtPublisher
+from amarillo.services.regions import RegionService
+from amarillo.services.stops import StopsStore
+from amarillo.services.trips import TripStore
+
+
+def create_publisher(agency_conf_service, feed_dir):
+    region_service = RegionService()
+    trip_store = TripStore(StopsStore(), agency_conf_service, region_service)
+    publisher = GtfsRtPublisher(GtfsRtProducer(trip_store), trip_store, region_service.regions.keys(), feed_dir)
+    return trip_store, publisher
+
+def published_feeds(feed_dir):
+    return sorted(path.name for path in feed_dir.glob('*.pbf'))
+
+def test_publishes_all_feeds_initially(tmp_path, agency_conf_service):
+    trip_store, publisher = create_publisher(agency_conf_service, tmp_path)
+
+    publisher.publish_pending()
+
+    assert published_feeds(tmp_path) == ['amarillo.bb.gtfsrt.pbf', 'amarillo.bw.gtfsrt.pbf',
+        'amarillo.by.gtfsrt.pbf', 'amarillo.gtfsrt.pbf', 'amarillo.nrw.gtfsrt.pbf']
+
+def test_publishes_only_affected_regions(tmp_path, agency_conf_service, make_carpool):
+    trip_store, publisher = create_publisher(agency_conf_service, tmp_path / 'initial')
+    (tmp_path / 'initial').mkdir()
+    publisher.publish_pending()
+    publisher.feed_dir = tmp_path
+
+    trip_store.put_carpool(make_carpool())
+    assert publisher._seconds_until_publication() > 0
+    publisher.publish_pending()
+    assert published_feeds(tmp_path) == ['amarillo.bb.gtfsrt.pbf', 'amarillo.gtfsrt.pbf']
+
+    (tmp_path / 'amarillo.bb.gtfsrt.pbf').unlink()
+    trip_store.delete_carpool('mfdz', 'Drei')
+    publisher.publish_pending()
+    assert (tmp_path / 'amarillo.bb.gtfsrt.pbf').exists()
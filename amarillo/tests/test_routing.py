@@ -0,0 +1,213 @@
+from amarillo.services.routing import AsyncRoutingService, CircuitBreaker, RoutingCache, RoutingException, RoutingService, RoutingUnavailableException
+from concurrent.futures import ThreadPoolExecutor
+from shapely.geometry import Point
+import asyncio
+import httpx
+import pytest
+import threading
+import time
+
+
+def test_routing_cache_rounds_points_and_counts_hits(tmp_path):
+    cache = RoutingCache(str(tmp_path / 'cache' / 'routing.sqlite'), precision=4)
+    key = cache.key([Point(14.01577, 53.11901), Point(13.94945, 53.011459)], 'gh')
+
+    assert cache.get(key) is None
+    cache.put(key, {'paths': [{'distance': 1000}]})
+
+    assert cache.key([Point(14.015774, 53.119012), Point(13.949452, 53.011461)], 'gh') == key
+    assert cache.get(key) == {'paths': [{'distance': 1000}]}
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'hit_ratio': 0.5}
+    assert RoutingCache(cache.filename).get(key) == {'paths': [{'distance': 1000}]}
+
+def test_routing_cache_evicts_least_recently_used_and_expired_results(tmp_path):
+    cache = RoutingCache(str(tmp_path / 'routing.sqlite'), max_entries=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    time.sleep(0.01)
+    cache.get('a')
+    cache.put('c', 3)
+
+    assert [cache.get(key) for key in 'abc'] == [1, None, 3]
+
+    cache.ttl_in_s = 0
+    assert cache.get('a') is None
+
+def test_routing_cache_evicts_in_batches_and_batches_access_times(tmp_path):
+    cache = RoutingCache(str(tmp_path / 'routing.sqlite'), max_entries=10, evict_ratio=0.5)
+    for i in range(10):
+        cache.put(str(i), i)
+    time.sleep(0.01)
+    assert cache.get('0') == 0
+    # the access time is written with the next eviction
+    assert cache._accessed.keys() == {'0'}
+
+    cache.put('10', 10)
+
+    assert [key for key in map(str, range(11)) if cache.get(key) is not None] == ['0', '7', '8', '9', '10']
+
+def test_routing_service_answers_cached_routes_without_request(tmp_path):
+    cache = RoutingCache(str(tmp_path / 'routing.sqlite'))
+    # unreachable, so only cached routes can be returned
+    service = RoutingService('http://localhost:1', cache)
+    points = [Point(14.01577, 53.11901), Point(13.94945, 53.011459)]
+    cache.put(cache.key(points, service.gh_service_url), {'paths': [{'distance': 1000}]})
+
+    assert service.path_for_stops(points) == {'distance': 1000}
+
+def async_routing_service(handler, **kwargs):
+    return AsyncRoutingService('http://gh', transport=httpx.MockTransport(handler), retry_backoff_in_s=0, **kwargs)
+
+def test_async_routing_service_limits_in_flight_requests_and_retries():
+    in_flight = []
+    max_in_flight = []
+    attempts = []
+
+    async def handler(request):
+        attempts.append(request.url)
+        in_flight.append(request)
+        max_in_flight.append(len(in_flight))
+        await asyncio.sleep(0.01)
+        in_flight.remove(request)
+        if attempts.count(request.url) == 1:
+            return httpx.Response(503)
+        return httpx.Response(200, json={'paths': [{'distance': 1000}]})
+
+    async def route_all(service):
+        try:
+            points = [[Point(14 + i / 100, 53), Point(13.9, 53.01)] for i in range(12)]
+            return await asyncio.gather(*[service.path_for_stops(p) for p in points])
+        finally:
+            await service.aclose()
+
+    service = async_routing_service(handler, max_in_flight=3)
+    assert asyncio.run(route_all(service)) == [{'distance': 1000}] * 12
+    assert max(max_in_flight) == 3
+    assert len(attempts) == 24
+
+def test_async_routing_service_does_not_retry_routes_not_found():
+    attempts = []
+
+    def handler(request):
+        attempts.append(request.url)
+        return httpx.Response(400, json={'message': 'Cannot find point 0'})
+
+    service = async_routing_service(handler)
+    with pytest.raises(RoutingException, match='Cannot find point 0') as err:
+        asyncio.run(service.path_for_stops([Point(14, 53), Point(13.9, 53.01)]))
+    assert not isinstance(err.value, RoutingUnavailableException)
+    assert len(attempts) == 1
+    assert service.breaker.state == CircuitBreaker.CLOSED
+
+def test_async_routing_service_circuit_breaker_fails_fast():
+    now = [0]
+    attempts = []
+    available = [False]
+
+    def handler(request):
+        attempts.append(request.url)
+        if available[0]:
+            return httpx.Response(200, json={'paths': [{'distance': 1000}]})
+        raise httpx.ConnectError('Connection refused')
+
+    service = async_routing_service(handler, retries=1, breaker=CircuitBreaker(2, 30, clock=lambda: now[0]))
+    points = [Point(14, 53), Point(13.9, 53.01)]
+    for _ in range(3):
+        with pytest.raises(RoutingUnavailableException):
+            asyncio.run(service.path_for_stops(points))
+    # the third request is rejected by the open breaker without any attempt
+    assert len(attempts) == 4
+    assert service.breaker.state == CircuitBreaker.OPEN
+
+    now[0] = 30
+    available[0] = True
+    assert asyncio.run(service.path_for_stops(points)) == {'distance': 1000}
+    assert service.breaker.state == CircuitBreaker.CLOSED
+
+def test_async_routing_service_reopens_breaker_after_cancelled_or_failed_trial():
+    now = [0]
+    responses = []
+
+    async def handler(request):
+        response = responses.pop(0)
+        if response is None:
+            # never answered, the trial request is cancelled
+            await asyncio.sleep(10)
+        return response
+
+    async def cancelled_route(service, points):
+        task = asyncio.create_task(service.path_for_stops(points))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    service = async_routing_service(handler, retries=0, breaker=CircuitBreaker(1, 30, clock=lambda: now[0]))
+    points = [Point(14, 53), Point(13.9, 53.01)]
+    responses.append(httpx.Response(503))
+    with pytest.raises(RoutingUnavailableException):
+        asyncio.run(service.path_for_stops(points))
+    assert service.breaker.state == CircuitBreaker.OPEN
+
+    now[0] = 30
+    responses.append(None)
+    asyncio.run(cancelled_route(service, points))
+    assert service.breaker.state == CircuitBreaker.OPEN
+
+    now[0] = 60
+    responses.append(httpx.Response(200, content=b'<html>'))
+    with pytest.raises(ValueError):
+        asyncio.run(service.path_for_stops(points))
+    assert service.breaker.state == CircuitBreaker.OPEN
+
+    now[0] = 90
+    responses.append(httpx.Response(200, json={'paths': [{'distance': 1000}]}))
+    assert asyncio.run(service.path_for_stops(points)) == {'distance': 1000}
+    assert service.breaker.state == CircuitBreaker.CLOSED
+
+def test_routing_service_shares_concurrent_requests_for_same_points():
+    requested = []
+    release = threading.Event()
+
+    class SlowRoutingService(RoutingService):
+        def _request_directions(self, points):
+            requested.append(points)
+            release.wait(1)
+            return {'paths': [{'distance': len(requested)}]}
+
+    service = SlowRoutingService('http://gh')
+    points = [Point(14.01577, 53.11901), Point(13.94945, 53.011459)]
+    with ThreadPoolExecutor(4) as executor:
+        paths = [executor.submit(service.path_for_stops, points) for _ in range(4)]
+        while service.in_flight.shared < 3:
+            time.sleep(0.001)
+        release.set()
+
+    assert [path.result() for path in paths] == [{'distance': 1}] * 4
+    assert len(requested) == 1
+    # once the request completed, the points are requested again
+    assert service.path_for_stops(points) == {'distance': 2}
+
+def test_async_routing_service_shares_concurrent_requests_for_same_points(tmp_path):
+    attempts = []
+
+    async def handler(request):
+        attempts.append(request.url)
+        await asyncio.sleep(0.01)
+        return httpx.Response(200, json={'paths': [{'distance': len(attempts)}]})
+
+    async def route(service, points):
+        try:
+            return await asyncio.gather(*[service.path_for_stops(p) for p in points])
+        finally:
+            await service.aclose()
+
+    service = async_routing_service(handler, cache=RoutingCache(str(tmp_path / 'routing.sqlite')))
+    a = [Point(14, 53), Point(13.9, 53.01)]
+    b = [Point(14.1, 53), Point(13.9, 53.01)]
+    paths = asyncio.run(route(service, [a, b, a, a, b]))
+
+    assert len(attempts) == 2
+    assert service.in_flight.shared == 3
+    assert [paths[i] for i in (2, 3)] == [paths[0]] * 2
+    assert paths[4] == paths[1]
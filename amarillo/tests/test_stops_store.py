@@ -1,5 +1,6 @@
 from amarillo.models.Carpool import StopTime
 from amarillo.services import stops
+import pandas as pd
 
 
 def test_load_stops_from_file():
@@ -8,6 +9,14 @@ def test_load_stops_from_file():
     assert len(store.stopsDataFrames[0]['stops']) > 0
 
 
+def test_reload_changes_version():
+    store = stops.StopsStore([{'url': 'amarillo/tests/stops.csv', 'vicinity': 50}])
+    store.load_stop_sources()
+    version = store.version
+    store.load_stop_sources()
+    assert store.version != version
+
+
 def test_load_csv_stops_from_web_():
     store = stops.StopsStore([{'url': 'https://data.mfdz.de/mfdz/stops/custom.csv', 'vicinity': 50}])
     store.load_stop_sources()
@@ -26,3 +35,11 @@ def test_find_closest_stop():
     carpool_stop = StopTime(name='start', lat=53.1191, lon=14.01577)
     stop = store.find_closest_stop(carpool_stop, 1000)
     assert stop.name == 'Mitfahrbank Biesenbrow'
+
+def test_carpooling_stops_mask_equals_is_carpooling_stop():
+    stop_ids = ['mfdz:1', 'bbnavi:2', 'de:3', 'de:4', 'de:5', 'de:6']
+    names = ['Stop', 'Stop', 'Mitfahrbank', 'P&M Parkplatz', 'Bahnhof', 'Markt']
+
+    mask = stops.carpooling_stops_mask(pd.Series(stop_ids), pd.Series(names))
+    assert mask.tolist() == [stops.is_carpooling_stop(stop_id, name) for stop_id, name in zip(stop_ids, names)]
+    assert mask.tolist() == [True, True, True, True, False, False]
@@ -1,7 +1,10 @@
-from amarillo.tests.sampledata import cp1, carpool_repeating
-from amarillo.services.trips import TripStore
+from amarillo.tests.sampledata import cp1, carpool_repeating, carpool_with_path
+from amarillo.services.trips import ActiveDays, ServiceDayTable, TripStore, TripTransformer
 from amarillo.services.stops import StopsStore
 from amarillo.services.agencyconf import AgencyConfService
+from amarillo.services.regions import RegionService
+from datetime import datetime
+import asyncio
 
 
 import logging
@@ -22,3 +25,77 @@ def test_trip_store_put_repeating_carpool():
     t = trip_store.put_carpool(carpool_repeating)
     assert t != None
     assert len(t.stop_times) >= 2
+
+
+def test_trip_store_indexes_trips_by_region(agency_conf_service, make_carpool):
+    trip_store = TripStore(StopsStore(), agency_conf_service, RegionService())
+
+    t = trip_store.put_carpool(make_carpool())
+    assert t.region_ids == {'bb'}
+    assert trip_store.trips_in_region('bb') == [t]
+    assert trip_store.recently_added_trips('bb') == [t]
+    assert trip_store.trips_in_region('bw') == []
+
+    trip_store.delete_carpool('mfdz', 'Drei')
+    assert trip_store.trips_in_region('bb') == []
+    assert trip_store.recently_deleted_trips('bb') == [t]
+
+
+def test_next_trip_dates_respect_exception_dates(make_carpool):
+    carpool = make_carpool(departureDate=['monday'], exceptionDates=[
+        {'date': '2025-01-06', 'exceptionType': 'removed'},
+        {'date': '2025-01-08', 'exceptionType': 'added'}])
+    trip = TripTransformer(StopsStore(), AgencyConfService()).transform_to_trip(carpool)
+
+    assert list(trip.next_trip_dates(datetime(2025, 1, 1, 10, 0))) == ['20250108', '20250113']
+
+def test_trip_store_rerenders_gtfs_fragments_of_changed_trips(trips_store, put_carpool):
+    t = put_carpool()
+    fragments = trips_store.gtfs_fragments(t)
+    assert fragments.trip == f'mfdz:Drei,mfdz:Drei,{fragments.service_id},{fragments.shape_id},xyz,2\r\n'
+    assert len(fragments.stop_times) == len(t.stop_times)
+    assert trips_store.gtfs_fragments(t) is fragments
+
+    t = put_carpool(deeplink='https://mfdz.de/trip/4')
+    assert trips_store.gtfs_fragments(t) is not fragments
+    assert 'https://mfdz.de/trip/4' in trips_store.gtfs_fragments(t).route
+
+def test_active_days_of_all_trips(make_carpool):
+    transformer = TripTransformer(StopsStore(), AgencyConfService())
+    regular = transformer.transform_to_trip(make_carpool(departureDate=['monday', 'wednesday'], exceptionDates=[
+        {'date': '2025-01-06', 'exceptionType': 'removed'},
+        {'date': '2025-01-09', 'exceptionType': 'added'},
+        {'date': '2025-03-01', 'exceptionType': 'added'}]))
+    past = transformer.transform_to_trip(make_carpool(id='Vier', departureDate='2024-12-31'))
+    upcoming = transformer.transform_to_trip(make_carpool(id='Fuenf', departureDate='2025-01-03'))
+    table = ServiceDayTable(datetime(2025, 1, 1).date(), 14)
+
+    active_days = ActiveDays(table, [regular, past, upcoming])
+
+    assert active_days.service_days_of(regular)[0] == table.service_days_of(regular)[0] == \
+        ['20250101', '20250108', '20250109', '20250113']
+    assert active_days.service_days_of(past)[0] == []
+    assert active_days.service_days_of(upcoming)[0] == ['20250103']
+    assert active_days.runs_on(regular, datetime(2025, 1, 9).date())
+    assert not active_days.runs_on(regular, datetime(2025, 1, 6).date())
+    assert active_days.runs_on(regular, datetime(2025, 3, 1).date())
+    assert active_days.runs_on(regular, datetime(2025, 3, 3).date())
+    assert not active_days.runs_on(upcoming, datetime(2025, 1, 2).date())
+    assert [active_days.has_remaining_service(trip) for trip in [regular, past, upcoming]] == [True, False, True]
+
+def test_trip_store_computes_active_days_once_per_day(trips_store, put_carpool):
+    t = put_carpool(departureDate='2025-01-03')
+
+    active_days = trips_store.active_days(datetime(2025, 1, 1, 10, 0), 32)
+    assert trips_store.active_days(datetime(2025, 1, 1, 23, 0), 32) is active_days
+    assert active_days.runs_on(t, datetime(2025, 1, 3).date())
+
+    t = put_carpool(departureDate='2025-01-04')
+    assert active_days.runs_on(t, datetime(2025, 1, 4).date())
+    assert not active_days.runs_on(t, datetime(2025, 1, 3).date())
+    assert trips_store.active_days(datetime(2025, 1, 2), 32) is not active_days
+
+def test_trip_store_put_carpool_async(trips_store, make_carpool):
+    t = asyncio.run(trips_store.put_carpool_async(make_carpool()))
+    assert trips_store.trips['mfdz:Drei'] is t
+    assert len(t.stop_times) == len(carpool_with_path['stops'])
@@ -1,7 +1,10 @@
-from amarillo.tests.sampledata import carpool_with_unchanged_stops, stops_1234
-from amarillo.services.trips import TripTransformer
+from amarillo.tests.sampledata import carpool_with_unchanged_stops, carpool_with_path, agency_conf_without_enhancement, stops_1234
+from amarillo.models.Carpool import Carpool
+from amarillo.services.routing import RoutingCache
+from amarillo.services.trips import TripStore, TripTransformer
 from amarillo.services.stops import StopsStore
 from amarillo.services.agencyconf import AgencyConfService
+from shapely.geometry import Point
 
 
 def test_transform_carpool_with_unchanged_stops():
@@ -14,3 +17,32 @@ def test_transform_carpool_with_unchanged_stops():
         assert t.stops[i].id == carpool_with_unchanged_stops.stops[i].id
         assert t.stops[0].pickup_dropoff == 'pickup_and_dropoff'
 
+
+def test_enhance_carpool_along_supplied_path_without_routing(agency_conf_service):
+    agency_conf_service.agency_id_to_agency_conf['mfdz'] = agency_conf_without_enhancement.model_copy(
+        update={'add_dropoffs_and_pickups': True, 'use_supplied_path': True, 'speed_profile': [(0, 30), (5, 60)]})
+    trip_transformer = TripTransformer(StopsStore(), agency_conf_service)
+    # no route must be requested
+    trip_transformer.router = None
+
+    carpool = trip_transformer.enhance_carpool(Carpool(**carpool_with_path))
+    assert carpool.path.coordinates == Carpool(**carpool_with_path).path.coordinates
+    assert [stop.id for stop in carpool.stops] == ['mfdz:12073:001', 'de:12073:900340137::3']
+    # about 13 km, 5 km at 30 km/h and 8 km at 60 km/h
+    assert carpool.stops[0].departureTime == '08:00:00'
+    assert '08:17:00' < carpool.stops[-1].arrivalTime < '08:19:00'
+
+def test_estimate_times_by_speed_profile():
+    trip_transformer = TripTransformer(StopsStore(), AgencyConfService())
+
+    times = trip_transformer._estimate_times_by_speed_profile([(0, 30), (5, 60), (30, 90)], [0, 5000, 10000, 40000])
+    assert list(times) == [0, 600000, 900000, 2500000]
+
+def test_transformer_routes_through_injected_routing_cache(tmp_path, agency_conf_service):
+    cache = RoutingCache(str(tmp_path / 'routing.sqlite'))
+    trips_store = TripStore(StopsStore(), agency_conf_service, routing_cache=cache)
+    points = [Point(14.01577, 53.11901), Point(13.94945, 53.011459)]
+    cache.put(cache.key(points, trips_store.transformer.router.gh_service_url), {'paths': [{'distance': 1000}]})
+
+    assert trips_store.transformer.router.path_for_stops(points) == {'distance': 1000}
+    assert trips_store.transformer.async_router.cache is cache
@@ -1,5 +1,6 @@
 import os
 import re
+from contextlib import contextmanager
 from datetime import datetime, date, timedelta
 from pyproj import Geod
 
@@ -8,6 +9,33 @@ def assert_folder_exists(foldername):
         os.makedirs(foldername, exist_ok=True)
 
 
+def write_atomically(filename, content: bytes):
+    """
+    Writes content to a temporary file next to filename and renames it
+    to filename, so readers never see a partially written file.
+    """
+    with open_atomically(filename) as f:
+        f.write(content)
+
+
+@contextmanager
+def open_atomically(filename, mode='wb'):
+    """
+    Opens a temporary file next to filename, which replaces filename
+    when the with block completes, so readers never see a partially
+    written file. If the block fails, the temporary file is removed.
+    """
+    tmp_filename = f"{filename}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_filename, mode) as f:
+            yield f
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+
 def agency_carpool_ids_from_filename(carpool_filename):
     """ 
     Returns agency_id, carpool_id from a carpool filename.
@@ -37,4 +65,20 @@ def geodesic_distance_in_m(coord1, coord2):
     geod = Geod(ellps="WGS84")
     lons = [coord1[0], coord2[0]]
     lats = [coord1[1], coord2[1]]
-    return geod.line_lengths(lons, lats)[0]
\ No newline at end of file
+    return geod.line_lengths(lons, lats)[0]
+def check_speed_profile(speed_profile):
+    """
+    Returns speed_profile, a list of (distance in km, speed in km/h), if its
+    distances start at 0 and are ascending and all speeds are positive,
+    otherwise raises a ValueError.
+    """
+    if not speed_profile:
+        raise ValueError("speed profile must not be empty")
+    distances = [distance for distance, _ in speed_profile]
+    if distances[0] != 0:
+        raise ValueError("speed profile must start at distance 0")
+    if any(previous >= distance for previous, distance in zip(distances, distances[1:])):
+        raise ValueError("speed profile distances must be ascending")
+    if any(speed <= 0 for _, speed in speed_profile):
+        raise ValueError("speed profile speeds must be positive")
+    return speed_profile
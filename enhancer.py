@@ -10,15 +10,8 @@ from amarillo.utils.container import container
 from amarillo.models.Carpool import Carpool
 from amarillo.utils.utils import agency_carpool_ids_from_filename
 
-logging.config.fileConfig('logging.conf', disable_existing_loggers=False)
 logger = logging.getLogger("enhancer")
 
-logger.info("Hello Enhancer")
-
-configure_enhancer_services()
-
-observer = Observer()  # Watch Manager
-
 
 class EventHandler(FileSystemEventHandler):
     # TODO FG HB should watch for both carpools and agencies
@@ -50,24 +43,34 @@ class EventHandler(FileSystemEventHandler):
             logger.exception("Eventhandler on_deleted encountered exception")
 
 
-observer.schedule(EventHandler(), 'data/carpool', recursive=True)
-observer.start()
+def main():
+    logging.config.fileConfig('logging.conf', disable_existing_loggers=False)
+    logger.info("Hello Enhancer")
+
+    configure_enhancer_services()
+
+    observer = Observer()  # Watch Manager
+    observer.schedule(EventHandler(), 'data/carpool', recursive=True)
+    observer.start()
+
+    try:
+        # TODO FG Is this really needed?
+        cnt = 0
+        ENHANCER_LOG_INTERVAL_IN_S = 600
+        while True:
+            if cnt == ENHANCER_LOG_INTERVAL_IN_S:
+                logger.debug("Currently stored carpool ids: %s", container['carpools'].get_all_ids())
+                cnt = 0
+
+            time.sleep(1)
+            cnt += 1
+    finally:
+        observer.stop()
+        observer.join()
+
+        logger.info("Goodbye Enhancer")
 
-import time
 
-try:
-    # TODO FG Is this really needed?
-    cnt = 0
-    ENHANCER_LOG_INTERVAL_IN_S = 600
-    while True:
-        if cnt == ENHANCER_LOG_INTERVAL_IN_S:
-            logger.debug("Currently stored carpool ids: %s", container['carpools'].get_all_ids())
-            cnt = 0
-
-        time.sleep(1)
-        cnt += 1
-finally:
-    observer.stop()
-    observer.join()
-
-    logger.info("Goodbye Enhancer")
+# Guarded, as worker processes spawned e.g. by the GTFS export import this module again
+if __name__ == '__main__':
+    main()